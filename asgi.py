@@ -0,0 +1,471 @@
+"""Modo de servicio asíncrono (ASGI).
+
+/generate se atiende en el event loop con un cliente HTTP asíncrono hacia Ollama, de modo
+que un solo proceso sostiene cientos de consultas en espera del modelo sin un hilo por
+cada una. El resto de las rutas (/, /stats, /metrics, /get_prompt, /save_prompt) las sigue
+atendiendo la app Flask de run.py.
+
+    uvicorn asgi:app --host 0.0.0.0 --port 8001
+"""
+import asyncio
+import contextvars
+import json
+import os
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+from asgiref.wsgi import WsgiToAsgi
+
+import run
+
+# Máximo de consultas /generate simultáneas por proceso (en espera del modelo incluidas)
+ASYNC_MAX_INFLIGHT = int(os.getenv("ASYNC_MAX_INFLIGHT", "1000"))
+OLLAMA_TIMEOUT = float(os.getenv("OLLAMA_TIMEOUT", "120"))
+
+_client: Optional[httpx.AsyncClient] = None
+_inflight = 0
+_flask_app = WsgiToAsgi(run.app)
+# Inicio de la consulta /generate en curso (para el total de Server-Timing)
+_request_started: "contextvars.ContextVar[Optional[float]]" = contextvars.ContextVar("request_started", default=None)
+# Accept-Encoding de la consulta en curso (las respuestas JSON se comprimen como en Flask)
+_accept_encoding: "contextvars.ContextVar[str]" = contextvars.ContextVar("accept_encoding", default="")
+
+
+def _get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=OLLAMA_TIMEOUT,
+            limits=httpx.Limits(max_connections=max(run.MAX_CONCURRENT_GPU * 2, 10)),
+        )
+    return _client
+
+
+async def call_ollama_async(
+    messages: List[Dict[str, str]], model: str = "gemma2:2b", timeout: float = OLLAMA_TIMEOUT,
+    meta: Optional[Dict[str, Any]] = None, options: Optional[Dict[str, Any]] = None,
+) -> str:
+    """Equivalente asíncrono de run.call_ollama (mismo ruteo, circuit breaker y plazo total)."""
+    backends = run.ollama_router.candidates()
+    if not backends:
+        return "No hay endpoints de Ollama configurados."
+    deadline = time.monotonic() + timeout
+    payload = run._chat_payload(messages, model, False, options)
+    last_error = None
+    for backend in backends:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        started = run.ollama_router.begin(backend)
+        try:
+            resp = await _get_client().post(f"{backend.url}/api/chat", json=payload, timeout=remaining)
+            resp.raise_for_status()
+            data = resp.json()
+            content = run.extract_ollama_content(data)
+        except httpx.ReadTimeout as e:
+            # Se agotó el presupuesto de la consulta: no vale probar otro endpoint, pero cuenta como
+            # fallo para el breaker (un Ollama colgado no debe sumar éxitos ni bajar su latencia)
+            run.ollama_router.end(backend, started, e)
+            last_error = e
+            break
+        except Exception as e:
+            run.ollama_router.end(backend, started, e)
+            last_error = e
+            run.app.logger.warning("Error contactando a Ollama en %s: %s", backend.url, e)
+            continue
+        run.ollama_router.end(backend, started)
+        if meta is not None and isinstance(data, dict):
+            meta.update(run.ollama_timings(data))
+        return content
+    if time.monotonic() >= deadline and meta is not None:
+        meta["deadline_exceeded"] = True
+    return f"No se pudo obtener respuesta de Ollama. Último error: {last_error}"
+
+
+async def call_ollama_stream_async(
+    messages: List[Dict[str, str]], model: str = "gemma2:2b", timeout: float = OLLAMA_TIMEOUT,
+    meta: Optional[Dict[str, Any]] = None, options: Optional[Dict[str, Any]] = None,
+):
+    """Equivalente asíncrono de run.call_ollama_stream."""
+    backends = run.ollama_router.candidates()
+    if not backends:
+        yield "No hay endpoints de Ollama configurados."
+        return
+    deadline = time.monotonic() + timeout
+    payload = run._chat_payload(messages, model, True, options)
+    last_error = None
+    for backend in backends:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        started = run.ollama_router.begin(backend)
+        error: Optional[BaseException] = None
+        finished = False
+        resp: Optional[httpx.Response] = None
+        try:
+            client = _get_client()
+            request = client.build_request("POST", f"{backend.url}/api/chat", json=payload, timeout=remaining)
+            resp = await client.send(request, stream=True)
+            resp.raise_for_status()
+            async for line in resp.aiter_lines():
+                if time.monotonic() >= deadline:
+                    if meta is not None:
+                        meta["deadline_exceeded"] = True
+                    break
+                if not line:
+                    continue
+                try:
+                    data = json.loads(line)
+                except ValueError:
+                    continue
+                message = data.get("message")
+                content = message.get("content", "") if isinstance(message, dict) else data.get("response", "")
+                if content:
+                    yield content
+                if data.get("done"):
+                    if meta is not None:
+                        meta.update(run.ollama_timings(data))
+                    break
+            finished = True
+            return
+        except httpx.ReadTimeout as e:
+            error = e
+            if meta is not None:
+                meta["deadline_exceeded"] = True
+            return
+        except httpx.HTTPError as e:
+            error = last_error = e
+            run.app.logger.warning("Error contactando a Ollama en %s: %s", backend.url, e)
+        finally:
+            # Cerrar la respuesta corta la generación en Ollama (también si el cliente se fue)
+            if resp is not None:
+                await resp.aclose()
+            if finished or error is not None:
+                run.ollama_router.end(backend, started, error)
+            else:
+                # Desconexión del cliente o cancelación: no dice nada del endpoint
+                run.ollama_router.release(backend)
+    if time.monotonic() >= deadline and meta is not None:
+        meta["deadline_exceeded"] = True
+        return
+    yield f"No se pudo obtener respuesta de Ollama. Último error: {last_error}"
+
+
+# -----------------------------------------------------------------------------
+# Utilidades ASGI
+# -----------------------------------------------------------------------------
+def _headers(content_type: str, extra: Optional[Dict[str, str]] = None) -> List[Tuple[bytes, bytes]]:
+    # Mismas cabeceras que la app Flask (seguridad y CORS abierto de flask_cors)
+    headers = {
+        "Content-Type": content_type,
+        "Access-Control-Allow-Origin": "*",
+        **run.SECURITY_HEADERS,
+        **(extra or {}),
+    }
+    timings = run._request_timings.get()
+    started = _request_started.get()
+    if run.SERVER_TIMING_ENABLED and timings is not None and started is not None:
+        headers["Server-Timing"] = run.server_timing_header(timings, time.perf_counter() - started)
+    return [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers.items()]
+
+
+async def _send_json(send, status: int, payload: Dict[str, Any]):
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    extra = {"Vary": "Accept-Encoding"}
+    encoding = None
+    if run.COMPRESSION_ENABLED and len(body) >= run.COMPRESSION_MIN_BYTES:
+        encoding = run.choose_encoding(_accept_encoding.get())
+    if encoding is not None:
+        with run.timed("compress"):
+            compressed = run.compress_body(body, encoding)
+        if len(compressed) < len(body):
+            body = compressed
+            extra["Content-Encoding"] = encoding
+    await send({"type": "http.response.start", "status": status, "headers": _headers("application/json", extra)})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _read_body(receive) -> Optional[bytes]:
+    """Cuerpo completo de la petición; None si supera MAX_CONTENT_LENGTH."""
+    limit = run.app.config["MAX_CONTENT_LENGTH"]
+    chunks: List[bytes] = []
+    size = 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return b""
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > limit:
+            return None
+        chunks.append(chunk)
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+def _client_ip(scope) -> str:
+    headers = dict(scope.get("headers") or [])
+    if run.TRUST_PROXY:
+        xff = headers.get(b"x-forwarded-for", b"").decode("latin-1").split(",")[0].strip()
+        if xff:
+            return xff
+    client = scope.get("client")
+    return client[0] if client else "0.0.0.0"
+
+
+async def acquire_gpu_async(client_key: str, receive) -> str:
+    """Equivalente asíncrono de run._try_acquire_gpu: misma cola equitativa, sin ocupar un hilo."""
+    admission = run.gpu_admission
+    lease = admission.try_admit_now()
+    if lease is not None:
+        return lease
+    loop = asyncio.get_running_loop()
+    event = asyncio.Event()
+    waiter = admission.enqueue(client_key, lambda: loop.call_soon_threadsafe(event.set))
+    # El cuerpo ya se leyó: el próximo mensaje sólo puede ser la desconexión del cliente
+    disconnect = asyncio.ensure_future(receive())
+    try:
+        admission.dispatch()
+        while True:
+            if waiter.lease is not None:
+                return waiter.lease
+            if admission.expired(waiter):
+                return admission.give_up(waiter, "gpu_queue_timeout")
+            if disconnect.done() and disconnect.result().get("type") == "http.disconnect":
+                return admission.give_up(waiter, "client_disconnected")
+            try:
+                await asyncio.wait_for(event.wait(), admission.poll)
+            except asyncio.TimeoutError:
+                pass
+            event.clear()
+            admission.poll_shared()
+    finally:
+        disconnect.cancel()
+
+
+async def lead_or_follow_async(
+    query: Dict[str, Any]
+) -> Tuple[Optional[run.InFlightCall], Optional[run.InFlightCall]]:
+    """Equivalente asíncrono de run.lead_or_follow: el seguidor espera a la líder sin ocupar un hilo."""
+    loop = asyncio.get_running_loop()
+    while True:
+        call, leader = run.inflight_generations.join(query["cache_key"])
+        if leader:
+            return call, None
+        event = asyncio.Event()
+        call.add_done_callback(lambda: loop.call_soon_threadsafe(event.set))
+        try:
+            await asyncio.wait_for(event.wait(), run.COALESCE_MAX_WAIT)
+        except asyncio.TimeoutError:
+            run.inflight_generations.abandon(call)
+            continue
+        if call.outcome() is not None:
+            return None, call
+
+
+async def _send_busy(send, rejected: run.AdmissionRejected):
+    run.count_rejection(rejected.reason)
+    if rejected.reason == "client_disconnected":
+        await _send_json(send, 499, {"error": "Client disconnected", "reason": rejected.reason})
+        return
+    body = json.dumps({"error": "System busy", "reason": rejected.reason}).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": 429,
+        "headers": _headers("application/json", {"Retry-After": str(rejected.retry_after)}),
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+# -----------------------------------------------------------------------------
+# /generate asíncrono
+# -----------------------------------------------------------------------------
+async def _stream_generation(send, query: Dict[str, Any], session_id: str, sse: bool, flight: run.InFlightCall):
+    mimetype = "text/event-stream" if sse else "application/x-ndjson"
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": _headers(mimetype, {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}),
+    })
+
+    async def emit(event: Dict[str, Any]):
+        body = run._encode_stream_event(event, sse).encode("utf-8")
+        await send({"type": "http.response.body", "body": body, "more_body": True})
+
+    await emit({"event": "meta", "session_id": session_id})
+    fields = run.StreamingJSONFields()
+    chunks: List[str] = []
+    meta: Dict[str, Any] = {}
+    started = time.perf_counter()
+    stream = call_ollama_stream_async(
+        query["messages"], timeout=run.generation_deadline(query), meta=meta, options=query["options"]
+    )
+    try:
+        async for piece in stream:
+            chunks.append(piece)
+            for event in fields.feed(piece):
+                await emit(event)
+    finally:
+        # Si send() falla por desconexión, el generador no se cerraría hasta el recolector
+        await stream.aclose()
+    run.record_stage("ollama", time.perf_counter() - started)
+    raw_response = "".join(chunks).strip()
+    run.record_generation(query, meta)
+    run.inflight_generations.complete(flight, raw_response, bool(meta.get("deadline_exceeded")))
+    payload, status = await asyncio.to_thread(
+        run.finish_generation, query, raw_response, session_id, timed_out=bool(meta.get("deadline_exceeded"))
+    )
+    await emit({"event": "done", "status": status, **payload})
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def _stream_static(send, payload: Dict[str, Any], sse: bool, status: int = 200):
+    mimetype = "text/event-stream" if sse else "application/x-ndjson"
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": _headers(mimetype, {"Cache-Control": "no-cache"}),
+    })
+    body = "".join(run._stream_static(payload, sse, status)).encode("utf-8")
+    await send({"type": "http.response.body", "body": body})
+
+
+async def generate(scope, receive, send):
+    global _inflight
+    started = time.perf_counter()
+    _request_started.set(started)
+    _accept_encoding.set(dict(scope.get("headers") or []).get(b"accept-encoding", b"").decode("latin-1"))
+    run.begin_request_timings()
+    client_ip = _client_ip(scope)
+    with run.timed("rate_limit"):
+        allowed = run._ip_allow(client_ip)
+    if not allowed:
+        run.count_rejection("rate_limit")
+        await _send_json(send, 429, {"error": "Rate limit exceeded"})
+        return
+    if _inflight >= ASYNC_MAX_INFLIGHT:
+        run.count_rejection("server_overloaded")
+        await _send_json(send, 429, {"error": "System busy", "reason": "server_overloaded"})
+        return
+
+    _inflight += 1
+    try:
+        body = await _read_body(receive)
+        if body is None:
+            await _send_json(send, 413, {"error": "Payload too large"})
+            return
+        try:
+            data = json.loads(body) if body else {}
+        except ValueError:
+            data = {}
+        if not isinstance(data, dict):
+            data = {}
+        user_prompt = data.get("prompt")
+        if not isinstance(user_prompt, str) or not user_prompt.strip():
+            await _send_json(send, 400, {"error": "Entrada inválida: 'prompt' es requerido"})
+            return
+
+        client_session = run.client_session_id(data.get("session_id"))
+        session_id = client_session or str(uuid.uuid4())
+        stream = bool(data.get("stream"))
+        accept = dict(scope.get("headers") or []).get(b"accept", b"").decode("latin-1")
+        sse = "text/event-stream" in accept
+
+        # RAG, reglas y cachés fuera del event loop
+        query = await asyncio.to_thread(run.prepare_query, user_prompt, client_session)
+        if query["content"] is not None:
+            await asyncio.to_thread(run.remember_turn, query, query["content"])
+            payload = run.assistant_payload(query["content"], session_id, query["source"])
+            run.count_response(payload)
+            if stream:
+                await _stream_static(send, payload, sse)
+            else:
+                await _send_json(send, 200, payload)
+            return
+
+        # Coalescencia: si una consulta idéntica ya está generando, se espera su salida
+        try:
+            with run.timed("coalesce"):
+                flight, shared = await lead_or_follow_async(query)
+        except run.AdmissionRejected as rejected:
+            await _send_busy(send, rejected)
+            return
+        if shared is not None:
+            payload, status = await asyncio.to_thread(
+                run.finish_generation, query, shared.result, session_id, coalesced=True,
+                timed_out=shared.deadline_exceeded,
+            )
+            if stream:
+                await _stream_static(send, payload, sse, status)
+            else:
+                await _send_json(send, status, payload)
+            return
+
+        try:
+            with run.timed("gpu_queue"):
+                gpu_lease = await acquire_gpu_async(client_ip, receive)
+        except run.AdmissionRejected as rejected:
+            run.abort_flight(flight, rejected)
+            await _send_busy(send, rejected)
+            return
+        try:
+            if stream:
+                await _stream_generation(send, query, session_id, sse, flight)
+                return
+            meta: Dict[str, Any] = {}
+            with run.timed("ollama"):
+                response_text = await call_ollama_async(
+                    query["messages"], timeout=run.generation_deadline(query), meta=meta, options=query["options"]
+                )
+            run.inflight_generations.complete(flight, response_text, bool(meta.get("deadline_exceeded")))
+            run.record_generation(query, meta)
+        except Exception as e:
+            run.inflight_generations.fail(flight, e)
+            raise
+        finally:
+            run._release_gpu(gpu_lease)
+            # Sin salida completa (p. ej. cancelación): los seguidores vuelven a competir
+            run.inflight_generations.abandon(flight)
+
+        payload, status = await asyncio.to_thread(
+            run.finish_generation, query, response_text, session_id, timed_out=bool(meta.get("deadline_exceeded"))
+        )
+        await _send_json(send, status, payload)
+    except Exception as e:
+        run.app.logger.exception("Error general en /generate (ASGI): %s", e)
+        await _send_json(send, 500, {"error": str(e)})
+    finally:
+        _inflight -= 1
+        if run.METRICS_ENABLED:
+            run.metrics.observe("asistente_request_seconds", time.perf_counter() - started, route="/generate")
+        if run._startup["first_request"] is None:
+            run.record_first_request("/generate", time.perf_counter() - started, run._request_timings.get())
+
+
+async def _lifespan(receive, send):
+    global _client
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await asyncio.to_thread(run.warm_start)
+            _get_client()
+            run.ollama_router.start()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if _client is not None:
+                await _client.aclose()
+                _client = None
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] == "http" and scope["path"] == "/generate" and scope["method"] == "POST":
+        await generate(scope, receive, send)
+        return
+    await _flask_app(scope, receive, send)
@@ -0,0 +1,118 @@
+"""Clasifica un backlog de tickets (JSONL o CSV) por el mismo camino que /generate.
+
+    OLLAMA_ENDPOINT=http://127.0.0.1:11434 python batch_classify.py --workers 2 tickets.csv clasificados.jsonl
+
+Cada ticket pasa por la detección de municipio, las reglas, las cachés, Ollama y el parseo del
+JSON; el resultado (con el id del ticket) se agrega a la salida JSONL apenas termina. La salida
+es también el checkpoint: si el proceso se corta, el mismo comando retoma con los tickets que
+faltan. Los que terminaron con "error" o "cancelled" se vuelven a intentar.
+
+El CLI es un proceso aparte: no ve la cola de GPU del servidor y no le cede el turno al chat.
+Con STATE_BACKEND=sqlite y la misma STATE_DB_PATH comparte con él el tope de
+MAX_CONCURRENT_GPU; aun así conviene pocos --workers (1 por defecto) si el servidor atiende
+consultas, o /generate_batch para lotes chicos, que sí espera a que el chat no tenga cola.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import run
+
+# -----------------------------------------------------------------------------
+# CONFIGURACIÓN DEL LOTE
+# -----------------------------------------------------------------------------
+# Cada cuántos resultados se fuerza la escritura a disco (fsync) y se informa el avance
+CHECKPOINT_EVERY = int(os.getenv("BATCH_CHECKPOINT_EVERY", "100"))
+# Resultados que no cuentan como hechos al retomar
+RETRY_STATUSES = ("error", "cancelled")
+
+# -----------------------------------------------------------------------------
+
+
+def load_checkpoint(path):
+    """Ids ya clasificados en la salida; la reescribe sin los resultados a reintentar.
+
+    Una última línea cortada (el proceso murió escribiéndola) también se descarta.
+    """
+    if not os.path.exists(path):
+        return set()
+    done, kept = set(), []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if not isinstance(record, dict) or "id" not in record or record.get("status") in RETRY_STATUSES:
+                continue
+            done.add(record["id"])
+            kept.append(line if line.endswith("\n") else line + "\n")
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.writelines(kept)
+    os.replace(tmp, path)
+    return done
+
+
+def pending_items(path, fmt, done):
+    """Tickets del archivo de entrada que todavía no están en la salida."""
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        for item_id, text in run.iter_batch_items(f, fmt):
+            if item_id not in done:
+                yield item_id, text
+
+
+def classify(input_path, output_path, fmt, workers):
+    done = load_checkpoint(output_path)
+    if done:
+        print(f"Retomando: {len(done)} tickets ya clasificados en {output_path}", file=sys.stderr)
+    counts = {}
+    started = time.perf_counter()
+    n = 0
+    with open(output_path, "a", encoding="utf-8") as out:
+        try:
+            for record in run.run_batch(pending_items(input_path, fmt, done), workers):
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                out.flush()
+                n += 1
+                counts[record["status"]] = counts.get(record["status"], 0) + 1
+                if n % CHECKPOINT_EVERY == 0:
+                    os.fsync(out.fileno())
+                    elapsed = time.perf_counter() - started
+                    print(f"{n} tickets, {n / elapsed:.1f}/s, {counts}", file=sys.stderr)
+        finally:
+            out.flush()
+            os.fsync(out.fileno())
+    elapsed = time.perf_counter() - started
+    print(f"Listo: {n} tickets en {elapsed:.1f} s ({counts}); salida en {output_path}", file=sys.stderr)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Clasificación por lotes de tickets (JSONL o CSV).")
+    parser.add_argument("input", help="archivo de tickets: JSONL (un objeto por línea) o CSV con encabezado")
+    parser.add_argument("output", help="salida JSONL; si ya existe, se retoma desde donde quedó")
+    parser.add_argument("--format", choices=("jsonl", "csv"), help="formato de entrada (por defecto, según la extensión)")
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="tickets en paralelo (por defecto 1: el CLI no ve la cola del chat del servidor)",
+    )
+    args = parser.parse_args()
+
+    run.ollama_router.start()
+    fmt = args.format or run.batch_format(args.input, "")
+    try:
+        counts = classify(args.input, args.output, fmt, args.workers)
+    except KeyboardInterrupt:
+        print("Interrumpido: volvé a correr el mismo comando para retomar.", file=sys.stderr)
+        return 130
+    except run.BatchInputError as e:
+        print(f"Archivo inválido: {e}", file=sys.stderr)
+        return 2
+    return 1 if counts.get("error") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
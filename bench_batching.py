@@ -0,0 +1,134 @@
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# -----------------------------------------------------------------------------
+# CONFIGURACIÓN DEL BENCHMARK
+# -----------------------------------------------------------------------------
+
+CONCURRENCY = int(os.getenv("BENCH_CONCURRENCY", "16"))
+DURATION_S = float(os.getenv("BENCH_DURATION", "10"))
+STUB_PORT = int(os.getenv("STUB_PORT", "18436"))
+# El stub imita a Ollama: latencia de evaluación del prompt, ms por token y slots paralelos
+STUB_LATENCY_MS = float(os.getenv("STUB_LATENCY_MS", "30"))
+STUB_TOKEN_MS = float(os.getenv("STUB_TOKEN_MS", "2"))
+STUB_PARALLEL = int(os.getenv("STUB_PARALLEL", "4"))
+
+os.environ.setdefault("OLLAMA_ENDPOINT", f"http://127.0.0.1:{STUB_PORT}")
+os.environ.setdefault("OLLAMA_NUM_PARALLEL", str(STUB_PARALLEL))
+os.environ.setdefault("MAX_CONCURRENT_GPU", str(STUB_PARALLEL))
+# Se mide el camino completo de /generate (admisión a la GPU incluida) sin lo que lo evita:
+# reglas, caché y límite por IP
+os.environ.setdefault("RULES_ENABLED", "false")
+os.environ.setdefault("RESPONSE_CACHE_SIZE", "0")
+os.environ.setdefault("RATE_LIMIT_RPM", "1000000")
+os.environ.setdefault("RATE_LIMIT_BURST", "1000000")
+os.environ.setdefault("GPU_QUEUE_MAX", str(max(64, CONCURRENCY)))
+os.environ.setdefault("OLLAMA_WARMUP_ENABLED", "false")
+
+import run  # noqa: E402  (después de apuntar OLLAMA_ENDPOINT al stub)
+import stub_ollama  # noqa: E402
+
+PROMPT = "quiero escriturar mi casa en la plata"
+
+# -----------------------------------------------------------------------------
+
+
+def wait_for_port(port, timeout=30.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def run_load(concurrency, duration):
+    """Hilos que hacen POST /generate en bucle durante 'duration' segundos; devuelve latencias y errores.
+
+    Cada consulta es distinta (no se coalescen) y pasa por la admisión a la GPU como en producción.
+    """
+    deadline = time.time() + duration
+
+    def client(worker_id):
+        app_client = run.app.test_client()
+        latencies, errors, i = [], 0, worker_id
+        while time.time() < deadline:
+            start = time.perf_counter()
+            resp = app_client.post("/generate", json={"prompt": f"{PROMPT} #{i}"})
+            i += concurrency
+            if resp.status_code == 200 and resp.get_json().get("type") != "error_fallback":
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors += 1
+        return latencies, errors
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(client, range(concurrency)))
+    latencies = sorted(l for lats, _ in results for l in lats)
+    return latencies, sum(e for _, e in results)
+
+
+def summarize(name, latencies, errors, tokens_per_response):
+    return {
+        "mode": name,
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": len(latencies) / DURATION_S,
+        "tokens_per_s": len(latencies) * tokens_per_response / DURATION_S,
+        "p50_ms": statistics.median(latencies) * 1000 if latencies else 0.0,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000 if latencies else 0.0,
+    }
+
+
+def run_benchmark():
+    # El stub corre en su propio proceso para no competir por el GIL con los clientes
+    stub = subprocess.Popen(
+        [sys.executable, "stub_ollama.py"],
+        env=dict(
+            os.environ,
+            STUB_PORT=str(STUB_PORT),
+            STUB_LATENCY_MS=str(STUB_LATENCY_MS),
+            STUB_TOKEN_MS=str(STUB_TOKEN_MS),
+            STUB_PARALLEL=str(STUB_PARALLEL),
+        ),
+        stdout=subprocess.DEVNULL,
+    )
+    if not wait_for_port(STUB_PORT):
+        stub.terminate()
+        raise RuntimeError("El stub de Ollama no levantó a tiempo")
+
+    tokens = stub_ollama.response_tokens()
+    dispatcher = run.OllamaBatchDispatcher(
+        run.OLLAMA_BATCH_WINDOW_MS / 1000.0, run.OLLAMA_BATCH_MAX, run.OLLAMA_NUM_PARALLEL,
+        len(run.OLLAMA_ENDPOINTS), run.gpu_admission,
+    )
+    modes = [("una a una", None), ("micro-lotes", dispatcher)]
+    print(f"Concurrencia {CONCURRENCY}, {DURATION_S:.0f} s por corrida, stub con {STUB_LATENCY_MS:.0f} ms + "
+          f"{STUB_TOKEN_MS:g} ms/token x {tokens} tokens y {STUB_PARALLEL} slots, "
+          f"MAX_CONCURRENT_GPU={run.MAX_CONCURRENT_GPU}")
+    print(f"Ventana {run.OLLAMA_BATCH_WINDOW_MS:g} ms, lotes de hasta {run.OLLAMA_BATCH_MAX}")
+    print("-" * 35)
+    results = []
+    try:
+        for name, mode_dispatcher in modes:
+            run.ollama_dispatcher = mode_dispatcher
+            r = summarize(name, *run_load(CONCURRENCY, DURATION_S), tokens)
+            results.append(r)
+            print(f"{r['mode']:12s}: {r['tokens_per_s']:8.1f} tokens/s  {r['rps']:6.1f} req/s  "
+                  f"p50 {r['p50_ms']:7.1f} ms  p99 {r['p99_ms']:7.1f} ms  errores {r['errors']}")
+        print(f"Lotes: {dispatcher.stats()}")
+    finally:
+        stub.terminate()
+        stub.wait(timeout=10)
+    return results
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,163 @@
+import json
+import os
+import random
+import re
+import sys
+import time
+
+import run
+
+# -----------------------------------------------------------------------------
+# CONFIGURACIÓN DEL BENCHMARK
+# -----------------------------------------------------------------------------
+
+# Variantes con defectos a generar por cada salida válida
+N_MUTATIONS = int(os.getenv("BENCH_MUTATIONS", "200"))
+SEED = int(os.getenv("BENCH_SEED", "42"))
+# Repeticiones de cada salida al medir el tiempo de parseo
+REPEAT = int(os.getenv("BENCH_REPEAT", "20"))
+
+# Salidas válidas típicas de gemma2:2b con format json
+VALIDAS = [
+    {"Urgencia": "2", "Clasificacion": "ESCRITURACIÓN", "descripcion_corta": "Requisitos para escriturar en La Plata.",
+     "respuesta_extendida": "Para iniciar la escrituración necesitás el boleto de compra-venta, los DNI de los "
+                            "titulares y un comprobante de domicilio. Acercate a la oficina municipal del programa."},
+    {"Urgencia": 3, "Clasificacion": "BENEFICIOS", "descripcion_corta": "Gratuidad del trámite.",
+     "respuesta_extendida": "El programa \"Mi escritura, mi casa\" es gratuito para viviendas únicas de ocupación "
+                            "permanente. {Consultá} las condiciones en tu municipio."},
+    {"Urgencia": "1", "Clasificacion": "CONTACTO", "descripcion_corta": "Datos de la oficina.",
+     "respuesta_extendida": "Podés comunicarte por mail o acercarte de lunes a viernes de 8 a 14 hs."},
+]
+
+# Salidas defectuosas reales (recortadas) de gemma2:2b sin format json o con num_predict bajo
+MALFORMADAS = [
+    'Claro, aquí tenés la clasificación:\n```json\n{"Urgencia": "2", "Clasificacion": "ESCRITURACIÓN", '
+    '"descripcion_corta": "Inicio de escrituración.", "respuesta_extendida": "Necesitás el boleto y los DNI."}\n```',
+    '```json\n{\n  "Urgencia": "2",\n  "Clasificacion": "GESTIÓN",\n  "descripcion_corta": "Estado del trámite.",\n'
+    '  "respuesta_extendida": "Tu trámite sigue en curso.",\n}\n```\n**Nota:** la urgencia es orientativa.',
+    "{'Urgencia': '3', 'Clasificacion': 'BENEFICIOS', 'descripcion_corta': 'Trámite gratuito', "
+    "'respuesta_extendida': 'El programa no tiene costo para el beneficiario.'}",
+    '{"Urgencia": "2", "Clasificacion": "ESCRITURACIÓN", "descripcion_corta": "Requisitos de escrituración.", '
+    '"respuesta_extendida": "Para escriturar tu vivienda necesitás presentar el boleto de compra-venta, los DNI de',
+    '{"Urgencia": 4, "Clasificacion": "GESTIÓN", "descripcion_corta": "Reclamo por demora",\n'
+    '"respuesta_extendida": "Lamentamos la demora.\nTu expediente fue derivado a la Escribanía."}',
+    'La consulta corresponde a {ESCRITURACIÓN}. Respuesta:\n{"Urgencia": "2", "Clasificacion": "ESCRITURACIÓN", '
+    '"descripcion_corta": "Escriturar en Quilmes", "respuesta_extendida": "Acercate al municipio de Quilmes."}',
+    '{"Urgencia": "1", "Clasificacion": "INFORMACIÓN", "descripcion_corta": "Horarios", '
+    '"respuesta_extendida": "Atención de 8 a 14 hs", "pasos": ["Pedir turno", "Presentar DNI",]}',
+    '{"Urgencia": "5", "Clasificacion": "GESTIÓN", "descripcion_corta": "Caso urgente", '
+    '"respuesta_extendida": "Se prioriza tu caso", "requiere_turno": True}',
+    '{"Urgencia": "2", "Clasificacion": "ESCRITURACIÓN", "descripcion_corta": "Escrituración", "respuesta_ext',
+    '{"Urgencia": "3", "Clasificacion": "BENEFICIOS", "descripcion_corta": "Beneficios del programa", '
+    '"respuesta_extendida": "El programa cubre los honorarios \\(escribano\\) y los sellados."}',
+    'No puedo clasificar esta consulta sin más información.',
+]
+
+# -----------------------------------------------------------------------------
+
+
+def legacy_parse_model_response(raw_response):
+    """Implementación anterior: json.loads, regex DOTALL de bloque ```json y recorte '{'...'}'."""
+    parsed_json = None
+    try:
+        parsed_json = json.loads(raw_response)
+    except json.JSONDecodeError:
+        match = re.search(r"```json\s*(\{.*\})\s*```", raw_response, re.DOTALL)
+        if not match:
+            start = raw_response.find('{')
+            end = raw_response.rfind('}')
+            if start != -1 and end != -1 and end > start:
+                try:
+                    parsed_json = json.loads(raw_response[start:end + 1])
+                except json.JSONDecodeError:
+                    pass
+        else:
+            try:
+                parsed_json = json.loads(match.group(1))
+            except json.JSONDecodeError:
+                pass
+    if parsed_json and isinstance(parsed_json, dict) and "Clasificacion" in parsed_json:
+        return parsed_json
+    return None
+
+
+def mutate(text, rng):
+    """Aplica de 1 a 3 defectos típicos de salida de LLM a un JSON válido."""
+    for _ in range(rng.randint(1, 3)):
+        op = rng.randrange(6)
+        if op == 0:
+            # Cortado por num_predict o por el plazo
+            text = text[:rng.randrange(len(text) // 3, len(text))]
+        elif op == 1:
+            text = re.sub(r'("|\d)(\s*)\}', r'\1,\2}', text, count=1)
+        elif op == 2 and "'" not in text:
+            text = text.replace('\\"', "\u201d").replace('"', "'")
+        elif op == 3:
+            text = rng.choice(["Aquí está la respuesta:\n```json\n", "Respuesta: ", ""]) + text + \
+                rng.choice(["\n```", "\n\nEspero que te sirva {:)}", ""])
+        elif op == 4:
+            text = text.replace(". ", ".\n", 1)
+        else:
+            text = text.replace('"1"', "True", 1)
+    return text
+
+
+def build_corpus(n, seed):
+    rng = random.Random(seed)
+    corpus = list(MALFORMADAS)
+    for valid in VALIDAS:
+        text = json.dumps(valid, ensure_ascii=False)
+        corpus.append(text)
+        corpus.extend(mutate(text, rng) for _ in range(n))
+    return corpus
+
+
+def time_parser(fn, corpus, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for text in corpus:
+            fn(text)
+    return (time.perf_counter() - start) / (repeat * len(corpus))
+
+
+def run_benchmark():
+    corpus = build_corpus(N_MUTATIONS, SEED)
+    errors = 0
+    legacy_ok = new_ok = 0
+    for text in corpus:
+        if legacy_parse_model_response(text) is not None:
+            legacy_ok += 1
+        try:
+            if run.parse_model_response(text) is not None:
+                new_ok += 1
+        except Exception as e:
+            errors += 1
+            print(f"Excepción con {text[:60]!r}: {e}")
+    # Salidas que el parser anterior resolvía y el nuevo manda a error_fallback
+    regressions = sum(
+        1 for text in corpus
+        if legacy_parse_model_response(text) is not None and run.parse_model_response(text) is None
+    )
+
+    legacy_s = time_parser(legacy_parse_model_response, corpus, REPEAT)
+    new_s = time_parser(run.parse_model_response, corpus, REPEAT)
+    # Modelo que repite la apertura del bloque sin cerrarlo: la regex DOTALL retrocede en cada '```json'
+    runaway = "```json {" * 4000
+    legacy_big_s = time_parser(legacy_parse_model_response, [runaway], 1)
+    new_big_s = time_parser(run.parse_model_response, [runaway], 1)
+
+    print(f"Salidas: {len(corpus)} ({len(MALFORMADAS)} reales, el resto mutaciones de {len(VALIDAS)} válidas)")
+    print("-" * 35)
+    print(f"error_fallback anterior:  {1 - legacy_ok / len(corpus):8.1%}")
+    print(f"error_fallback nuevo:     {1 - new_ok / len(corpus):8.1%}")
+    print(f"Regresiones:              {regressions}")
+    print(f"Excepciones:              {errors}")
+    print(f"Parseo anterior:          {legacy_s * 1e6:8.1f} µs/salida")
+    print(f"Parseo nuevo:             {new_s * 1e6:8.1f} µs/salida")
+    print(f"Salida desbocada ({len(runaway)} chars): {legacy_big_s * 1e3:.1f} ms anterior, {new_big_s * 1e3:.1f} ms nuevo")
+    print("Reparaciones:", run.model_parse_stats.stats()["by_repair"])
+    return errors == 0 and regressions == 0
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run_benchmark() else 1)
@@ -0,0 +1,124 @@
+import os
+import random
+import threading
+import time
+
+import run
+
+# -----------------------------------------------------------------------------
+# CONFIGURACIÓN DEL BENCHMARK
+# -----------------------------------------------------------------------------
+
+# Tasa de referencia: costo del limitador como fracción de un núcleo a estas consultas por segundo
+TARGET_RPS = int(os.getenv("BENCH_RPS", "10000"))
+# Consultas por escenario
+N_OPS = int(os.getenv("BENCH_OPS", "200000"))
+# IPs de clientes legítimos y de la inundación con X-Forwarded-For falsificado
+N_CLIENTS = int(os.getenv("BENCH_CLIENTS", "500"))
+N_SPOOFED = int(os.getenv("BENCH_SPOOFED", "1000000"))
+THREADS = int(os.getenv("BENCH_THREADS", "8"))
+SEED = int(os.getenv("BENCH_SEED", "42"))
+
+RATE = run.RATE_LIMIT_RPM / 60.0
+BURST = float(run.RATE_LIMIT_BURST)
+
+# -----------------------------------------------------------------------------
+
+
+class LegacyBuckets:
+    """Implementación anterior: un dict con un solo lock que nunca se purga."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def take_token(self, key, rate_per_sec, burst):
+        now = time.time()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = {"tokens": float(burst), "last": now}
+                self._buckets[key] = bucket
+            elapsed = max(0.0, now - bucket["last"])
+            bucket["tokens"] = min(float(burst), bucket["tokens"] + elapsed * rate_per_sec)
+            bucket["last"] = now
+            if bucket["tokens"] >= 1.0:
+                bucket["tokens"] -= 1.0
+                return True
+            return False
+
+    def n_keys(self):
+        return len(self._buckets)
+
+
+def n_keys(store):
+    if isinstance(store, LegacyBuckets):
+        return store.n_keys()
+    return store.stats()["rate_limit_keys"]
+
+
+def random_ip(rng):
+    return "%d.%d.%d.%d" % (rng.randrange(1, 255), rng.randrange(256), rng.randrange(256), rng.randrange(1, 255))
+
+
+def time_ops(store, keys):
+    take = store.take_token
+    start = time.perf_counter()
+    for key in keys:
+        take(key, RATE, BURST)
+    return (time.perf_counter() - start) / len(keys)
+
+
+def time_threads(store, keys, n_threads):
+    chunks = [keys[i::n_threads] for i in range(n_threads)]
+    threads = [threading.Thread(target=time_ops, args=(store, chunk)) for chunk in chunks]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return len(keys) / (time.perf_counter() - start)
+
+
+def report(name, legacy_s, new_s, legacy_keys, new_keys):
+    print(f"{name}")
+    print(f"  anterior: {legacy_s * 1e6:6.2f} µs/consulta ({legacy_s * TARGET_RPS:6.2%} de un núcleo a "
+          f"{TARGET_RPS} RPS), {legacy_keys} IPs en memoria")
+    print(f"  nuevo:    {new_s * 1e6:6.2f} µs/consulta ({new_s * TARGET_RPS:6.2%} de un núcleo a "
+          f"{TARGET_RPS} RPS), {new_keys} IPs en memoria")
+
+
+def run_benchmark():
+    rng = random.Random(SEED)
+    clients = [random_ip(rng) for _ in range(N_CLIENTS)]
+    normal = ["ip:" + rng.choice(clients) for _ in range(N_OPS)]
+    spoofed = ["ip:" + random_ip(rng) for _ in range(N_SPOOFED)]
+
+    print(f"Límite: {run.RATE_LIMIT_RPM} RPM, ráfaga {run.RATE_LIMIT_BURST}; tope {run.RATE_LIMIT_MAX_KEYS} IPs, "
+          f"{run.RATE_LIMIT_SHARDS} particiones")
+    print("-" * 35)
+
+    legacy, new = LegacyBuckets(), run.InProcessStateStore(run.RATE_LIMIT_SHARDS, run.RATE_LIMIT_MAX_KEYS)
+    report(f"Tráfico normal ({N_CLIENTS} clientes):",
+           time_ops(legacy, normal), time_ops(new, normal), n_keys(legacy), n_keys(new))
+
+    legacy, new = LegacyBuckets(), run.InProcessStateStore(run.RATE_LIMIT_SHARDS, run.RATE_LIMIT_MAX_KEYS)
+    report(f"X-Forwarded-For falsificado ({N_SPOOFED} IPs distintas):",
+           time_ops(legacy, spoofed), time_ops(new, spoofed), n_keys(legacy), n_keys(new))
+
+    legacy, new = LegacyBuckets(), run.InProcessStateStore(run.RATE_LIMIT_SHARDS, run.RATE_LIMIT_MAX_KEYS)
+    legacy_tput = time_threads(legacy, normal, THREADS)
+    new_tput = time_threads(new, normal, THREADS)
+    print(f"{THREADS} hilos: {legacy_tput:,.0f} consultas/s anterior, {new_tput:,.0f} consultas/s nuevo")
+
+    whitelist = {"10.0.0.0/8", "192.168.0.0/16", "172.16.0.0/12", "203.0.113.7"}
+    run._whitelist_exact, run._whitelist_networks = run.parse_whitelist(whitelist)
+    ips = [key[3:] for key in normal[:50000]]
+    start = time.perf_counter()
+    for ip in ips:
+        run._ip_whitelisted(ip)
+    print(f"Whitelist con {len(whitelist)} entradas CIDR: {(time.perf_counter() - start) / len(ips) * 1e6:.2f} µs/consulta")
+
+
+if __name__ == "__main__":
+    run_benchmark()
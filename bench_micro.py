@@ -0,0 +1,169 @@
+"""Microbenchmarks del camino de /generate que no depende del modelo: normalización, RAG y parseo del JSON.
+
+    BENCH_OUTPUT=bench_results.json BENCH_BASELINE=bench_baseline.json python bench_micro.py
+
+Cada caso corre varias rondas calibradas (como pytest-benchmark) y los resultados quedan en
+BENCH_OUTPUT; con BENCH_BASELINE, sale con código 1 si algún caso empeora más de BENCH_TOLERANCE.
+"""
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+
+import run
+from bench_json import MALFORMADAS, VALIDAS
+from bench_rag import PLANTILLAS, add_typo
+
+# -----------------------------------------------------------------------------
+# CONFIGURACIÓN DEL BENCHMARK
+# -----------------------------------------------------------------------------
+
+# Rondas por caso y tiempo mínimo de cada ronda (las iteraciones por ronda se calibran)
+ROUNDS = int(os.getenv("BENCH_ROUNDS", "15"))
+MIN_ROUND_S = float(os.getenv("BENCH_MIN_ROUND_S", "0.05"))
+SEED = int(os.getenv("BENCH_SEED", "42"))
+# Resultados de esta corrida y, si existe, corrida de referencia contra la que se compara
+BENCH_OUTPUT = os.getenv("BENCH_OUTPUT", "bench_results.json")
+BENCH_BASELINE = os.getenv("BENCH_BASELINE", "")
+# Regresión: mediana más de BENCH_TOLERANCE veces la de referencia
+BENCH_TOLERANCE = float(os.getenv("BENCH_TOLERANCE", "1.25"))
+
+# Consultas que las reglas no deben responder (tienen matices que resuelve el modelo)
+# y consultas que sí, con la clasificación esperada
+REGLAS_NO = [
+    "es gratis escriturar?",
+    "Cuánto tarda escriturar mi casa",
+    "quiero escriturar pero el vendedor falleció",
+    "me quieren cobrar por escriturar, es legal?",
+    "escriturar",
+]
+REGLAS_SI = {
+    "que requisitos necesito?": "ESCRITURACIÓN",
+    "qué papeles tengo que llevar para escriturar": "ESCRITURACIÓN",
+}
+
+# -----------------------------------------------------------------------------
+
+
+def check_rules():
+    """Regresiones del tier de reglas: consultas respondidas (o no) sin pasar por el modelo."""
+    errors = []
+    for prompt in REGLAS_NO:
+        content = run.apply_fast_path_rules(prompt, None)
+        if content is not None:
+            errors.append(f"reglas respondieron {prompt!r} con {content['Clasificacion']}")
+    for prompt, expected in REGLAS_SI.items():
+        content = run.apply_fast_path_rules(prompt, None)
+        if content is None or content["Clasificacion"] != expected:
+            errors.append(f"reglas no respondieron {prompt!r} con {expected}")
+    return errors
+
+
+def build_cases(seed):
+    """Entradas de cada caso: nombres con y sin errores de tipeo, consultas típicas y salidas del modelo."""
+    rng = random.Random(seed)
+    names = sorted(run.get_gazetteer().fuzzy_names)
+    exact = [rng.choice(PLANTILLAS).format(rng.choice(names)) for _ in range(200)]
+    typos = [add_typo(rng.choice(names), rng) for _ in range(200)]
+    sin_municipio = ["hola", "¿cuánto cuesta escriturar?", "quiero saber cómo sigue mi trámite de escritura"]
+    outputs = [json.dumps(v, ensure_ascii=False) for v in VALIDAS]
+    return {
+        "normalize_text": (run.normalize_text, exact),
+        "find_municipio_in_text": (run.find_municipio_in_text, exact + sin_municipio),
+        "search_municipio/exacto": (run.search_municipio, names[:200]),
+        "search_municipio/typo": (run.search_municipio, typos),
+        "parse_model_response/valida": (run.parse_model_response, outputs),
+        "parse_model_response/malformada": (run.parse_model_response, MALFORMADAS),
+    }
+
+
+def calibrate(fn, inputs):
+    """Pasadas completas sobre inputs necesarias para que una ronda dure al menos MIN_ROUND_S."""
+    passes = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(passes):
+            for x in inputs:
+                fn(x)
+        if time.perf_counter() - start >= MIN_ROUND_S or passes >= 1 << 16:
+            return passes
+        passes *= 2
+
+
+def bench(fn, inputs):
+    """Como pytest-benchmark: varias rondas, estadísticas del tiempo por llamada."""
+    for x in inputs:
+        fn(x)
+    passes = calibrate(fn, inputs)
+    per_call = []
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        for _ in range(passes):
+            for x in inputs:
+                fn(x)
+        per_call.append((time.perf_counter() - start) / (passes * len(inputs)))
+    median = statistics.median(per_call)
+    return {
+        "rounds": ROUNDS,
+        "calls_per_round": passes * len(inputs),
+        "min_us": min(per_call) * 1e6,
+        "median_us": median * 1e6,
+        "mean_us": statistics.mean(per_call) * 1e6,
+        "stddev_us": statistics.stdev(per_call) * 1e6 if len(per_call) > 1 else 0.0,
+        "ops": 1.0 / median,
+    }
+
+
+def compare(results, baseline_path):
+    """Casos cuya mediana empeoró más de BENCH_TOLERANCE respecto de la referencia."""
+    try:
+        with open(baseline_path, encoding="utf-8") as f:
+            baseline = json.load(f)["benchmarks"]
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Sin referencia válida en {baseline_path}: {e}")
+        return []
+    regressions = []
+    for name, stats in results.items():
+        ref = baseline.get(name)
+        if not ref:
+            continue
+        ratio = stats["median_us"] / ref["median_us"]
+        stats["vs_baseline"] = round(ratio, 3)
+        if ratio > BENCH_TOLERANCE:
+            regressions.append(f"{name}: {ratio:.2f}x ({ref['median_us']:.1f} -> {stats['median_us']:.1f} µs)")
+    return regressions
+
+
+def run_benchmark():
+    results = {}
+    print(f"{'Caso':34} {'mediana':>12} {'mín':>12} {'desvío':>10} {'ops/s':>12}")
+    print("-" * 84)
+    for name, (fn, inputs) in build_cases(SEED).items():
+        stats = bench(fn, inputs)
+        results[name] = stats
+        print(f"{name:34} {stats['median_us']:9.2f} µs {stats['min_us']:9.2f} µs "
+              f"{stats['stddev_us']:7.2f} µs {stats['ops']:12,.0f}")
+
+    regressions = compare(results, BENCH_BASELINE) if BENCH_BASELINE else []
+    if run.RULES_ENABLED:
+        regressions.extend(check_rules())
+    output = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "benchmarks": results,
+        "baseline": BENCH_BASELINE or None,
+        "regressions": regressions,
+    }
+    with open(BENCH_OUTPUT, "w", encoding="utf-8") as f:
+        json.dump(output, f, ensure_ascii=False, indent=2)
+    print(f"Resultados en {BENCH_OUTPUT}")
+    for r in regressions:
+        print(f"Regresión: {r}")
+    return not regressions
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run_benchmark() else 1)
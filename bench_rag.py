@@ -0,0 +1,125 @@
+import difflib
+import os
+import random
+import sqlite3
+import time
+
+import run
+
+# -----------------------------------------------------------------------------
+# CONFIGURACIÓN DEL BENCHMARK
+# -----------------------------------------------------------------------------
+
+# Cantidad de consultas con errores de tipeo a generar
+N_PROMPTS = int(os.getenv("BENCH_PROMPTS", "300"))
+SEED = int(os.getenv("BENCH_SEED", "42"))
+
+PLANTILLAS = [
+    "{}",
+    "quiero escriturar en {}",
+    "donde queda la oficina de {}",
+    "vivo en {} y necesito los requisitos",
+    "horario de atencion en el partido de {}",
+]
+
+# -----------------------------------------------------------------------------
+
+
+def legacy_search_municipio(municipio_name):
+    """Implementación anterior: recorre toda la tabla con difflib en cada consulta."""
+    q = run.normalize_text(municipio_name)
+    if not q:
+        return None
+    conn = sqlite3.connect(run.DB_NAME)
+    cur = conn.cursor()
+    cur.execute("SELECT * FROM municipios")
+    rows = cur.fetchall()
+    cols = [d[0] for d in cur.description]
+    search_idx = {col: i for i, col in enumerate(cols) if col in run.SEARCH_COLS}
+    best_sim = 0.0
+    best_row = None
+    for r in rows:
+        current_best_sim = 0.0
+        for col_name, idx in search_idx.items():
+            val = str(r[idx]) if r[idx] is not None else ""
+            localidades = [l.strip() for l in val.split(',') if l.strip()] if col_name == "LOCALIDADES" else [val]
+            for cand_val in localidades:
+                cand_val_norm = run.normalize_text(cand_val)
+                if not cand_val_norm or len(cand_val_norm) < 3:
+                    continue
+                sim = difflib.SequenceMatcher(None, q, cand_val_norm).ratio()
+                if sim > current_best_sim:
+                    current_best_sim = sim
+        if current_best_sim > best_sim:
+            best_sim = current_best_sim
+            best_row = r
+    conn.close()
+    if best_row is not None and best_sim >= run.SIMILARITY_THRESHOLD:
+        return {cols[i]: (str(best_row[i]) if best_row[i] is not None else "") for i in range(len(cols))}
+    return None
+
+
+def add_typo(text, rng):
+    """Borra, inserta o reemplaza un carácter al azar."""
+    chars = list(text)
+    if len(chars) < 4:
+        return text
+    i = rng.randrange(len(chars))
+    op = rng.random()
+    if op < 0.33:
+        del chars[i]
+    elif op < 0.66:
+        chars.insert(i, rng.choice("aeiourstnl"))
+    else:
+        chars[i] = rng.choice("aeiourstnl")
+    return "".join(chars)
+
+
+def build_prompts(n, seed):
+    rng = random.Random(seed)
+    names = list(run.get_gazetteer().fuzzy_names)
+    prompts = []
+    for _ in range(n):
+        name = rng.choice(names)
+        for _ in range(rng.randint(1, 2)):
+            name = add_typo(name, rng)
+        prompts.append(rng.choice(PLANTILLAS).format(name))
+    return prompts
+
+
+def time_calls(fn, prompts):
+    start = time.perf_counter()
+    results = [fn(p) for p in prompts]
+    return time.perf_counter() - start, results
+
+
+def run_benchmark():
+    prompts = build_prompts(N_PROMPTS, SEED)
+    # Candidatos que extract_and_search_municipio consulta por cada prompt
+    queries = []
+    for p in prompts:
+        text_norm = run.normalize_text(p)
+        words = text_norm.split()
+        queries.append(p)
+        queries.extend(" ".join(words[-n:]) for n in range(3, 0, -1) if len(words) >= n)
+
+    print(f"Consultas difusas: {len(queries)} (de {len(prompts)} prompts con errores de tipeo)")
+    print("-" * 35)
+
+    legacy_s, legacy_res = time_calls(legacy_search_municipio, queries)
+    new_s, new_res = time_calls(run.search_municipio, queries)
+
+    key = lambda r: r and r.get("NRO")
+    mismatches = sum(1 for a, b in zip(legacy_res, new_res) if key(a) != key(b))
+    hits = sum(1 for r in new_res if r)
+
+    print(f"Implementación anterior: {legacy_s * 1000 / len(queries):8.3f} ms/consulta")
+    print(f"Índice de trigramas:     {new_s * 1000 / len(queries):8.3f} ms/consulta")
+    print(f"Aceleración:             {legacy_s / new_s:8.1f}x")
+    print(f"Coincidencias:           {hits}/{len(queries)}")
+    print(f"Resultados distintos:    {mismatches}")
+    return mismatches == 0
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,103 @@
+"""Tiempo de arranque: importación de run.py, warm_start y primera consulta, en procesos nuevos.
+
+    STARTUP_RUNS=5 STARTUP_MAX_MS=400 python bench_startup.py
+
+Cada escenario corre STARTUP_RUNS veces en un intérprete nuevo (como un reinicio del contenedor
+o un worker nuevo) y muestra la mediana de cada etapa del informe de arranque de run.py. La
+primera consulta la responden las reglas, así no depende de Ollama. Con STARTUP_MAX_MS sale con
+código 1 si la primera respuesta con snapshot llega más tarde que eso desde que arrancó el proceso.
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# -----------------------------------------------------------------------------
+# CONFIGURACIÓN DEL BENCHMARK
+# -----------------------------------------------------------------------------
+STARTUP_RUNS = int(os.getenv("STARTUP_RUNS", "5"))
+# Umbral para el escenario con snapshot (0 = no se controla)
+STARTUP_MAX_MS = float(os.getenv("STARTUP_MAX_MS", "0"))
+PROMPT = "que requisitos necesito para escriturar en Quilmes?"
+
+CHILD = """
+import json, os, sys, time
+import run
+if os.environ["BENCH_WARM"] == "1":
+    run.warm_start()
+resp = run.app.test_client().post("/generate", json={"prompt": %r})
+assert resp.status_code == 200, resp.status_code
+print(json.dumps({**run.startup_report(), "numpy": "numpy" in sys.modules}))
+""" % PROMPT
+
+# -----------------------------------------------------------------------------
+
+
+def run_child(env):
+    started = time.perf_counter()
+    out = subprocess.run(
+        [sys.executable, "-c", CHILD], env=env, capture_output=True, text=True, check=True
+    ).stdout
+    report = json.loads(out.strip().splitlines()[-1])
+    report["process_ms"] = (time.perf_counter() - started) * 1000
+    return report
+
+
+def scenario(name, snapshot_path, warm, keep_snapshot):
+    env = {
+        **os.environ,
+        "GAZETTEER_SNAPSHOT_PATH": snapshot_path,
+        "BENCH_WARM": "1" if warm else "0",
+        "OLLAMA_WARMUP_ENABLED": "false",
+        "RESPONSE_CACHE_SIZE": "0",
+    }
+    samples = []
+    for _ in range(STARTUP_RUNS):
+        if not keep_snapshot and snapshot_path and os.path.exists(snapshot_path):
+            os.remove(snapshot_path)
+        samples.append(run_child(env))
+
+    def med(get):
+        values = [get(s) for s in samples if get(s) is not None]
+        return statistics.median(values) if values else 0.0
+
+    row = {
+        "imports_ms": med(lambda s: s["imports_ms"]),
+        "module_ms": med(lambda s: s["module_ms"]),
+        "warm_start_ms": med(lambda s: s["warm_start_ms"]),
+        "first_request_ms": med(lambda s: s["first_request"]["duration_ms"]),
+        "ready_ms": med(lambda s: s["first_request"]["since_import_ms"]),
+        "process_ms": med(lambda s: s["process_ms"]),
+        "rag_source": samples[-1]["warm_start"]["rag_source"] if warm else "primer uso",
+        "numpy": any(s["numpy"] for s in samples),
+    }
+    print(f"{name:28} {row['imports_ms']:8.0f} {row['module_ms']:7.0f} {row['warm_start_ms']:7.0f} "
+          f"{row['first_request_ms']:9.0f} {row['ready_ms']:8.0f} {row['process_ms']:8.0f}   {row['rag_source']}")
+    return row
+
+
+def run_benchmark():
+    print(f"Mediana de {STARTUP_RUNS} procesos (ms)")
+    print(f"{'Escenario':28} {'imports':>8} {'módulo':>7} {'warm':>7} {'1ª cons.':>9} {'lista':>8} {'proceso':>8}")
+    print("-" * 90)
+    with tempfile.TemporaryDirectory() as tmp:
+        snapshot = os.path.join(tmp, "municipios.snapshot.pkl")
+        results = {
+            "sin_snapshot": scenario("warm_start sin snapshot", snapshot, True, keep_snapshot=False),
+            "con_snapshot": scenario("warm_start con snapshot", snapshot, True, keep_snapshot=True),
+            "carga_diferida": scenario("sin warm_start (primer uso)", snapshot, False, keep_snapshot=True),
+        }
+    if any(r["numpy"] for r in results.values()):
+        print("Aviso: numpy se importó sin la caché semántica habilitada")
+    ready = results["con_snapshot"]["ready_ms"]
+    if STARTUP_MAX_MS and ready > STARTUP_MAX_MS:
+        print(f"Regresión: primera respuesta a los {ready:.0f} ms > {STARTUP_MAX_MS:.0f} ms")
+        return False
+    return True
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run_benchmark() else 1)
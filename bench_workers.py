@@ -0,0 +1,137 @@
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# -----------------------------------------------------------------------------
+# CONFIGURACIÓN DEL BENCHMARK
+# -----------------------------------------------------------------------------
+
+# Cantidades de workers a comparar (ej: "1,4")
+WORKER_COUNTS = [int(n) for n in os.getenv("BENCH_WORKERS", f"1,{os.cpu_count() or 2}").split(",")]
+CONCURRENCY = int(os.getenv("BENCH_CONCURRENCY", "32"))
+DURATION_S = float(os.getenv("BENCH_DURATION", "10"))
+STUB_LATENCY_MS = float(os.getenv("STUB_LATENCY_MS", "20"))
+PORT = int(os.getenv("BENCH_PORT", "18001"))
+STUB_PORT = int(os.getenv("STUB_PORT", "18435"))
+
+# Consultas con errores de tipeo: fuerzan la búsqueda difusa del RAG en cada petición
+PROMPTS = [
+    "necesito escriturar mi casa en la plta",
+    "donde queda la oficina de bahia blnca",
+    "vivo en san antono de areco, que tengo que hacer",
+    "es gratis el tramite en lomas de zamora?",
+    "quiero saber como escriturar en mar del plat",
+]
+
+# -----------------------------------------------------------------------------
+
+
+def wait_for_port(port, timeout=30.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def run_load(url, concurrency, duration):
+    """Clientes concurrentes en bucle durante 'duration' segundos; devuelve latencias y errores."""
+    deadline = time.time() + duration
+
+    def client(worker_id):
+        session = requests.Session()
+        latencies, errors, i = [], 0, worker_id
+        while time.time() < deadline:
+            prompt = PROMPTS[i % len(PROMPTS)] + f" #{i}"
+            i += concurrency
+            start = time.perf_counter()
+            try:
+                resp = session.post(url, json={"prompt": prompt}, timeout=60)
+                ok = resp.status_code == 200
+            except requests.RequestException:
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors += 1
+        return latencies, errors
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(client, range(concurrency)))
+    latencies = [l for lats, _ in results for l in lats]
+    errors = sum(e for _, e in results)
+    return latencies, errors
+
+
+def bench_workers(workers, stub_port):
+    env = dict(
+        os.environ,
+        WORKERS=str(workers),
+        FLASK_PORT=str(PORT),
+        OLLAMA_ENDPOINT=f"http://127.0.0.1:{stub_port}",
+        STATE_DB_PATH=f"/tmp/bench-state-{os.getpid()}-{workers}.db",
+        RATE_LIMIT_BURST="1000000",
+        RATE_LIMIT_RPM="100000000",
+        MAX_CONCURRENT_GPU="1000",
+        RULES_ENABLED="false",
+        RESPONSE_CACHE_SIZE="0",
+    )
+    proc = subprocess.Popen(
+        [sys.executable, "serve.py"], env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        if not wait_for_port(PORT):
+            raise RuntimeError("El servidor no levantó a tiempo")
+        time.sleep(1.0)
+        latencies, errors = run_load(f"http://127.0.0.1:{PORT}/generate", CONCURRENCY, DURATION_S)
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+    latencies.sort()
+    return {
+        "workers": workers,
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": len(latencies) / DURATION_S,
+        "p50_ms": statistics.median(latencies) * 1000 if latencies else 0.0,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000 if latencies else 0.0,
+    }
+
+
+def run_benchmark():
+    # El stub corre en su propio proceso para no competir por el GIL con los clientes
+    stub = subprocess.Popen(
+        [sys.executable, "stub_ollama.py"],
+        env=dict(os.environ, STUB_PORT=str(STUB_PORT), STUB_LATENCY_MS=str(STUB_LATENCY_MS)),
+        stdout=subprocess.DEVNULL,
+    )
+    if not wait_for_port(STUB_PORT):
+        stub.terminate()
+        raise RuntimeError("El stub de Ollama no levantó a tiempo")
+    print(f"Concurrencia {CONCURRENCY}, {DURATION_S:.0f} s por corrida, stub con {STUB_LATENCY_MS:.0f} ms de latencia")
+    print("-" * 35)
+    results = []
+    try:
+        for workers in WORKER_COUNTS:
+            r = bench_workers(workers, STUB_PORT)
+            results.append(r)
+            print(f"{r['workers']:2d} worker(s): {r['rps']:8.1f} req/s  p50 {r['p50_ms']:7.1f} ms  "
+                  f"p99 {r['p99_ms']:7.1f} ms  errores {r['errors']}")
+    finally:
+        stub.terminate()
+        stub.wait(timeout=10)
+    return results
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,194 @@
+"""Escenarios de carga de /generate para locust.
+
+    STUB_LATENCY_MS=300 STUB_TOKEN_MS=25 STUB_MALFORMED_RATE=0.05 python stub_ollama.py
+    OLLAMA_ENDPOINT=http://127.0.0.1:11435 TRUST_PROXY=1 python run.py
+    locust -f locustfile.py --headless -u 50 -r 10 -t 2m --host http://127.0.0.1:8001
+
+Cada usuario simula un vecino: una primera consulta con el nombre de su municipio (a veces
+con errores de tipeo), repreguntas cortas en la misma sesión y, de vez en cuando, consultas
+genéricas que resuelven las reglas o la caché. Al terminar, el resumen queda en
+LOCUST_RESULTS (JSON) y el proceso sale con código 1 si se superan los umbrales.
+"""
+import csv
+import json
+import os
+import random
+import time
+import uuid
+
+from locust import HttpUser, between, events, task
+
+# -----------------------------------------------------------------------------
+# CONFIGURACIÓN DE LA CARGA
+# -----------------------------------------------------------------------------
+CSV_PATH = os.getenv("LOCUST_CSV", "reescribiendo_bases/datos_tierras.csv")
+LOCUST_RESULTS = os.getenv("LOCUST_RESULTS", "locust_results.json")
+# Umbrales de regresión (0 = no se controla)
+LOCUST_MAX_P95_MS = float(os.getenv("LOCUST_MAX_P95_MS", "0"))
+LOCUST_MAX_FAIL_RATIO = float(os.getenv("LOCUST_MAX_FAIL_RATIO", "0.01"))
+LOCUST_MIN_RPS = float(os.getenv("LOCUST_MIN_RPS", "0"))
+# Fracción de primeras consultas con un error de tipeo en el municipio
+TYPO_RATE = float(os.getenv("LOCUST_TYPO_RATE", "0.3"))
+STREAM_RATE = float(os.getenv("LOCUST_STREAM_RATE", "0.2"))
+
+PLANTILLAS = [
+    "Necesito saber los requisitos para escriturar mi vivienda en {}. ¿Es gratis el trámite?",
+    "quiero escriturar en {}",
+    "donde queda la oficina de {}",
+    "vivo en {} y compré un terreno hace años, cómo hago para tener la escritura?",
+    "horario de atencion en el partido de {}",
+    "Hace dos años que inicié el trámite en {} y todavía no me llaman, a quién le reclamo?",
+]
+REPREGUNTAS = [
+    "¿y el horario?",
+    "y el mail?",
+    "¿dónde queda?",
+    "¿tiene costo?",
+    "qué papeles llevo?",
+    "y por whatsapp?",
+]
+GENERICAS = [
+    "hola",
+    "¿qué es el programa Mi escritura, mi casa?",
+    "¿cuánto cuesta escriturar?",
+    "requisitos para escriturar",
+]
+
+# -----------------------------------------------------------------------------
+
+
+def load_municipios(path):
+    """Nombres de municipios y localidades del CSV (la misma fuente que usa el backend)."""
+    names = []
+    try:
+        with open(path, newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                municipio = (row.get("Municipio") or "").strip()
+                if municipio:
+                    names.append(municipio)
+                names.extend(l.strip() for l in (row.get("Localidades") or "").split(",") if l.strip())
+    except FileNotFoundError:
+        pass
+    return names or ["La Plata", "Quilmes", "Bahía Blanca", "Mar del Plata", "Lomas de Zamora"]
+
+
+MUNICIPIOS = load_municipios(CSV_PATH)
+
+
+def add_typo(text, rng):
+    """Borra, inserta o reemplaza un carácter al azar (como bench_rag.py)."""
+    chars = list(text)
+    if len(chars) < 4:
+        return text
+    i = rng.randrange(len(chars))
+    op = rng.random()
+    if op < 0.33:
+        del chars[i]
+    elif op < 0.66:
+        chars.insert(i, rng.choice("aeiourstnl"))
+    else:
+        chars[i] = rng.choice("aeiourstnl")
+    return "".join(chars)
+
+
+class Vecino(HttpUser):
+    wait_time = between(1, 5)
+
+    def on_start(self):
+        self.rng = random.Random()
+        self.new_session()
+        # IP propia por usuario: con TRUST_PROXY cada vecino tiene su bucket de rate limit
+        self.ip = "10.%d.%d.%d" % (self.rng.randrange(256), self.rng.randrange(256), self.rng.randrange(1, 255))
+
+    def new_session(self):
+        self.session_id = uuid.uuid4().hex
+        self.asked = False
+
+    def generate(self, prompt, name):
+        stream = self.rng.random() < STREAM_RATE
+        body = {"prompt": prompt, "session_id": self.session_id, "stream": stream}
+        headers = {"X-Forwarded-For": self.ip}
+        with self.client.post("/generate", json=body, headers=headers, name=name + (" (stream)" if stream else ""),
+                              catch_response=True) as resp:
+            # ERROR_MODELO sale con 500 y type error_fallback: se cuenta aparte de los errores del servidor
+            if resp.status_code not in (200, 500):
+                resp.failure(f"HTTP {resp.status_code}")
+                return
+            try:
+                if stream:
+                    lines = [l for l in resp.text.splitlines() if l.strip()]
+                    payload = json.loads(lines[-1]) if lines else {}
+                else:
+                    payload = resp.json()
+            except ValueError:
+                resp.failure("Respuesta no es JSON")
+                return
+            if payload.get("type") == "error_fallback":
+                resp.failure("error_fallback")
+            elif resp.status_code != 200:
+                resp.failure(f"HTTP {resp.status_code}")
+            elif stream and payload.get("event") != "done":
+                resp.failure("Stream sin evento done")
+            else:
+                resp.success()
+
+    @task(5)
+    def consulta_municipio(self):
+        self.new_session()
+        municipio = self.rng.choice(MUNICIPIOS)
+        typo = self.rng.random() < TYPO_RATE
+        if typo:
+            municipio = add_typo(municipio, self.rng)
+        self.generate(self.rng.choice(PLANTILLAS).format(municipio), "consulta con typo" if typo else "consulta")
+        self.asked = True
+
+    @task(3)
+    def repregunta(self):
+        if not self.asked:
+            self.consulta_municipio()
+            return
+        self.generate(self.rng.choice(REPREGUNTAS), "repregunta")
+
+    @task(1)
+    def consulta_generica(self):
+        self.generate(self.rng.choice(GENERICAS), "generica")
+
+
+@events.quitting.add_listener
+def write_results(environment, **kwargs):
+    """Guarda el resumen por escenario y marca la corrida como fallida si hay regresión."""
+    stats = environment.stats
+    total = stats.total
+
+    def summary(entry):
+        return {
+            "requests": entry.num_requests,
+            "failures": entry.num_failures,
+            "rps": round(entry.total_rps, 2),
+            "p50_ms": entry.get_response_time_percentile(0.5),
+            "p95_ms": entry.get_response_time_percentile(0.95),
+            "p99_ms": entry.get_response_time_percentile(0.99),
+            "avg_ms": round(entry.avg_response_time, 1),
+        }
+
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "host": environment.host,
+        "users": getattr(environment.parsed_options, "num_users", None),
+        "total": summary(total),
+        "scenarios": {name: summary(entry) for (name, _), entry in stats.entries.items()},
+        "errors": {str(e.error): e.occurrences for e in stats.errors.values()},
+        "regressions": [],
+    }
+    if total.num_requests:
+        if total.fail_ratio > LOCUST_MAX_FAIL_RATIO:
+            results["regressions"].append(f"fallas {total.fail_ratio:.2%} > {LOCUST_MAX_FAIL_RATIO:.2%}")
+        p95 = total.get_response_time_percentile(0.95)
+        if LOCUST_MAX_P95_MS and p95 > LOCUST_MAX_P95_MS:
+            results["regressions"].append(f"p95 {p95:.0f} ms > {LOCUST_MAX_P95_MS:.0f} ms")
+        if LOCUST_MIN_RPS and total.total_rps < LOCUST_MIN_RPS:
+            results["regressions"].append(f"{total.total_rps:.1f} RPS < {LOCUST_MIN_RPS:.1f} RPS")
+    with open(LOCUST_RESULTS, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    if results["regressions"]:
+        environment.process_exit_code = 1
@@ -1,18 +1,48 @@
-from flask import Flask, request, jsonify, send_from_directory
+import time
+# Inicio de la importación de este módulo, para el informe de arranque (/stats "startup")
+_MODULE_STARTED = time.perf_counter()
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 import requests
 import os
+import sys
+import atexit
 import uuid
+import zlib
 import re
 import sqlite3
-import pandas as pd
 import difflib
 import threading
-import time
-from typing import Dict, List, Optional
-import bleach
+import math
+import select
+import socket
+import ipaddress
+import contextvars
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, NamedTuple, Optional, Tuple
+import hashlib
 import json 
+import csv
+import io
+import pickle
+import gzip
+try:
+    # Implementación en C de difflib (mismos resultados, varias veces más rápida)
+    import cydifflib as fast_difflib
+except ImportError:
+    fast_difflib = difflib
+try:
+    # Brotli para comprimir respuestas; sin él se negocia sólo gzip
+    import brotli
+except ImportError:
+    brotli = None
+if TYPE_CHECKING:
+    # numpy (caché semántica) y bleach se importan recién al usarse: no pesan en el arranque
+    import numpy as np
 import re 
+_IMPORTS_DONE = time.perf_counter()
 
 # -----------------------------------------------------------------------------
 # Configuración básica
@@ -33,6 +63,7 @@ ALLOWED_PROTOCOLS = ['http', 'https', 'mailto']
 def sanitize_html(html: str) -> str:
     if not isinstance(html, str):
         return ''
+    import bleach
     cleaned = bleach.clean(
         html,
         tags=ALLOWED_TAGS,
@@ -43,9 +74,8 @@ def sanitize_html(html: str) -> str:
     return cleaned.replace('<a ', '<a rel="noopener noreferrer" ')
 
 
-@app.after_request
-def set_security_headers(resp):
-    csp = (
+SECURITY_HEADERS = {
+    'Content-Security-Policy': (
         "default-src 'self'; "
         "script-src 'self' 'unsafe-inline'; "
         "style-src 'self' 'unsafe-inline'; "
@@ -56,38 +86,398 @@ def set_security_headers(resp):
         "base-uri 'self'; "
         "frame-ancestors 'none'; "
         "form-action 'self'"
-    )
-    resp.headers.setdefault('Content-Security-Policy', csp)
-    resp.headers.setdefault('X-Content-Type-Options', 'nosniff')
-    resp.headers.setdefault('X-Frame-Options', 'DENY')
-    resp.headers.setdefault('Referrer-Policy', 'same-origin')
-    resp.headers.setdefault('Permissions-Policy', 'geolocation=(), camera=(), microphone=()')
+    ),
+    'X-Content-Type-Options': 'nosniff',
+    'X-Frame-Options': 'DENY',
+    'Referrer-Policy': 'same-origin',
+    'Permissions-Policy': 'geolocation=(), camera=(), microphone=()',
+}
+
+
+@app.after_request
+def set_security_headers(resp):
+    for name, value in SECURITY_HEADERS.items():
+        resp.headers.setdefault(name, value)
     return resp
 
 # Configuración de Ollama: usa el nombre del servicio Docker 'ollama'
 OLLAMA_ENDPOINT_DEFAULT = "http://ollama:11434"
 
+# Uno o varios servidores Ollama separados por coma (OLLAMA_ENDPOINT sigue valiendo para uno solo)
 OLLAMA_ENDPOINTS = [
-    os.getenv("OLLAMA_ENDPOINT", OLLAMA_ENDPOINT_DEFAULT),
+    endpoint.strip().rstrip("/")
+    for endpoint in (os.getenv("OLLAMA_ENDPOINTS") or os.getenv("OLLAMA_ENDPOINT", OLLAMA_ENDPOINT_DEFAULT)).split(",")
+    if endpoint.strip()
 ]
-current_endpoint_index = 0
+# Conexiones persistentes por endpoint
+OLLAMA_POOL_SIZE = int(os.getenv("OLLAMA_POOL_SIZE", "16"))
+# Circuit breaker: fallos seguidos que sacan a un endpoint de la rotación y espera antes de reintentarlo
+OLLAMA_BREAKER_FAILURES = int(os.getenv("OLLAMA_BREAKER_FAILURES", "3"))
+OLLAMA_BREAKER_COOLDOWN = float(os.getenv("OLLAMA_BREAKER_COOLDOWN", "30"))
+# Sondeo de salud en segundo plano (GET /api/tags); 0 lo desactiva
+OLLAMA_HEALTH_INTERVAL = float(os.getenv("OLLAMA_HEALTH_INTERVAL", "10"))
+OLLAMA_HEALTH_TIMEOUT = float(os.getenv("OLLAMA_HEALTH_TIMEOUT", "2"))
+# Tiempo que Ollama mantiene el modelo en memoria tras cada petición ("30m", "1h", segundos, "-1" = siempre)
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+# Precarga del modelo en cada endpoint al arrancar; /ready responde 503 hasta que termina
+OLLAMA_WARMUP_ENABLED = os.getenv("OLLAMA_WARMUP_ENABLED", "true").lower() in ("1", "true", "yes")
+OLLAMA_WARMUP_TIMEOUT = float(os.getenv("OLLAMA_WARMUP_TIMEOUT", "600"))
+# Un endpoint sin tráfico durante este tiempo recibe una carga vacía que renueva keep_alive (0 = nunca)
+OLLAMA_KEEPALIVE_TOUCH = float(os.getenv("OLLAMA_KEEPALIVE_TOUCH", "600"))
 
 # Rate limiting / Concurrency
 RATE_LIMIT_RPM = int(os.getenv("RATE_LIMIT_RPM", "30"))
 RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "10"))
+# IPs o redes CIDR (p. ej. "10.0.0.0/8,192.168.1.10") exentas del rate limiting
 WHITELIST_IPS = {ip.strip() for ip in os.getenv("WHITELIST_IPS", "").split(",") if ip.strip()}
+# Buckets por IP en memoria: particiones con lock propio y tope de IPs seguidas (las menos recientes se olvidan)
+RATE_LIMIT_SHARDS = int(os.getenv("RATE_LIMIT_SHARDS", "16"))
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
 TRUST_PROXY = os.getenv("TRUST_PROXY", "false").lower() in ("1", "true", "yes")
 MAX_CONCURRENT_GPU = int(os.getenv("MAX_CONCURRENT_GPU", "4"))
 
-_ip_buckets: Dict[str, Dict[str, float]] = {}
-_gpu_semaphore = threading.Semaphore(MAX_CONCURRENT_GPU)
+# Tiempo máximo que un slot de GPU queda tomado si el proceso que lo tomó muere
+GPU_LEASE_TTL = float(os.getenv("GPU_LEASE_TTL", "600"))
+# Cola de espera por un slot de GPU (0 = rechazar con 429 apenas se llenan los slots)
+GPU_QUEUE_MAX = int(os.getenv("GPU_QUEUE_MAX", "64"))
+GPU_QUEUE_TIMEOUT = float(os.getenv("GPU_QUEUE_TIMEOUT", "30"))
+# Cada cuánto revisa un pedido en espera si se liberó un slot en otro worker o si el cliente se fue
+GPU_QUEUE_POLL = float(os.getenv("GPU_QUEUE_POLL", "0.1"))
+
+# Backend del estado compartido: "memory" (un proceso) o "sqlite" (varios workers)
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory").lower()
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "/tmp/asistente-ia-state.db")
 
 CSV_PATH = "reescribiendo_bases/datos_tierras.csv"
 DB_NAME = "municipios.db"
 SIMILARITY_THRESHOLD = 0.85
 
-chat_history_by_session: Dict[str, List[Dict[str, str]]] = {}
-municipio_consultado_by_session: Dict[str, List[Dict[str, str]]] = {}
+
+# -----------------------------------------------------------------------------
+# Estado compartido (rate limiting, slots de GPU, contadores, sesiones)
+# -----------------------------------------------------------------------------
+class StateStore(ABC):
+    """Interfaz del estado que debe ser global aunque haya varios procesos.
+
+    Una implementación a la que le falte un método falla al construirse, no en medio de una consulta.
+    """
+
+    @abstractmethod
+    def take_token(self, key: str, rate_per_sec: float, burst: float) -> bool:
+        """Token bucket: consume un token de 'key' si hay disponible."""
+        ...
+
+    @abstractmethod
+    def try_acquire_slot(self, name: str, limit: int, ttl: float) -> Optional[str]:
+        """Toma uno de 'limit' slots sin esperar; devuelve el id del préstamo o None."""
+        ...
+
+    @abstractmethod
+    def release_slot(self, name: str, lease: str):
+        ...
+
+    @abstractmethod
+    def slots_in_use(self, name: str) -> int:
+        ...
+
+    @abstractmethod
+    def incr(self, name: str) -> int:
+        """Incrementa un contador y devuelve el valor nuevo."""
+        ...
+
+    @abstractmethod
+    def get_json(self, key: str) -> Optional[Any]:
+        ...
+
+    @abstractmethod
+    def set_json(self, key: str, value: Any, ttl: Optional[float] = None):
+        ...
+
+    @abstractmethod
+    def delete(self, key: str):
+        ...
+
+    def stats(self) -> Dict[str, Any]:
+        return {}
+
+
+class _BucketShard:
+    """Partición de los token buckets: LRU propio bajo su lock ([tokens, último uso] por clave)."""
+
+    __slots__ = ("lock", "buckets", "evicted_idle", "evicted_full")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets: "OrderedDict[str, List[float]]" = OrderedDict()
+        self.evicted_idle = 0
+        self.evicted_full = 0
+
+
+class InProcessStateStore(StateStore):
+    """Estado en diccionarios del proceso (servidor de desarrollo o un único worker).
+
+    Los token buckets se reparten en particiones con lock propio, así los hilos que consultan
+    IPs distintas casi no compiten. Cada partición es un LRU: los buckets inactivos hasta
+    rellenarse se descartan (equivalen a uno nuevo) y, si aun así se supera max_keys, se
+    descartan los menos recientes. Cada consulta cuesta O(1) amortizado.
+    """
+
+    def __init__(self, shards: int = 16, max_keys: int = 100000):
+        self._lock = threading.Lock()
+        self._bucket_shards = [_BucketShard() for _ in range(max(1, shards))]
+        self._max_keys_per_shard = max(1, max_keys // len(self._bucket_shards))
+        self._slots: Dict[str, Dict[str, float]] = {}
+        self._counters: Dict[str, int] = {}
+        self._kv: Dict[str, Tuple[Optional[float], Any]] = {}
+
+    def take_token(self, key: str, rate_per_sec: float, burst: float) -> bool:
+        now = time.monotonic()
+        shard = self._bucket_shards[hash(key) % len(self._bucket_shards)]
+        # Tiempo sin uso tras el cual el bucket está lleno otra vez
+        idle_s = burst / rate_per_sec if rate_per_sec > 0 else math.inf
+        with shard.lock:
+            buckets = shard.buckets
+            bucket = buckets.get(key)
+            if bucket is not None:
+                buckets.move_to_end(key)
+                tokens = min(float(burst), bucket[0] + max(0.0, now - bucket[1]) * rate_per_sec)
+                bucket[1] = now
+                if tokens >= 1.0:
+                    bucket[0] = tokens - 1.0
+                    return True
+                bucket[0] = tokens
+                return False
+
+            # Sólo una clave nueva hace crecer la partición: es el momento de purgar
+            while buckets:
+                oldest_key, oldest = next(iter(buckets.items()))
+                if now - oldest[1] >= idle_s:
+                    shard.evicted_idle += 1
+                elif len(buckets) >= self._max_keys_per_shard:
+                    shard.evicted_full += 1
+                else:
+                    break
+                del buckets[oldest_key]
+            allowed = burst >= 1.0
+            buckets[key] = [float(burst) - 1.0 if allowed else float(burst), now]
+            return allowed
+
+    def try_acquire_slot(self, name: str, limit: int, ttl: float) -> Optional[str]:
+        with self._lock:
+            leases = self._slots.setdefault(name, {})
+            if len(leases) >= limit:
+                return None
+            lease = uuid.uuid4().hex
+            leases[lease] = time.time() + ttl
+            return lease
+
+    def release_slot(self, name: str, lease: str):
+        with self._lock:
+            self._slots.get(name, {}).pop(lease, None)
+
+    def slots_in_use(self, name: str) -> int:
+        with self._lock:
+            return len(self._slots.get(name, {}))
+
+    def incr(self, name: str) -> int:
+        with self._lock:
+            value = self._counters.get(name, 0) + 1
+            self._counters[name] = value
+            return value
+
+    def get_json(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._kv.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at is not None and expires_at <= time.time():
+                del self._kv[key]
+                return None
+            return value
+
+    def set_json(self, key: str, value: Any, ttl: Optional[float] = None):
+        with self._lock:
+            self._kv[key] = (time.time() + ttl if ttl else None, value)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._kv.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            kv_keys = len(self._kv)
+        return {
+            "backend": "memory",
+            "rate_limit_keys": sum(len(shard.buckets) for shard in self._bucket_shards),
+            "rate_limit_max_keys": self._max_keys_per_shard * len(self._bucket_shards),
+            "rate_limit_evicted_idle": sum(shard.evicted_idle for shard in self._bucket_shards),
+            "rate_limit_evicted_full": sum(shard.evicted_full for shard in self._bucket_shards),
+            "kv_keys": kv_keys,
+        }
+
+
+class SQLiteStateStore(StateStore):
+    """Estado compartido entre procesos en una base SQLite en modo WAL.
+
+    Cada operación es una transacción IMMEDIATE corta, así que los límites son globales
+    entre workers. Los slots son préstamos con vencimiento: si un worker muere con un
+    slot tomado, se libera solo al vencer.
+    """
+
+    # Cada cuántas operaciones se purgan buckets llenos y claves vencidas
+    CLEANUP_EVERY = 1000
+
+    def __init__(self, path: str, timeout: float = 5.0, max_keys: int = 100000):
+        self.path = path
+        self.timeout = timeout
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._conn_obj: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+        self._ops = 0
+        with self._transaction() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, last REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS buckets_last ON buckets (last)")
+            conn.execute("CREATE TABLE IF NOT EXISTS slots (name TEXT, lease TEXT PRIMARY KEY, expires REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)")
+            conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT, expires REAL)")
+
+    def _conn(self) -> sqlite3.Connection:
+        # Una conexión por proceso: no se hereda a través de fork()
+        if self._conn_obj is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn_obj = conn
+            self._pid = os.getpid()
+        return self._conn_obj
+
+    class _Tx:
+        def __init__(self, store: "SQLiteStateStore"):
+            self.store = store
+
+        def __enter__(self) -> sqlite3.Connection:
+            self.store._lock.acquire()
+            try:
+                self.conn = self.store._conn()
+                self.conn.execute("BEGIN IMMEDIATE")
+            except Exception:
+                self.store._lock.release()
+                raise
+            return self.conn
+
+        def __exit__(self, exc_type, exc, tb):
+            try:
+                self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+            finally:
+                self.store._lock.release()
+            return False
+
+    def _transaction(self) -> "SQLiteStateStore._Tx":
+        return SQLiteStateStore._Tx(self)
+
+    def _maybe_cleanup(self, conn: sqlite3.Connection, now: float, rate_per_sec: float = 0.0, burst: float = 0.0):
+        self._ops += 1
+        if self._ops % self.CLEANUP_EVERY:
+            return
+        conn.execute("DELETE FROM kv WHERE expires IS NOT NULL AND expires <= ?", (now,))
+        conn.execute("DELETE FROM slots WHERE expires <= ?", (now,))
+        if rate_per_sec > 0:
+            # Un bucket que ya se rellenó por completo equivale a uno inexistente
+            conn.execute("DELETE FROM buckets WHERE last <= ?", (now - burst / rate_per_sec,))
+            # Tope de IPs seguidas: se olvidan las menos recientes
+            (n_buckets,) = conn.execute("SELECT COUNT(*) FROM buckets").fetchone()
+            if n_buckets > self.max_keys:
+                conn.execute(
+                    "DELETE FROM buckets WHERE key IN (SELECT key FROM buckets ORDER BY last LIMIT ?)",
+                    (n_buckets - self.max_keys,),
+                )
+
+    def take_token(self, key: str, rate_per_sec: float, burst: float) -> bool:
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute("SELECT tokens, last FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens, last = row if row else (float(burst), now)
+            tokens = min(float(burst), tokens + max(0.0, now - last) * rate_per_sec)
+            allowed = tokens >= 1.0
+            if allowed:
+                tokens -= 1.0
+            conn.execute("INSERT OR REPLACE INTO buckets (key, tokens, last) VALUES (?, ?, ?)", (key, tokens, now))
+            self._maybe_cleanup(conn, now, rate_per_sec, burst)
+            return allowed
+
+    def try_acquire_slot(self, name: str, limit: int, ttl: float) -> Optional[str]:
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM slots WHERE name = ? AND expires <= ?", (name, now))
+            (in_use,) = conn.execute("SELECT COUNT(*) FROM slots WHERE name = ?", (name,)).fetchone()
+            if in_use >= limit:
+                return None
+            lease = uuid.uuid4().hex
+            conn.execute("INSERT INTO slots (name, lease, expires) VALUES (?, ?, ?)", (name, lease, now + ttl))
+            return lease
+
+    def release_slot(self, name: str, lease: str):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM slots WHERE lease = ?", (lease,))
+
+    def slots_in_use(self, name: str) -> int:
+        with self._transaction() as conn:
+            (in_use,) = conn.execute(
+                "SELECT COUNT(*) FROM slots WHERE name = ? AND expires > ?", (name, time.time())
+            ).fetchone()
+            return in_use
+
+    def incr(self, name: str) -> int:
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO counters (name, value) VALUES (?, 1) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + 1",
+                (name,),
+            )
+            (value,) = conn.execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()
+            return value
+
+    def get_json(self, key: str) -> Optional[Any]:
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute("SELECT value, expires FROM kv WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            value, expires_at = row
+            if expires_at is not None and expires_at <= now:
+                conn.execute("DELETE FROM kv WHERE key = ?", (key,))
+                return None
+            return json.loads(value)
+
+    def set_json(self, key: str, value: Any, ttl: Optional[float] = None):
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), now + ttl if ttl else None),
+            )
+            self._maybe_cleanup(conn, now)
+
+    def delete(self, key: str):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._transaction() as conn:
+            (buckets,) = conn.execute("SELECT COUNT(*) FROM buckets").fetchone()
+            (kv_keys,) = conn.execute("SELECT COUNT(*) FROM kv").fetchone()
+        return {"backend": "sqlite", "path": self.path, "rate_limit_keys": buckets, "kv_keys": kv_keys}
+
+
+def make_state_store(backend: str) -> StateStore:
+    if backend == "sqlite":
+        return SQLiteStateStore(STATE_DB_PATH, max_keys=RATE_LIMIT_MAX_KEYS)
+    return InProcessStateStore(RATE_LIMIT_SHARDS, RATE_LIMIT_MAX_KEYS)
+
+
+state_store = make_state_store(STATE_BACKEND)
 
 
 def _get_client_ip() -> str:
@@ -98,33 +488,489 @@ def _get_client_ip() -> str:
     return request.remote_addr or "0.0.0.0"
 
 
+def parse_whitelist(entries: set) -> Tuple[set, List[Tuple[int, int, int]]]:
+    """Separa WHITELIST_IPS en IPs exactas (búsqueda O(1)) y redes CIDR como (familia, red, máscara)."""
+    exact = set()
+    networks = []
+    for entry in entries:
+        if "/" not in entry:
+            exact.add(entry)
+            continue
+        try:
+            network = ipaddress.ip_network(entry, strict=False)
+        except ValueError:
+            app.logger.warning("WHITELIST_IPS: red inválida '%s', se ignora", entry)
+            continue
+        family = socket.AF_INET if network.version == 4 else socket.AF_INET6
+        networks.append((family, int(network.network_address), int(network.netmask)))
+    return exact, networks
+
+
+_whitelist_exact, _whitelist_networks = parse_whitelist(WHITELIST_IPS)
+
+
+def _ip_whitelisted(ip: str) -> bool:
+    if ip in _whitelist_exact:
+        return True
+    if not _whitelist_networks:
+        return False
+    # inet_pton es bastante más rápido que ipaddress.ip_address
+    try:
+        family, packed = socket.AF_INET, socket.inet_pton(socket.AF_INET, ip)
+    except OSError:
+        try:
+            family, packed = socket.AF_INET6, socket.inet_pton(socket.AF_INET6, ip)
+        except OSError:
+            return False
+    address = int.from_bytes(packed, "big")
+    return any(family == net_family and address & mask == net for net_family, net, mask in _whitelist_networks)
+
+
 def _ip_allow(ip: str) -> bool:
-    if ip in WHITELIST_IPS:
+    if _ip_whitelisted(ip):
         return True
-    now = time.time()
-    bucket = _ip_buckets.get(ip)
-    if bucket is None:
-        bucket = {"tokens": float(RATE_LIMIT_BURST), "last": now}
-        _ip_buckets[ip] = bucket
-    elapsed = max(0.0, now - bucket["last"])
-    refill_per_sec = RATE_LIMIT_RPM / 60.0
-    bucket["tokens"] = min(float(RATE_LIMIT_BURST), bucket["tokens"] + elapsed * refill_per_sec)
-    bucket["last"] = now
-    if bucket["tokens"] >= 1.0:
-        bucket["tokens"] -= 1.0
+    return state_store.take_token("ip:" + ip, RATE_LIMIT_RPM / 60.0, float(RATE_LIMIT_BURST))
+
+
+def _percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, max(0, math.ceil(q * len(sorted_values)) - 1))
+    return sorted_values[idx]
+
+
+# -----------------------------------------------------------------------------
+# Métricas (Prometheus) y Server-Timing
+# -----------------------------------------------------------------------------
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING_ENABLED", "true").lower() in ("1", "true", "yes")
+# Últimas mediciones por etapa de las que salen p50/p95/p99
+METRICS_WINDOW = int(os.getenv("METRICS_WINDOW", "1024"))
+METRICS_QUANTILES = (0.5, 0.95, 0.99)
+
+# Duración de cada etapa de la consulta en curso (la vista la crea; las etapas la completan)
+_request_timings: "contextvars.ContextVar[Optional[Dict[str, float]]]" = contextvars.ContextVar(
+    "request_timings", default=None
+)
+
+
+def _label_text(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        '%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+class Metrics:
+    """Contadores y resúmenes (cuantiles sobre una ventana) del proceso, en formato de texto de Prometheus.
+
+    Registrar cuesta un append bajo un lock; los cuantiles se calculan recién al exportar.
+    Los valores que ya llevan otros componentes (cachés, cola, endpoints) se leen de sus
+    stats() al exportar, mediante los collectors.
+    """
+
+    def __init__(self, window: int = 1024):
+        self.window = window
+        self._lock = threading.Lock()
+        self._summaries: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], List[Any]] = {}
+        self._counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+        self._help: Dict[str, Tuple[str, str]] = {}
+        self._collectors: List[Any] = []
+
+    def describe(self, name: str, kind: str, help_text: str):
+        self._help[name] = (kind, help_text)
+
+    def observe(self, name: str, value: float, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            summary = self._summaries.get(key)
+            if summary is None:
+                summary = self._summaries[key] = [0, 0.0, deque(maxlen=self.window)]
+            summary[0] += 1
+            summary[1] += value
+            summary[2].append(value)
+
+    def inc(self, name: str, amount: float = 1.0, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + amount
+
+    def collector(self, fn):
+        """Registra una función que devuelve [(nombre, tipo, ayuda, {labels}, valor), ...] al exportar."""
+        self._collectors.append(fn)
+        return fn
+
+    def render(self) -> str:
+        with self._lock:
+            summaries = [(name, labels, count, total, sorted(values))
+                         for (name, labels), (count, total, values) in self._summaries.items()]
+            counters = list(self._counters.items())
+
+        series: Dict[str, List[str]] = {}
+        kinds: Dict[str, Tuple[str, str]] = {}
+        for name, labels, count, total, values in sorted(summaries):
+            kinds[name] = self._help.get(name, ("summary", ""))
+            lines = series.setdefault(name, [])
+            for q in METRICS_QUANTILES:
+                lines.append(f"{name}{_label_text(labels + (('quantile', str(q)),))} {_percentile(values, q):.6f}")
+            lines.append(f"{name}_sum{_label_text(labels)} {total:.6f}")
+            lines.append(f"{name}_count{_label_text(labels)} {count}")
+        for (name, labels), value in sorted(counters):
+            kinds[name] = self._help.get(name, ("counter", ""))
+            series.setdefault(name, []).append(f"{name}{_label_text(labels)} {value:g}")
+        for fn in self._collectors:
+            try:
+                samples = fn()
+            except Exception as e:
+                app.logger.warning("Métricas: collector %s falló: %s", fn.__name__, e)
+                continue
+            for name, kind, help_text, labels, value in samples:
+                kinds.setdefault(name, (kind, help_text))
+                series.setdefault(name, []).append(f"{name}{_label_text(tuple(sorted(labels.items())))} {value:g}")
+
+        out = []
+        for name, lines in series.items():
+            kind, help_text = kinds[name]
+            if help_text:
+                out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(lines)
+        return "\n".join(out) + "\n"
+
+
+metrics = Metrics(METRICS_WINDOW)
+metrics.describe("asistente_stage_seconds", "summary", "Duración de cada etapa de /generate.")
+metrics.describe("asistente_request_seconds", "summary", "Duración total de las respuestas HTTP por ruta.")
+metrics.describe("asistente_rejections_total", "counter", "Consultas rechazadas (429/499) por motivo.")
+metrics.describe("asistente_responses_total", "counter", "Respuestas de /generate por origen.")
+metrics.describe("asistente_rag_lookups_total", "counter", "Detección de municipio: hit o miss.")
+
+
+def begin_request_timings() -> Dict[str, float]:
+    """Abre el registro de etapas de la consulta en curso (hilo, greenlet o tarea asyncio)."""
+    timings: Dict[str, float] = {}
+    _request_timings.set(timings)
+    return timings
+
+
+class timed:
+    """with timed("rag"): ... suma la duración a la etapa de la consulta en curso y a las métricas."""
+
+    __slots__ = ("stage", "started")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        record_stage(self.stage, time.perf_counter() - self.started)
+        return False
+
+
+def record_stage(stage: str, seconds: float):
+    if METRICS_ENABLED:
+        metrics.observe("asistente_stage_seconds", seconds, stage=stage)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+def server_timing_header(timings: Dict[str, float], total_s: Optional[float] = None) -> str:
+    """Valor de Server-Timing (ms por etapa) para que el navegador muestre el desglose."""
+    parts = [f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in timings.items()]
+    if total_s is not None:
+        parts.append(f"total;dur={total_s * 1000:.2f}")
+    return ", ".join(parts)
+
+
+def count_rejection(reason: str):
+    if METRICS_ENABLED:
+        metrics.inc("asistente_rejections_total", reason=reason)
+
+
+def count_response(payload: Dict[str, Any]):
+    if METRICS_ENABLED:
+        metrics.inc("asistente_responses_total", source=payload.get("source") or payload.get("type", "unknown"))
+
+
+@app.before_request
+def start_request_timings():
+    request.environ["asistente.started"] = time.perf_counter()
+    begin_request_timings()
+
+
+@app.after_request
+def add_server_timing(resp):
+    started = request.environ.get("asistente.started")
+    if started is None:
+        return resp
+    total_s = time.perf_counter() - started
+    if METRICS_ENABLED:
+        # Sólo rutas conocidas como etiqueta: los 404 no agregan series
+        route = request.url_rule.rule if request.url_rule is not None else "other"
+        metrics.observe("asistente_request_seconds", total_s, route=route)
+    timings = _request_timings.get()
+    if SERVER_TIMING_ENABLED and timings is not None:
+        resp.headers["Server-Timing"] = server_timing_header(timings, total_s)
+    if _startup["first_request"] is None:
+        record_first_request(request.path, total_s, timings)
+    return resp
+
+
+class AdmissionRejected(Exception):
+    """El pedido no consiguió slot de GPU: cola llena, espera vencida o cliente desconectado."""
+
+    def __init__(self, reason: str, retry_after: int = 0):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionWaiter:
+    __slots__ = ("key", "enqueued_at", "lease", "wake")
+
+    def __init__(self, key: str, wake):
+        self.key = key
+        self.enqueued_at = time.monotonic()
+        self.lease: Optional[str] = None
+        self.wake = wake
+
+
+class AdmissionQueue:
+    """Cola de espera acotada delante de los slots de GPU, con turnos equitativos por cliente.
+
+    Cada cliente (IP) tiene su propia fila y los slots que se liberan se reparten por
+    turnos entre las filas, así un usuario con muchos pedidos no posterga al resto. Los
+    slots siguen estando en state_store, por lo que el límite es global entre workers.
+
+    Un slot liberado en este proceso se reparte en el acto (release llama a dispatch); los que
+    se liberan en otros workers se descubren consultando state_store a lo sumo una vez cada
+    'poll' segundos por proceso, no una vez por cada pedido en espera.
+    """
+
+    def __init__(self, store: StateStore, slot_name: str, limit: int, max_depth: int,
+                 max_wait: float, lease_ttl: float, poll: float):
+        self.store = store
+        self.slot_name = slot_name
+        self.limit = limit
+        self.max_depth = max_depth
+        self.max_wait = max_wait
+        self.lease_ttl = lease_ttl
+        self.poll = poll
+        self._lock = threading.Lock()
+        self._queues: "OrderedDict[str, deque]" = OrderedDict()
+        self._depth = 0
+        self._lease_started: Dict[str, float] = {}
+        self._service_ewma: Optional[float] = None
+        self._waits: deque = deque(maxlen=2048)
+        self._last_dispatch = 0.0
+        self.store_polls = 0
+        self.admitted = 0
+        self.queued = 0
+        self.rejected_full = 0
+        self.timeouts = 0
+        self.cancelled = 0
+
+    # --- Núcleo (sin bloqueo; lo usan tanto la vista Flask como el modo ASGI) ---
+    def _admit(self, lease: str, waited: float):
+        self._lease_started[lease] = time.monotonic()
+        self._waits.append(waited)
+        self.admitted += 1
+
+    def try_admit_now(self) -> Optional[str]:
+        """Slot inmediato, sólo si nadie está esperando (respeta el orden de la cola)."""
+        with self._lock:
+            if self._depth:
+                return None
+            lease = self.store.try_acquire_slot(self.slot_name, self.limit, self.lease_ttl)
+            if lease is not None:
+                self._admit(lease, 0.0)
+            return lease
+
+    def enqueue(self, key: str, wake) -> AdmissionWaiter:
+        with self._lock:
+            if self._depth >= self.max_depth:
+                self.rejected_full += 1
+                raise AdmissionRejected("gpu_queue_full", self._retry_after_locked())
+            waiter = AdmissionWaiter(key, wake)
+            self._queues.setdefault(key, deque()).append(waiter)
+            self._depth += 1
+            self.queued += 1
+            return waiter
+
+    def dispatch(self):
+        """Asigna los slots libres a los pedidos en espera, una fila por turno."""
+        woken: List[AdmissionWaiter] = []
+        with self._lock:
+            if self._queues:
+                self._last_dispatch = time.monotonic()
+                self.store_polls += 1
+            while self._queues:
+                key, waiting = next(iter(self._queues.items()))
+                lease = self.store.try_acquire_slot(self.slot_name, self.limit, self.lease_ttl)
+                if lease is None:
+                    break
+                waiter = waiting.popleft()
+                self._depth -= 1
+                if waiting:
+                    self._queues.move_to_end(key)
+                else:
+                    del self._queues[key]
+                waiter.lease = lease
+                self._admit(lease, time.monotonic() - waiter.enqueued_at)
+                woken.append(waiter)
+        for waiter in woken:
+            waiter.wake()
+
+    def poll_shared(self):
+        """dispatch() para los slots liberados por otros workers, a lo sumo una vez cada 'poll' segundos."""
+        with self._lock:
+            if not self._queues or time.monotonic() - self._last_dispatch < self.poll:
+                return
+        self.dispatch()
+
+    def cancel(self, waiter: AdmissionWaiter) -> Optional[str]:
+        """Saca al pedido de la cola; si ya tenía slot asignado, lo devuelve."""
+        with self._lock:
+            if waiter.lease is not None:
+                return waiter.lease
+            waiting = self._queues.get(waiter.key)
+            if waiting is not None and waiter in waiting:
+                waiting.remove(waiter)
+                self._depth -= 1
+                if not waiting:
+                    del self._queues[waiter.key]
+            return None
+
+    def expired(self, waiter: AdmissionWaiter) -> bool:
+        return time.monotonic() - waiter.enqueued_at >= self.max_wait
+
+    def give_up(self, waiter: AdmissionWaiter, reason: str) -> Optional[str]:
+        """Cancela por espera vencida o desconexión; devuelve el slot si llegó a tiempo."""
+        lease = self.cancel(waiter)
+        if lease is not None and reason != "client_disconnected":
+            return lease
+        if lease is not None:
+            self.release(lease)
+        with self._lock:
+            if reason == "client_disconnected":
+                self.cancelled += 1
+            else:
+                self.timeouts += 1
+            retry_after = self._retry_after_locked()
+        raise AdmissionRejected(reason, retry_after)
+
+    def release(self, lease: str):
+        with self._lock:
+            started = self._lease_started.pop(lease, None)
+            if started is not None:
+                held = time.monotonic() - started
+                self._service_ewma = held if self._service_ewma is None else 0.8 * self._service_ewma + 0.2 * held
+        self.store.release_slot(self.slot_name, lease)
+        self.dispatch()
+
+    def _retry_after_locked(self) -> int:
+        # Tiempo estimado hasta que se atienda a todos los que ya están esperando
+        service = self._service_ewma if self._service_ewma is not None else 5.0
+        return max(1, math.ceil(service * (self._depth + 1) / max(1, self.limit)))
+
+    # --- Espera bloqueante (hilos / greenlets) ---
+    def acquire(self, key: str, is_disconnected=None) -> str:
+        lease = self.try_admit_now()
+        if lease is not None:
+            return lease
+        event = threading.Event()
+        waiter = self.enqueue(key, event.set)
+        self.dispatch()
+        while True:
+            if waiter.lease is not None:
+                return waiter.lease
+            if self.expired(waiter):
+                return self.give_up(waiter, "gpu_queue_timeout")
+            if is_disconnected is not None and is_disconnected():
+                return self.give_up(waiter, "client_disconnected")
+            event.wait(self.poll)
+            self.poll_shared()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            waits = sorted(self._waits)
+            return {
+                "depth": self._depth,
+                "max_depth": self.max_depth,
+                "max_wait_s": self.max_wait,
+                "clients_waiting": len(self._queues),
+                "admitted": self.admitted,
+                "queued": self.queued,
+                "rejected_full": self.rejected_full,
+                "timeouts": self.timeouts,
+                "cancelled": self.cancelled,
+                "store_polls": self.store_polls,
+                "wait_ms": {
+                    "p50": _percentile(waits, 0.50) * 1000,
+                    "p95": _percentile(waits, 0.95) * 1000,
+                    "p99": _percentile(waits, 0.99) * 1000,
+                },
+                "service_s_ewma": self._service_ewma,
+                "retry_after_s": self._retry_after_locked(),
+            }
+
+
+gpu_admission = AdmissionQueue(
+    state_store, "gpu", MAX_CONCURRENT_GPU, GPU_QUEUE_MAX, GPU_QUEUE_TIMEOUT, GPU_LEASE_TTL, GPU_QUEUE_POLL
+)
+
+# Claves del environ WSGI donde los servidores exponen el socket del cliente
+CLIENT_SOCKET_ENV_KEYS = ("werkzeug.socket", "gunicorn.socket", "gevent.socket")
+
+
+def _client_disconnected(environ: Dict[str, Any]) -> bool:
+    """True si el cliente cerró la conexión (el cuerpo ya se leyó: legible sin datos = EOF)."""
+    sock = next((environ[k] for k in CLIENT_SOCKET_ENV_KEYS if environ.get(k) is not None), None)
+    if sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            return False
+        return sock.recv(1, socket.MSG_PEEK) == b""
+    except (OSError, ValueError):
         return True
-    return False
 
 
-def _try_acquire_gpu() -> bool:
-    return _gpu_semaphore.acquire(blocking=False)
+def _try_acquire_gpu(client_key: str, is_disconnected=None) -> str:
+    """Espera turno por un slot de GPU; lanza AdmissionRejected si no lo consigue."""
+    return gpu_admission.acquire(client_key, is_disconnected)
 
 
-def _release_gpu():
+def _release_gpu(lease: Optional[str]):
+    if not lease:
+        return
     try:
-        _gpu_semaphore.release()
+        gpu_admission.release(lease)
     except Exception:
-        pass
+        app.logger.exception("No se pudo liberar el slot de GPU %s", lease)
+
+
+def _busy_response(rejected: AdmissionRejected):
+    count_rejection(rejected.reason)
+    if rejected.reason == "client_disconnected":
+        return jsonify({"error": "Client disconnected", "reason": rejected.reason}), 499
+    resp = jsonify({"error": "System busy", "reason": rejected.reason})
+    resp.status_code = 429
+    resp.headers["Retry-After"] = str(rejected.retry_after)
+    return resp
+
+
+def _next_endpoint_start(n: int) -> int:
+    """Índice del endpoint por el que empieza la rotación (round-robin global entre workers)."""
+    return (state_store.incr("ollama_endpoint") - 1) % n
 
 # -----------------------------------------------------------------------------
 # Keywords y respuestas predefinidas (Se mantienen por ser datos)
@@ -275,34 +1121,97 @@ def format_municipio_data(data: Dict[str, str]) -> str:
 # -----------------------------------------------------------------------------
 # DB y CSV (RAG Component)
 # -----------------------------------------------------------------------------
-def create_and_populate_db_if_needed():
-    """Crea la base de datos SQLite desde el CSV si no existe, o si es la primera vez."""
+def read_csv_rows(text: str) -> Tuple[List[str], List[Tuple[str, ...]]]:
+    """Columnas normalizadas y filas del CSV de municipios, todo como string (se omiten filas vacías)."""
+    reader = csv.reader(io.StringIO(text))
+    columns = [normalize_column_name(c) for c in next(reader, [])]
+    rows = []
+    for raw in reader:
+        values = tuple((raw + [""] * len(columns))[:len(columns)])
+        if any(v.strip() for v in values):
+            rows.append(values)
+    return columns, rows
+
+
+def _row_keys(columns: List[str], rows: List[Tuple[str, ...]]) -> List[Tuple[str, int]]:
+    """Clave de cada fila para el upsert: NRO (o el contenido si no tiene) y su número de aparición."""
+    key_idx = columns.index("NRO") if "NRO" in columns else None
+    seen: Dict[str, int] = {}
+    keys = []
+    for row in rows:
+        base = row[key_idx] if key_idx is not None and row[key_idx].strip() else "\x1f".join(row)
+        occurrence = seen.get(base, 0)
+        seen[base] = occurrence + 1
+        keys.append((base, occurrence))
+    return keys
+
+
+def sync_csv_to_db() -> Optional[Dict[str, int]]:
+    """Aplica a municipios.db los cambios del CSV fila por fila, en una sola transacción.
+
+    El hash del CSV aplicado queda en la tabla rag_sync; si no cambió no se toca la base.
+    Devuelve las filas insertadas/actualizadas/borradas, o None si no hubo nada que aplicar.
+    Si cambian las columnas, la tabla se recrea (también dentro de la transacción).
+    """
     if not os.path.exists(CSV_PATH):
         app.logger.warning(f"CSV de municipios no encontrado en {CSV_PATH}")
-        return
-    
-    if os.path.exists(DB_NAME):
-        app.logger.info(f"DB {DB_NAME} ya existe.")
-        return
+        return None
+    with open(CSV_PATH, "rb") as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()
 
+    conn = sqlite3.connect(DB_NAME, timeout=30, isolation_level=None)
     try:
-        app.logger.info(f"Creando DB {DB_NAME} desde CSV para RAG...")
-        conn = sqlite3.connect(DB_NAME)
-        # Lectura como string para evitar errores de tipo en la DB
-        df = pd.read_csv(CSV_PATH, dtype=str, keep_default_na=False)
-        df.columns = [normalize_column_name(c) for c in df.columns]
-        
-        if "CABECERA" not in df.columns:
+        # IMMEDIATE: con varios workers, sólo uno aplica el cambio; el resto ve el hash ya guardado
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("CREATE TABLE IF NOT EXISTS rag_sync (key TEXT PRIMARY KEY, value TEXT)")
+        row = conn.execute("SELECT value FROM rag_sync WHERE key = 'csv_sha256'").fetchone()
+        if row is not None and row[0] == digest:
+            conn.execute("COMMIT")
+            return None
+
+        columns, rows = read_csv_rows(data.decode("utf-8-sig"))
+        if "CABECERA" not in columns:
             app.logger.warning("Columna CABECERA no encontrada en CSV.")
+        existing_cols = [r[1] for r in conn.execute("PRAGMA table_info(municipios)")]
+        existing: Dict[Tuple[str, int], Tuple[Any, ...]] = {}
+        if existing_cols != columns:
+            quoted = ", ".join('"%s" TEXT' % c.replace('"', '""') for c in columns)
+            conn.execute("DROP TABLE IF EXISTS municipios")
+            conn.execute(f"CREATE TABLE municipios ({quoted})")
+        else:
+            db_rows = conn.execute("SELECT rowid, * FROM municipios ORDER BY rowid").fetchall()
+            db_values = [tuple("" if v is None else str(v) for v in r[1:]) for r in db_rows]
+            existing = {
+                key: (r[0],) + values for key, r, values in zip(_row_keys(columns, db_values), db_rows, db_values)
+            }
 
-        df.to_sql("municipios", conn, if_exists="replace", index=False)
-        conn.close()
-        app.logger.info("DB de municipios creada exitosamente.")
-    except Exception as e:
-        app.logger.exception("Error creando DB desde CSV: %s", e)
+        inserts, updates = [], []
+        for key, values in zip(_row_keys(columns, rows), rows):
+            old = existing.pop(key, None)
+            if old is None:
+                inserts.append(values)
+            elif old[1:] != values:
+                updates.append(values + (old[0],))
+        deletes = [(old[0],) for old in existing.values()]
 
+        placeholders = ", ".join("?" for _ in columns)
+        assignments = ", ".join('"%s" = ?' % c.replace('"', '""') for c in columns)
+        conn.executemany(f"INSERT INTO municipios VALUES ({placeholders})", inserts)
+        conn.executemany(f"UPDATE municipios SET {assignments} WHERE rowid = ?", updates)
+        conn.executemany("DELETE FROM municipios WHERE rowid = ?", deletes)
+        conn.execute("INSERT OR REPLACE INTO rag_sync (key, value) VALUES ('csv_sha256', ?)", (digest,))
+        conn.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
 
-create_and_populate_db_if_needed()
+    changes = {"inserted": len(inserts), "updated": len(updates), "deleted": len(deletes)}
+    app.logger.warning("CSV de municipios aplicado a %s: %s", DB_NAME, changes)
+    return changes
 
 
 def get_db_connection():
@@ -310,237 +1219,3298 @@ def get_db_connection():
     return conn
 
 
-def search_municipio(municipio_name: str) -> Optional[Dict[str, str]]:
-    """Búsqueda difusa de municipio, localidad o cabecera en DB."""
-    if not municipio_name:
-        return None
-    q = normalize_text(municipio_name)
-    if not q:
-        return None
-    
-    # Columnas clave para la búsqueda de coincidencia
-    SEARCH_COLS = ["MUNICIPIO", "LOCALIDADES", "CABECERA"]
-    
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM municipios")
-        rows = cur.fetchall()
-        cols = [d[0] for d in cur.description]
-        
-        search_idx = {col: i for i, col in enumerate(cols) if col in SEARCH_COLS}
-        best_sim = 0.0
-        best_row = None
-        
-        for r in rows:
-            current_best_sim = 0.0
-            
-            for col_name, idx in search_idx.items():
-                val = str(r[idx]) if r[idx] is not None else ""
-                
-                # Para LOCALIDADES, compara cada entrada por separado
-                localidades = [l.strip() for l in val.split(',') if l.strip()] if col_name == "LOCALIDADES" else [val]
-                
-                for cand_val in localidades:
-                    cand_val_norm = normalize_text(cand_val)
-                    if not cand_val_norm or len(cand_val_norm) < 3:
-                        continue
-                    
-                    sim = difflib.SequenceMatcher(None, q, cand_val_norm).ratio()
-                    
-                    if sim > current_best_sim:
-                        current_best_sim = sim
-            
-            if current_best_sim > best_sim:
-                best_sim = current_best_sim
-                best_row = r
+# Columnas clave para la búsqueda de coincidencia
+SEARCH_COLS = ["MUNICIPIO", "LOCALIDADES", "CABECERA"]
+NAME_PREFIXES = ["municipio de ", "partido de ", "ciudad de "]
+MIN_NAME_LEN = 3
+# Cada cuántos segundos se verifica si municipios.db o el CSV cambiaron (0 = sólo al arrancar)
+GAZETTEER_CHECK_INTERVAL = float(os.getenv("GAZETTEER_CHECK_INTERVAL", "5"))
+# Índice ya construido, guardado junto a la base para no reconstruirlo en cada arranque ("" = no se usa)
+GAZETTEER_SNAPSHOT_PATH = os.getenv("GAZETTEER_SNAPSHOT_PATH", "municipios.snapshot.pkl")
+# Subir al cambiar normalize_text o las estructuras del índice: invalida los snapshots anteriores
+GAZETTEER_SNAPSHOT_VERSION = 1
 
-        conn.close()
 
-        if best_row is not None and best_sim >= SIMILARITY_THRESHOLD:
-            return {
-                cols[i]: (str(best_row[i]) if best_row[i] is not None else "")
-                for i in range(len(cols))
-            }
-        return None
-    except Exception as e:
-        app.logger.exception("Error en search_municipio: %s", e)
-        try:
-            conn.close()
-        except:
-            pass
-        return None
+class NameMatch(NamedTuple):
+    """Mención de un nombre del índice; start/end son posiciones en el texto normalizado."""
+    start: int
+    end: int
+    name: str
+    row: int
 
 
-def extract_and_search_municipio(user_text: str) -> Optional[Dict[str, str]]:
-    """Intenta extraer un posible nombre de municipio/localidad/cabecera desde el texto y busca en DB."""
-    if not user_text:
-        return None
-    text_norm = normalize_text(user_text)
-    words = text_norm.split()
-    candidates: List[str] = []
+class NameMatcher:
+    """Autómata Aho-Corasick sobre palabras: encuentra todos los nombres en una sola pasada.
 
-    # Patrones con preposiciones comunes y sufijos
-    m = re.search(r"\b(?:de|en)\s+(la\s+|el\s+)?([a-z\s]{2,})$", text_norm)
-    if m:
-        tail = m.group(2).strip()
-        tail_words = tail.split()
-        for n in range(3, 0, -1):
-            if len(tail_words) >= n:
-                candidates.append(" ".join(tail_words[-n:]))
+    Trabaja sobre texto normalizado (palabras separadas por un único espacio), por lo que
+    coincidir por palabras equivale a buscar con límites de palabra (\\b) sin compilar regex.
+    """
 
-    # Sufijos globales del enunciado
-    for n in range(3, 0, -1):
-        if len(words) >= n:
-            candidates.append(" ".join(words[-n:]))
+    def __init__(self):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        # Nombres (id) que terminan en cada nodo, incluidos los heredados por los enlaces de fallo
+        self._out: List[List[int]] = [[]]
+        self.names: List[str] = []
+        self._name_len: List[int] = []
+        self._ids: Dict[str, int] = {}
 
-    # Deduplicar manteniendo orden
-    seen = set()
-    uniq_candidates = []
-    for c in candidates:
-        if c not in seen:
-            seen.add(c)
-            uniq_candidates.append(c)
+    def add(self, name: str) -> int:
+        """Agrega un nombre normalizado y devuelve su id (el mismo si ya existía)."""
+        if name in self._ids:
+            return self._ids[name]
+        node = 0
+        words = name.split(" ")
+        for word in words:
+            nxt = self._goto[node].get(word)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][word] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            node = nxt
+        name_id = len(self.names)
+        self.names.append(name)
+        self._name_len.append(len(words))
+        self._ids[name] = name_id
+        self._out[node].append(name_id)
+        return name_id
 
-    for cand in uniq_candidates:
-        res = search_municipio(cand)
-        if res:
-            return res
-    return None
+    def build(self):
+        """Calcula los enlaces de fallo (BFS); llamar tras agregar todos los nombres."""
+        queue = list(self._goto[0].values())
+        for node in queue:
+            self._fail[node] = 0
+        head = 0
+        while head < len(queue):
+            node = queue[head]
+            head += 1
+            for word, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and word not in self._goto[fail]:
+                    fail = self._fail[fail]
+                target = self._goto[fail].get(word, 0)
+                self._fail[child] = target if target != child else 0
+                self._out[child] = self._out[child] + self._out[self._fail[child]]
 
+    def find_all(self, text_norm: str) -> List[Tuple[int, int, int]]:
+        """Devuelve (start, end, id) de cada aparición, incluidas las superpuestas."""
+        matches: List[Tuple[int, int, int]] = []
+        if not text_norm:
+            return matches
+        starts: List[int] = []
+        node = 0
+        pos = 0
+        for word in text_norm.split(" "):
+            starts.append(pos)
+            end = pos + len(word)
+            while node and word not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(word, 0)
+            for name_id in self._out[node]:
+                first_word = len(starts) - self._name_len[name_id]
+                matches.append((starts[first_word], end, name_id))
+            pos = end + 1
+        return matches
 
-def find_municipio_in_text(user_text: str) -> Optional[Dict[str, str]]:
-    """Busca municipio/localidad/cabecera mencionado literalmente en el texto del usuario (búsqueda estricta)."""
-    if not user_text:
-        return None
-    text_norm = normalize_text(user_text)
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM municipios")
-        rows = cur.fetchall()
-        cols = [d[0] for d in cur.description]
 
-        SEARCH_COLS = ["MUNICIPIO", "LOCALIDADES", "CABECERA"]
-        search_idx = {col: i for i, col in enumerate(cols) if col in SEARCH_COLS}
+class FuzzyIndex:
+    """Búsqueda difusa: índice invertido de trigramas + SequenceMatcher sólo sobre la lista corta.
 
-        if not search_idx:
-            return None
+    Los filtros son cotas exactas de SequenceMatcher.ratio(), así que nunca descartan un
+    candidato que alcance el umbral: el resultado es el mismo que comparar contra todos.
+    """
 
-        for r in rows:
-            for col_name, idx in search_idx.items():
-                val = str(r[idx]) if r[idx] is not None else ""
-                raw = val.strip()
+    def __init__(self, values: List[str], threshold: float):
+        self.values = values
+        self.threshold = threshold
+        self._by_len: Dict[int, List[int]] = {}
+        self._postings: Dict[str, List[Tuple[int, int]]] = {}
+        for value_id, value in enumerate(values):
+            self._by_len.setdefault(len(value), []).append(value_id)
+            for gram, count in self._trigrams(value).items():
+                self._postings.setdefault(gram, []).append((value_id, count))
 
-                primary_cands = [l.strip() for l in raw.split(',') if l.strip()] if col_name == "LOCALIDADES" else [raw]
-                
-                for primary in primary_cands:
-                    if not primary: continue
+    @staticmethod
+    def _trigrams(s: str) -> Dict[str, int]:
+        grams: Dict[str, int] = {}
+        for i in range(len(s) - 2):
+            gram = s[i:i + 3]
+            grams[gram] = grams.get(gram, 0) + 1
+        return grams
 
-                    name_norm_full = normalize_text(primary)
-                    if not name_norm_full or len(name_norm_full) < 3:
-                        continue
+    def _shortlist(self, q: str) -> List[int]:
+        t = self.threshold
+        la = len(q)
+        # ratio <= 2*min(la, lb) / (la + lb): acota las longitudes posibles
+        lengths = [
+            lb for lb in self._by_len
+            if 2.0 * min(la, lb) / (la + lb) >= t - 1e-9
+        ]
+        if not lengths:
+            return []
 
-                    candidates = [name_norm_full]
-                    
-                    parts = re.split(r"\s*[-–—\(,/+]\s*", primary, maxsplit=1)
-                    if parts[0].strip() != primary:
-                        part_norm = normalize_text(parts[0].strip())
-                        if part_norm and part_norm not in candidates:
-                            candidates.append(part_norm)
-
-                    # Quitar prefijos comunes (ej: "municipio de")
-                    for prefix in ["municipio de ", "partido de ", "ciudad de "]:
-                        if name_norm_full.startswith(normalize_text(prefix)):
-                            cand = name_norm_full[len(normalize_text(prefix)) :].strip()
-                            if cand and cand not in candidates:
-                                candidates.append(cand)
-                    
-                    # Probar cada candidato con límites de palabra para evitar falsos positivos
-                    for cand in candidates:
-                        if len(cand) < 3:
-                            continue
-                        pattern = r"\b" + re.escape(cand) + r"\b"
-                        if re.search(pattern, text_norm):
-                            conn.close()
-                            return {
-                                cols[i]: (str(r[i]) if r[i] is not None else "")
-                                for i in range(len(cols))
-                            }
+        shared: Dict[int, int] = {}
+        for gram, count in self._trigrams(q).items():
+            for value_id, value_count in self._postings.get(gram, ()):
+                shared[value_id] = shared.get(value_id, 0) + min(count, value_count)
 
-        conn.close()
-        return None
-    except Exception as e:
-        app.logger.exception("Error en find_municipio_in_text: %s", e)
-        try:
+        # Con M caracteres coincidentes en k bloques, comparten al menos M - 2k trigramas,
+        # y k - 1 no supera los caracteres sin coincidir: trigramas >= (la+lb)*(2.5t-2) - 2
+        shortlist: List[int] = []
+        for lb in lengths:
+            required = (la + lb) * (2.5 * t - 2.0) - 2.0
+            for value_id in self._by_len[lb]:
+                if required <= 0 or shared.get(value_id, 0) >= required - 1e-9:
+                    shortlist.append(value_id)
+        shortlist.sort()
+        return shortlist
+
+    def best_match(self, q: str) -> Tuple[Optional[int], float]:
+        """Devuelve (id, similitud) del mejor valor; a igual similitud gana el primero."""
+        best_sim = 0.0
+        best_id = None
+        if not q:
+            return best_id, best_sim
+        # Mismo orden de argumentos que SequenceMatcher(None, q, valor): ratio() no es simétrico
+        matcher = fast_difflib.SequenceMatcher(None)
+        matcher.set_seq1(q)
+        for value_id in self._shortlist(q):
+            matcher.set_seq2(self.values[value_id])
+            # Cotas superiores baratas antes del cálculo completo
+            floor = max(best_sim, self.threshold)
+            if matcher.real_quick_ratio() < floor or matcher.quick_ratio() < floor:
+                continue
+            sim = matcher.ratio()
+            if sim > best_sim:
+                best_sim = sim
+                best_id = value_id
+        return best_id, best_sim
+
+
+class Gazetteer:
+    """Índice en memoria de municipios: nombres pre-normalizados mapeados a su fila."""
+
+    def __init__(self, columns: List[str], rows: List[Dict[str, str]]):
+        self.columns = columns
+        self.rows = rows
+        # Nombre normalizado -> primera fila (en orden de tabla) que lo menciona
+        self.literal_rows: Dict[str, int] = {}
+        self.matcher = NameMatcher()
+        # Valor normalizado -> primera fila que lo contiene (búsqueda difusa)
+        self.fuzzy_names: Dict[str, int] = {}
+
+        search_cols = [c for c in columns if c in SEARCH_COLS]
+        for row_idx, row in enumerate(rows):
+            for col_name in search_cols:
+                val = row.get(col_name, "")
+                for name in self._literal_candidates(col_name, val):
+                    if name not in self.literal_rows:
+                        self.literal_rows[name] = row_idx
+                        self.matcher.add(name)
+
+                # Para LOCALIDADES, cada entrada se compara por separado
+                localidades = [l.strip() for l in val.split(',') if l.strip()] if col_name == "LOCALIDADES" else [val]
+                for cand_val in localidades:
+                    cand_val_norm = normalize_text(cand_val)
+                    if not cand_val_norm or len(cand_val_norm) < MIN_NAME_LEN:
+                        continue
+                    self.fuzzy_names.setdefault(cand_val_norm, row_idx)
+        self.matcher.build()
+        self.fuzzy_index = FuzzyIndex(list(self.fuzzy_names), SIMILARITY_THRESHOLD)
+        self._fuzzy_rows = list(self.fuzzy_names.values())
+
+    @staticmethod
+    def _literal_candidates(col_name: str, val: str) -> List[str]:
+        """Variantes normalizadas de un valor: nombre completo, parte previa a separadores y sin prefijos."""
+        raw = val.strip()
+        primary_cands = [l.strip() for l in raw.split(',') if l.strip()] if col_name == "LOCALIDADES" else [raw]
+        names: List[str] = []
+        for primary in primary_cands:
+            if not primary:
+                continue
+            name_norm_full = normalize_text(primary)
+            if not name_norm_full or len(name_norm_full) < MIN_NAME_LEN:
+                continue
+
+            candidates = [name_norm_full]
+
+            parts = re.split(r"\s*[-–—\(,/+]\s*", primary, maxsplit=1)
+            if parts[0].strip() != primary:
+                part_norm = normalize_text(parts[0].strip())
+                if part_norm and part_norm not in candidates:
+                    candidates.append(part_norm)
+
+            # Quitar prefijos comunes (ej: "municipio de")
+            for prefix in NAME_PREFIXES:
+                prefix_norm = normalize_text(prefix)
+                if name_norm_full.startswith(prefix_norm):
+                    cand = name_norm_full[len(prefix_norm):].strip()
+                    if cand and cand not in candidates:
+                        candidates.append(cand)
+
+            names.extend(c for c in candidates if len(c) >= MIN_NAME_LEN)
+        return names
+
+    def fuzzy_lookup(self, q: str) -> Tuple[Optional[int], float]:
+        """Fila con el valor más parecido a la consulta normalizada y su similitud."""
+        value_id, sim = self.fuzzy_index.best_match(q)
+        if value_id is None:
+            return None, sim
+        return self._fuzzy_rows[value_id], sim
+
+    def find_mentions(self, text_norm: str) -> List[NameMatch]:
+        """Todas las menciones en el texto normalizado, en orden de aparición.
+
+        Las superposiciones se resuelven por la más larga (ej: "san antonio de areco"
+        frente a "san antonio"); a igual longitud gana la fila anterior en la tabla.
+        """
+        found = [
+            NameMatch(start, end, self.matcher.names[name_id], self.literal_rows[self.matcher.names[name_id]])
+            for start, end, name_id in self.matcher.find_all(text_norm)
+        ]
+        found.sort(key=lambda m: (m.start - m.end, m.row, m.start))
+        selected: List[NameMatch] = []
+        for m in found:
+            if all(m.end <= o.start or m.start >= o.end for o in selected):
+                selected.append(m)
+        selected.sort(key=lambda m: m.start)
+        return selected
+
+    def to_snapshot(self) -> Dict[str, Any]:
+        """Estado del índice en tipos básicos: el pickle no depende del nombre de este módulo."""
+        return {
+            "columns": self.columns,
+            "rows": self.rows,
+            "literal_rows": self.literal_rows,
+            "fuzzy_names": self.fuzzy_names,
+            "matcher": vars(self.matcher),
+            "fuzzy_index": vars(self.fuzzy_index),
+        }
+
+    @classmethod
+    def from_snapshot(cls, state: Dict[str, Any]) -> "Gazetteer":
+        """Índice armado desde to_snapshot, sin volver a normalizar ni indexar los nombres."""
+        gazetteer = cls.__new__(cls)
+        gazetteer.columns = state["columns"]
+        gazetteer.rows = state["rows"]
+        gazetteer.literal_rows = state["literal_rows"]
+        gazetteer.fuzzy_names = state["fuzzy_names"]
+        gazetteer.matcher = NameMatcher.__new__(NameMatcher)
+        gazetteer.matcher.__dict__.update(state["matcher"])
+        gazetteer.fuzzy_index = FuzzyIndex.__new__(FuzzyIndex)
+        gazetteer.fuzzy_index.__dict__.update(state["fuzzy_index"])
+        gazetteer._fuzzy_rows = list(gazetteer.fuzzy_names.values())
+        return gazetteer
+
+    def row_by_name(self, name: str) -> Optional[Dict[str, str]]:
+        """Fila de un nombre de municipio/localidad ya conocido (p. ej. el guardado en una sesión)."""
+        row_idx = self.literal_rows.get(normalize_text(name))
+        return self.row(row_idx) if row_idx is not None else None
+
+    def row(self, row_idx: int) -> Dict[str, str]:
+        # Copia para que el llamador no pueda alterar el índice compartido
+        return dict(self.rows[row_idx])
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+
+def load_gazetteer() -> Gazetteer:
+    """Lee la tabla municipios completa una sola vez y construye el índice."""
+    try:
+        conn = get_db_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT * FROM municipios")
+            rows = cur.fetchall()
+            cols = [d[0] for d in cur.description]
+        finally:
             conn.close()
-        except:
-            pass
+    except Exception as e:
+        app.logger.exception("Error leyendo municipios para el índice RAG: %s", e)
+        return Gazetteer([], [])
+
+    data = [
+        {cols[i]: (str(r[i]) if r[i] is not None else "") for i in range(len(cols))}
+        for r in rows
+    ]
+    gazetteer = Gazetteer(cols, data)
+    app.logger.info(
+        "Índice RAG construido: %d filas, %d nombres literales, %d nombres difusos.",
+        len(gazetteer), len(gazetteer.literal_rows), len(gazetteer.fuzzy_names),
+    )
+    return gazetteer
+
+
+def gazetteer_snapshot_key() -> Optional[str]:
+    """Identifica el índice que saldría de la base actual: contenido de municipios.db y parámetros de indexado."""
+    try:
+        with open(DB_NAME, "rb") as f:
+            db_hash = hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+    params = [GAZETTEER_SNAPSHOT_VERSION, db_hash, SEARCH_COLS, NAME_PREFIXES, MIN_NAME_LEN, SIMILARITY_THRESHOLD]
+    return hashlib.sha256(json.dumps(params).encode("utf-8")).hexdigest()
+
+
+def read_gazetteer_snapshot(path: str, key: str) -> Optional[Gazetteer]:
+    """Índice guardado en path si corresponde a key; None si falta, es de otra versión o está dañado.
+
+    El archivo son dos pickles seguidos: una cabecera chica (que se compara antes de leer el resto)
+    y el estado del índice.
+    """
+    try:
+        with open(path, "rb") as f:
+            header = pickle.load(f)
+            if not isinstance(header, dict) or header.get("key") != key:
+                return None
+            return Gazetteer.from_snapshot(pickle.load(f))
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        app.logger.warning("Snapshot del índice RAG ilegible en %s, se reconstruye: %s", path, e)
+        return None
+
+
+def write_gazetteer_snapshot(path: str, key: str, gazetteer: Gazetteer):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            pickle.dump({"key": key, "version": GAZETTEER_SNAPSHOT_VERSION, "rows": len(gazetteer)}, f)
+            pickle.dump(gazetteer.to_snapshot(), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        app.logger.warning("No se pudo guardar el snapshot del índice RAG en %s: %s", path, e)
+
+
+def load_or_build_gazetteer() -> Tuple[Gazetteer, str]:
+    """Índice desde el snapshot si coincide con la base; si no, se construye y se guarda el snapshot.
+
+    Devuelve el índice y de dónde salió ("snapshot" o "db").
+    """
+    key = gazetteer_snapshot_key() if GAZETTEER_SNAPSHOT_PATH else None
+    if key is not None:
+        gazetteer = read_gazetteer_snapshot(GAZETTEER_SNAPSHOT_PATH, key)
+        if gazetteer is not None:
+            return gazetteer, "snapshot"
+    gazetteer = load_gazetteer()
+    if key is not None and len(gazetteer):
+        write_gazetteer_snapshot(GAZETTEER_SNAPSHOT_PATH, key, gazetteer)
+    return gazetteer, "db"
+
+
+def _gevent_patched() -> bool:
+    """True si gevent parcheó threading (serve.py): los "hilos" son greenlets del mismo hub."""
+    # Sin gevent.monkey ya importado nada pudo parchearse (y no se paga importar gevent)
+    monkey = sys.modules.get("gevent.monkey")
+    return monkey is not None and monkey.is_module_patched("threading")
+
+
+def native_lock():
+    """Lock del sistema aunque threading esté parcheado, para compartirlo con hilos de run_off_hub."""
+    if _gevent_patched():
+        return sys.modules["gevent.monkey"].get_original("threading", "Lock")()
+    return threading.Lock()
+
+
+def run_off_hub(fn, *args):
+    """Ejecuta fn en un hilo del sistema si corremos bajo gevent.
+
+    Un trabajo de CPU largo (la reconstrucción del índice) dentro de un greenlet no cede el hub
+    y frena todas las consultas del worker; en el threadpool de gevent el hub sigue atendiendo
+    mientras el greenlet que llama espera. Sin gevent se ejecuta directamente.
+    """
+    if not _gevent_patched():
+        return fn(*args)
+    import gevent
+    return gevent.get_hub().threadpool.apply(fn, args)
+
+
+# Índice vigente: se reemplaza entero (asignación atómica), nunca se modifica en el lugar
+_gazetteer: Optional[Gazetteer] = None
+_rag_lock = native_lock()
+_rag_watcher_lock = threading.Lock()
+_rag_watcher_pid: Optional[int] = None
+_rag_state: Dict[str, Any] = {
+    "csv_signature": None, "db_signature": None, "syncs": 0, "last_sync": None,
+    "rebuilds": 0, "last_rebuild_s": None, "last_source": None, "errors": 0,
+}
+
+
+def _file_signature(path: str) -> Optional[tuple]:
+    try:
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size)
+    except OSError:
+        return None
+
+
+def refresh_rag_data() -> bool:
+    """Sincroniza CSV→DB si el CSV cambió y, si la base cambió, publica un índice nuevo.
+
+    El índice se construye aparte y recién después reemplaza al vigente: las consultas
+    siguen usando el anterior mientras tanto. True si se publicó un índice nuevo.
+    """
+    global _gazetteer
+    with _rag_lock:
+        csv_signature = _file_signature(CSV_PATH)
+        if csv_signature != _rag_state["csv_signature"]:
+            try:
+                changes = sync_csv_to_db()
+            except Exception as e:
+                _rag_state["errors"] += 1
+                app.logger.exception("Error sincronizando el CSV de municipios: %s", e)
+            else:
+                _rag_state["csv_signature"] = csv_signature
+                if changes is not None:
+                    _rag_state["syncs"] += 1
+                    _rag_state["last_sync"] = changes
+
+        db_signature = _file_signature(DB_NAME)
+        if _gazetteer is not None and db_signature == _rag_state["db_signature"]:
+            return False
+        started = time.perf_counter()
+        gazetteer, source = load_or_build_gazetteer()
+        _gazetteer = gazetteer
+        _rag_state["db_signature"] = db_signature
+        _rag_state["rebuilds"] += 1
+        _rag_state["last_rebuild_s"] = time.perf_counter() - started
+        _rag_state["last_source"] = source
+        return True
+
+
+def _rag_watch_loop():
+    while True:
+        time.sleep(GAZETTEER_CHECK_INTERVAL)
+        try:
+            run_off_hub(refresh_rag_data)
+        except Exception as e:
+            _rag_state["errors"] += 1
+            app.logger.exception("Error recargando los datos RAG: %s", e)
+
+
+def start_rag_watcher():
+    """Hilo que vigila el CSV y la base de este proceso (los hilos no sobreviven al fork)."""
+    global _rag_watcher_pid
+    with _rag_watcher_lock:
+        if _rag_watcher_pid == os.getpid() or GAZETTEER_CHECK_INTERVAL <= 0:
+            return
+        _rag_watcher_pid = os.getpid()
+    threading.Thread(target=_rag_watch_loop, name="rag-watcher", daemon=True).start()
+
+
+def get_gazetteer() -> Gazetteer:
+    """Devuelve el índice vigente; un hilo aparte lo reconstruye cuando cambian el CSV o municipios.db.
+
+    El primer uso lo carga si warm_start no lo hizo antes.
+    """
+    if _gazetteer is None:
+        refresh_rag_data()
+    if _rag_watcher_pid != os.getpid():
+        start_rag_watcher()
+    return _gazetteer
+
+
+def rag_stats() -> Dict[str, Any]:
+    gazetteer = _gazetteer
+    return {
+        "rows": len(gazetteer) if gazetteer is not None else 0,
+        "syncs": _rag_state["syncs"],
+        "last_sync": _rag_state["last_sync"],
+        "rebuilds": _rag_state["rebuilds"],
+        "last_rebuild_ms": (_rag_state["last_rebuild_s"] or 0.0) * 1000,
+        "last_source": _rag_state["last_source"],
+        "errors": _rag_state["errors"],
+    }
+
+
+def search_municipio(municipio_name: str) -> Optional[Dict[str, str]]:
+    """Búsqueda difusa de municipio, localidad o cabecera en el índice en memoria."""
+    if not municipio_name:
+        return None
+    q = normalize_text(municipio_name)
+    if not q:
+        return None
+
+    try:
+        gazetteer = get_gazetteer()
+        best_row, best_sim = gazetteer.fuzzy_lookup(q)
+
+        if best_row is not None and best_sim >= SIMILARITY_THRESHOLD:
+            return gazetteer.row(best_row)
+        return None
+    except Exception as e:
+        app.logger.exception("Error en search_municipio: %s", e)
+        return None
+
+
+def extract_and_search_municipio(user_text: str) -> Optional[Dict[str, str]]:
+    """Intenta extraer un posible nombre de municipio/localidad/cabecera desde el texto y busca en el índice."""
+    if not user_text:
+        return None
+    text_norm = normalize_text(user_text)
+    words = text_norm.split()
+    candidates: List[str] = []
+
+    # Patrones con preposiciones comunes y sufijos
+    m = re.search(r"\b(?:de|en)\s+(la\s+|el\s+)?([a-z\s]{2,})$", text_norm)
+    if m:
+        tail = m.group(2).strip()
+        tail_words = tail.split()
+        for n in range(3, 0, -1):
+            if len(tail_words) >= n:
+                candidates.append(" ".join(tail_words[-n:]))
+
+    # Sufijos globales del enunciado
+    for n in range(3, 0, -1):
+        if len(words) >= n:
+            candidates.append(" ".join(words[-n:]))
+
+    # Deduplicar manteniendo orden
+    seen = set()
+    uniq_candidates = []
+    for c in candidates:
+        if c not in seen:
+            seen.add(c)
+            uniq_candidates.append(c)
+
+    for cand in uniq_candidates:
+        res = search_municipio(cand)
+        if res:
+            return res
+    return None
+
+
+def find_municipio_in_text(user_text: str) -> Optional[Dict[str, str]]:
+    """Busca municipio/localidad/cabecera mencionado literalmente en el texto del usuario (búsqueda estricta)."""
+    if not user_text:
+        return None
+    text_norm = normalize_text(user_text)
+    try:
+        gazetteer = get_gazetteer()
+        mentions = gazetteer.find_mentions(text_norm)
+        if not mentions:
+            return None
+        # Se prefiere la mención más larga; a igual longitud, la primera fila de la tabla
+        best = min(mentions, key=lambda m: (m.start - m.end, m.row))
+        return gazetteer.row(best.row)
+    except Exception as e:
+        app.logger.exception("Error en find_municipio_in_text: %s", e)
+        return None
+
+
+def find_municipio_mentions(user_text: str) -> List[Dict[str, object]]:
+    """Todas las menciones literales de municipios/localidades con su posición en el texto normalizado."""
+    if not user_text:
+        return []
+    try:
+        gazetteer = get_gazetteer()
+        return [
+            {"name": m.name, "start": m.start, "end": m.end, "municipio": gazetteer.row(m.row)}
+            for m in gazetteer.find_mentions(normalize_text(user_text))
+        ]
+    except Exception as e:
+        app.logger.exception("Error en find_municipio_mentions: %s", e)
+        return []
+
+
+# -----------------------------------------------------------------------------
+# Ollama Call
+# -----------------------------------------------------------------------------
+class OllamaBackend:
+    """Un servidor Ollama: sesión con conexiones persistentes, carga actual, latencia y circuit breaker.
+
+    Estados del breaker: "closed" (en rotación), "open" (expulsado por fallos seguidos hasta que
+    pase el cooldown o lo recupere el sondeo) y "half_open" (una sola petición de prueba en curso).
+    """
+
+    def __init__(self, url: str, pool_size: int):
+        self.url = url
+        self.pool_size = pool_size
+        self.session = self._new_session()
+        self.outstanding = 0
+        self.latency_ewma: Optional[float] = None
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.consecutive_failures = 0
+        self.requests = 0
+        self.failures = 0
+        self.last_error: Optional[str] = None
+        self.warm = False
+        self.warmup_s: Optional[float] = None
+        self.last_used = time.monotonic()
+
+    def _new_session(self) -> requests.Session:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def cost(self) -> float:
+        # Menos peticiones en curso primero, ponderado por la latencia observada
+        return (self.outstanding + 1) * (self.latency_ewma or 1.0)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "url": self.url,
+            "state": self.state,
+            "outstanding": self.outstanding,
+            "latency_ewma_s": self.latency_ewma,
+            "requests": self.requests,
+            "failures": self.failures,
+            "consecutive_failures": self.consecutive_failures,
+            "last_error": self.last_error,
+            "warm": self.warm,
+            "warmup_s": self.warmup_s,
+        }
+
+
+class OllamaRouter:
+    """Reparte las llamadas entre OLLAMA_ENDPOINTS: menor carga ponderada por latencia, sin los expulsados.
+
+    La carga y el breaker son por proceso; el desempate entre endpoints equivalentes sigue la
+    rotación global de _next_endpoint_start. Al arrancar (start()) precarga el modelo en todos
+    los endpoints y después los sondea y mantiene el modelo cargado en los que no tienen tráfico.
+    """
+
+    def __init__(self, urls: List[str], pool_size: int, failures: int, cooldown: float,
+                 health_interval: float, health_timeout: float,
+                 warmup: bool, warmup_timeout: float, keepalive_touch: float):
+        self.backends = [OllamaBackend(url, pool_size) for url in urls]
+        self.max_failures = max(1, failures)
+        self.cooldown = cooldown
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.warmup = warmup
+        self.warmup_timeout = warmup_timeout
+        self.keepalive_touch = keepalive_touch
+        self.warmup_done = not warmup
+        self.warmup_s: Optional[float] = None
+        self._lock = threading.Lock()
+        self._pid: Optional[int] = None
+
+    def start(self):
+        """Arranca precarga y sondeo en este proceso (una vez; de nuevo en cada worker tras el fork)."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None:
+                # Las conexiones del padre no se comparten con el hijo
+                for backend in self.backends:
+                    backend.session = backend._new_session()
+                    backend.outstanding = 0
+            self._pid = os.getpid()
+        if self.backends:
+            threading.Thread(target=self._background, name="ollama-health", daemon=True).start()
+
+    def candidates(self) -> List[OllamaBackend]:
+        """Endpoints en orden de preferencia; los expulsados van al final como último recurso."""
+        self.start()
+        n = len(self.backends)
+        if n == 0:
+            return []
+        start = _next_endpoint_start(n)
+        now = time.monotonic()
+        available, ejected = [], []
+        with self._lock:
+            for i in range(n):
+                backend = self.backends[(start + i) % n]
+                if backend.state == "open" and now - backend.opened_at >= self.cooldown:
+                    backend.state = "half_open"
+                    available.append(backend)
+                elif backend.state == "closed":
+                    available.append(backend)
+                else:
+                    ejected.append(backend)
+            available.sort(key=OllamaBackend.cost)
+        return available + ejected
+
+    def begin(self, backend: OllamaBackend) -> float:
+        now = time.monotonic()
+        with self._lock:
+            backend.outstanding += 1
+            backend.requests += 1
+            backend.last_used = now
+        return now
+
+    def end(self, backend: OllamaBackend, started: float, error: Optional[BaseException] = None):
+        elapsed = time.monotonic() - started
+        with self._lock:
+            backend.outstanding = max(0, backend.outstanding - 1)
+            if error is None:
+                self._record_success(backend, elapsed)
+            else:
+                self._record_failure(backend, error)
+
+    def release(self, backend: OllamaBackend):
+        """Libera el lugar sin éxito ni fallo: el cliente abandonó la consulta a mitad de camino."""
+        with self._lock:
+            backend.outstanding = max(0, backend.outstanding - 1)
+
+    def _record_success(self, backend: OllamaBackend, elapsed: Optional[float]):
+        if elapsed is not None:
+            backend.latency_ewma = elapsed if backend.latency_ewma is None else 0.8 * backend.latency_ewma + 0.2 * elapsed
+        if backend.state != "closed":
+            app.logger.warning("Ollama en %s vuelve a la rotación", backend.url)
+        backend.state = "closed"
+        backend.consecutive_failures = 0
+
+    def _record_failure(self, backend: OllamaBackend, error: BaseException):
+        backend.failures += 1
+        backend.consecutive_failures += 1
+        backend.last_error = str(error)[:200]
+        if backend.state == "half_open" or (
+            backend.state == "closed" and backend.consecutive_failures >= self.max_failures
+        ):
+            if backend.state == "closed":
+                app.logger.warning("Ollama en %s sale de la rotación tras %d fallos: %s",
+                                   backend.url, backend.consecutive_failures, error)
+            backend.state = "open"
+            backend.opened_at = time.monotonic()
+
+    def probe(self, backend: OllamaBackend):
+        try:
+            resp = backend.session.get(f"{backend.url}/api/tags", timeout=self.health_timeout)
+            resp.raise_for_status()
+        except Exception as e:
+            with self._lock:
+                self._record_failure(backend, e)
+            return
+        with self._lock:
+            self._record_success(backend, None)
+
+    def load_model(self, backend: OllamaBackend, timeout: float):
+        """Pide a Ollama que cargue el modelo (chat sin mensajes) y renueva su keep_alive."""
+        payload = {
+            "model": os.getenv("OLLAMA_MODEL", "gemma2:2b"), "messages": [], "keep_alive": ollama_keep_alive(),
+            # El mismo num_ctx que las consultas: si no, la primera consulta recargaría el modelo
+            "options": {"num_ctx": OLLAMA_NUM_CTX},
+        }
+        started = self.begin(backend)
+        try:
+            resp = backend.session.post(f"{backend.url}/api/chat", json=payload, timeout=timeout)
+            resp.raise_for_status()
+        except Exception as e:
+            self.end(backend, started, e)
+            raise
+        with self._lock:
+            backend.outstanding = max(0, backend.outstanding - 1)
+            self._record_success(backend, None)
+            backend.warm = True
+
+    def _warm_backend(self, backend: OllamaBackend, deadline: float):
+        started = time.monotonic()
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                app.logger.error("No se pudo precargar el modelo en %s: %s", backend.url, backend.last_error)
+                return
+            try:
+                self.load_model(backend, remaining)
+                backend.warmup_s = time.monotonic() - started
+                app.logger.warning("Modelo cargado en %s en %.1f s", backend.url, backend.warmup_s)
+                return
+            except Exception:
+                # Ollama puede estar arrancando todavía (depends_on no espera a que responda)
+                time.sleep(min(5.0, max(0.0, deadline - time.monotonic())))
+
+    def _background(self):
+        if self.warmup:
+            started = time.monotonic()
+            deadline = started + self.warmup_timeout
+            threads = [
+                threading.Thread(target=self._warm_backend, args=(backend, deadline), daemon=True)
+                for backend in self.backends
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.warmup_s = time.monotonic() - started
+            self.warmup_done = True
+        self._probe_loop()
+
+    def _probe_loop(self):
+        intervals = [i for i in (self.health_interval, self.keepalive_touch) if i > 0]
+        if not intervals:
+            return
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(min(intervals))
+            now = time.monotonic()
+            for backend in self.backends:
+                if self.keepalive_touch > 0 and backend.warm and now - backend.last_used >= self.keepalive_touch:
+                    # Sin tráfico: volver a tocar el modelo antes de que Ollama lo descargue
+                    try:
+                        self.load_model(backend, self.warmup_timeout)
+                    except Exception:
+                        pass
+                elif self.health_interval > 0 and (backend.state != "closed" or backend.outstanding == 0):
+                    # Un endpoint con tráfico ya informa su salud con cada respuesta
+                    self.probe(backend)
+
+    def ready(self) -> bool:
+        """Listo cuando terminó la precarga y al menos un endpoint tiene el modelo en memoria."""
+        if not self.warmup_done:
+            return False
+        if not self.warmup:
+            return any(backend.state != "open" for backend in self.backends)
+        return any(backend.warm and backend.state != "open" for backend in self.backends)
+
+    def readiness(self) -> Dict[str, Any]:
+        return {
+            "ready": self.ready(),
+            "model": os.getenv("OLLAMA_MODEL", "gemma2:2b"),
+            "keep_alive": OLLAMA_KEEP_ALIVE,
+            "warmup_done": self.warmup_done,
+            "warmup_s": self.warmup_s,
+        }
+
+    def stats(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [backend.stats() for backend in self.backends]
+
+
+def ollama_keep_alive() -> Any:
+    """OLLAMA_KEEP_ALIVE como lo espera Ollama: número de segundos o duración ("30m")."""
+    try:
+        return int(OLLAMA_KEEP_ALIVE)
+    except ValueError:
+        return OLLAMA_KEEP_ALIVE
+
+
+ollama_router = OllamaRouter(
+    OLLAMA_ENDPOINTS, OLLAMA_POOL_SIZE, OLLAMA_BREAKER_FAILURES, OLLAMA_BREAKER_COOLDOWN,
+    OLLAMA_HEALTH_INTERVAL, OLLAMA_HEALTH_TIMEOUT,
+    OLLAMA_WARMUP_ENABLED, OLLAMA_WARMUP_TIMEOUT, OLLAMA_KEEPALIVE_TOUCH,
+)
+
+
+def extract_ollama_content(data: Dict[str, Any]) -> str:
+    """Texto generado dentro de la respuesta (no streaming) de Ollama u otro servidor compatible."""
+    # --- Lógica de Extracción de Contenido de Ollama ---
+    if "message" in data and isinstance(data["message"], dict):
+        content = data["message"].get("content", "")
+        if content:
+            return content.strip()
+
+    if "response" in data and isinstance(data["response"], str):
+        return data["response"].strip()
+
+    if ("choices" in data and isinstance(data["choices"], list) and len(data["choices"]) > 0):
+        first = data["choices"][0]
+        if (isinstance(first, dict) and "message" in first and isinstance(first["message"], dict)):
+            return first["message"].get("content", "").strip()
+
+    return json.dumps(data)
+
+
+# Conteos de tokens y duraciones (ns) que Ollama informa al terminar cada respuesta
+OLLAMA_TIMING_FIELDS = (
+    "prompt_eval_count", "prompt_eval_duration", "eval_count", "eval_duration", "load_duration", "total_duration",
+)
+
+
+def ollama_timings(data: Dict[str, Any]) -> Dict[str, int]:
+    return {k: data[k] for k in OLLAMA_TIMING_FIELDS if isinstance(data.get(k), (int, float))}
+
+
+def call_ollama(
+    messages: List[Dict[str, str]], model: str = "gemma2:2b", timeout: int = 120,
+    meta: Optional[Dict[str, Any]] = None, options: Optional[Dict[str, Any]] = None,
+) -> str:
+    """Llama al endpoint de Ollama y devuelve la respuesta CRUDA de la IA.
+
+    timeout es el presupuesto total de la llamada (reintentos en otros endpoints incluidos);
+    si se agota, Ollama corta la generación al cerrarse la conexión y meta["deadline_exceeded"]
+    queda en True. options son las opciones de generación de Ollama (num_predict, num_ctx, ...).
+    Con OLLAMA_BATCH_ENABLED la petición pasa por el despachador de micro-lotes, que además
+    toma el slot de GPU (y puede lanzar AdmissionRejected); sin él, el slot lo toma quien
+    llama. Si se pasa meta, se completa con los conteos y duraciones que informó Ollama (OLLAMA_TIMING_FIELDS).
+    """
+    if ollama_dispatcher is not None:
+        return ollama_dispatcher.call(messages, model, timeout, meta, options)
+    return _call_ollama_direct(messages, model, timeout, meta, options)
+
+
+def _chat_payload(
+    messages: List[Dict[str, str]], model: str, stream: bool, options: Optional[Dict[str, Any]]
+) -> Dict[str, Any]:
+    # Solicitud estricta de FORMATO JSON para la clasificación
+    payload = {
+        "model": os.getenv("OLLAMA_MODEL", model), "messages": messages, "stream": stream, "format": "json",
+        "keep_alive": ollama_keep_alive(),
+    }
+    if options:
+        payload["options"] = options
+    return payload
+
+
+def _call_ollama_direct(
+    messages: List[Dict[str, str]], model: str, timeout: float,
+    meta: Optional[Dict[str, Any]] = None, options: Optional[Dict[str, Any]] = None,
+) -> str:
+    """Una petición /api/chat, probando los endpoints en el orden que indica ollama_router."""
+    last_error = None
+    backends = ollama_router.candidates()
+    if not backends:
+        return "No hay endpoints de Ollama configurados."
+
+    deadline = time.monotonic() + timeout
+    payload = _chat_payload(messages, model, False, options)
+    headers = {"Content-Type": "application/json"}
+    for backend in backends:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        url = f"{backend.url}/api/chat"
+        started = ollama_router.begin(backend)
+        try:
+            resp = backend.session.post(url, json=payload, headers=headers, timeout=remaining)
+            resp.raise_for_status()
+            data = resp.json()
+            content = extract_ollama_content(data)
+        except requests.ReadTimeout as e:
+            # Se agotó el presupuesto de la consulta: no vale probar otro endpoint, pero cuenta como
+            # fallo para el breaker (un Ollama colgado no debe sumar éxitos ni bajar su latencia)
+            ollama_router.end(backend, started, e)
+            last_error = e
+            break
+        except Exception as e:
+            ollama_router.end(backend, started, e)
+            last_error = e
+            app.logger.warning("Error contactando a Ollama en %s: %s", backend.url, e)
+            continue
+        ollama_router.end(backend, started)
+        if meta is not None and isinstance(data, dict):
+            meta.update(ollama_timings(data))
+        return content
+    if time.monotonic() >= deadline and meta is not None:
+        meta["deadline_exceeded"] = True
+    return f"No se pudo obtener respuesta de Ollama. Último error: {last_error}"
+
+
+def call_ollama_stream(
+    messages: List[Dict[str, str]], model: str = "gemma2:2b", timeout: int = 120,
+    meta: Optional[Dict[str, Any]] = None, options: Optional[Dict[str, Any]] = None,
+) -> Iterator[str]:
+    """Como call_ollama, pero con "stream": True: devuelve los fragmentos de contenido a medida que llegan.
+
+    Al agotarse timeout deja de leer y cierra la conexión (Ollama corta la generación).
+    """
+    last_error = None
+    backends = ollama_router.candidates()
+    if not backends:
+        yield "No hay endpoints de Ollama configurados."
+        return
+
+    deadline = time.monotonic() + timeout
+    payload = _chat_payload(messages, model, True, options)
+    headers = {"Content-Type": "application/json"}
+    for backend in backends:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        url = f"{backend.url}/api/chat"
+        started = ollama_router.begin(backend)
+        try:
+            resp = backend.session.post(url, json=payload, headers=headers, timeout=remaining, stream=True)
+            resp.raise_for_status()
+        except requests.ReadTimeout as e:
+            ollama_router.end(backend, started, e)
+            last_error = e
+            break
+        except Exception as e:
+            ollama_router.end(backend, started, e)
+            last_error = e
+            app.logger.warning("Error contactando a Ollama en %s: %s", backend.url, e)
+            continue
+
+        # Cerrar la respuesta corta la generación si el cliente se desconecta o vence el plazo
+        stream_error = None
+        finished = False
+        with resp:
+            try:
+                for line in resp.iter_lines():
+                    if time.monotonic() >= deadline:
+                        if meta is not None:
+                            meta["deadline_exceeded"] = True
+                        break
+                    if not line:
+                        continue
+                    try:
+                        data = json.loads(line)
+                    except ValueError:
+                        continue
+                    message = data.get("message")
+                    content = message.get("content", "") if isinstance(message, dict) else data.get("response", "")
+                    if content:
+                        yield content
+                    if data.get("done"):
+                        if meta is not None:
+                            meta.update(ollama_timings(data))
+                        break
+                finished = True
+            except requests.ReadTimeout as e:
+                stream_error = e
+                if meta is not None:
+                    meta["deadline_exceeded"] = True
+            except requests.RequestException as e:
+                stream_error = e
+                app.logger.warning("Stream de Ollama interrumpido en %s: %s", backend.url, e)
+            finally:
+                if finished or stream_error is not None:
+                    ollama_router.end(backend, started, stream_error)
+                else:
+                    # El cliente se desconectó (GeneratorExit en el yield): no dice nada del endpoint
+                    ollama_router.release(backend)
+        return
+    if time.monotonic() >= deadline and meta is not None:
+        meta["deadline_exceeded"] = True
+        return
+    yield f"No se pudo obtener respuesta de Ollama. Último error: {last_error}"
+
+
+class StreamingJSONFields:
+    """Lee incrementalmente el objeto JSON de nivel superior que va generando el modelo.
+
+    feed() devuelve eventos a medida que aparecen los campos:
+    {"event": "delta", "key", "text"} con cada fragmento nuevo de un valor string y
+    {"event": "field", "key", "value"} cuando el valor (string, número o literal) está completo.
+    Los valores anidados (objetos/listas) se emiten completos al cerrarse.
+    """
+
+    def __init__(self):
+        self._state = "start"
+        self._key: List[str] = []
+        self._value: List[str] = []
+        self._delta: List[str] = []
+        self._escape: Optional[str] = None
+        self._depth = 0
+        self._nested_in_string = False
+        self._nested_escape = False
+
+    def _read_string_char(self, ch: str, out: List[str]) -> bool:
+        """Consume un carácter dentro de un string; True si cerró el string."""
+        if self._escape is not None:
+            self._escape += ch
+            if self._escape.startswith("u") and len(self._escape) < 5:
+                return False
+            try:
+                out.append(json.loads('"\\' + self._escape + '"'))
+            except ValueError:
+                out.append(self._escape)
+            self._escape = None
+            return False
+        if ch == "\\":
+            self._escape = ""
+            return False
+        if ch == '"':
+            return True
+        out.append(ch)
+        return False
+
+    def _scalar(self, raw: str) -> Any:
+        try:
+            return json.loads(raw)
+        except ValueError:
+            return raw.strip()
+
+    def feed(self, chunk: str) -> List[Dict[str, Any]]:
+        events: List[Dict[str, Any]] = []
+        for ch in chunk:
+            state = self._state
+            if state == "start":
+                if ch == "{":
+                    self._state = "key_or_end"
+            elif state == "key_or_end":
+                if ch == '"':
+                    self._key = []
+                    self._state = "key"
+                elif ch == "}":
+                    self._state = "done"
+            elif state == "key":
+                if self._read_string_char(ch, self._key):
+                    self._state = "colon"
+            elif state == "colon":
+                if ch == ":":
+                    self._state = "value"
+            elif state == "value":
+                if ch.isspace():
+                    continue
+                self._value = []
+                if ch == '"':
+                    self._delta = []
+                    self._state = "string"
+                elif ch in "{[":
+                    self._value.append(ch)
+                    self._depth = 1
+                    self._nested_in_string = False
+                    self._nested_escape = False
+                    self._state = "nested"
+                else:
+                    self._value.append(ch)
+                    self._state = "scalar"
+            elif state == "string":
+                if self._read_string_char(ch, self._delta):
+                    key = "".join(self._key)
+                    if self._delta:
+                        events.append({"event": "delta", "key": key, "text": "".join(self._delta)})
+                    self._value.extend(self._delta)
+                    self._delta = []
+                    events.append({"event": "field", "key": key, "value": "".join(self._value)})
+                    self._state = "comma_or_end"
+            elif state == "scalar":
+                if ch in ",}":
+                    events.append({"event": "field", "key": "".join(self._key), "value": self._scalar("".join(self._value))})
+                    self._state = "key_or_end" if ch == "," else "done"
+                else:
+                    self._value.append(ch)
+            elif state == "nested":
+                self._value.append(ch)
+                if self._nested_in_string:
+                    if self._nested_escape:
+                        self._nested_escape = False
+                    elif ch == "\\":
+                        self._nested_escape = True
+                    elif ch == '"':
+                        self._nested_in_string = False
+                elif ch == '"':
+                    self._nested_in_string = True
+                elif ch in "{[":
+                    self._depth += 1
+                elif ch in "}]":
+                    self._depth -= 1
+                    if self._depth == 0:
+                        events.append({"event": "field", "key": "".join(self._key), "value": self._scalar("".join(self._value))})
+                        self._state = "comma_or_end"
+            elif state == "comma_or_end":
+                if ch == ",":
+                    self._state = "key_or_end"
+                elif ch == "}":
+                    self._state = "done"
+
+        if self._state == "string" and self._delta:
+            events.append({"event": "delta", "key": "".join(self._key), "text": "".join(self._delta)})
+            self._value.extend(self._delta)
+            self._delta = []
+        return events
+
+
+# -----------------------------------------------------------------------------
+# Extracción del JSON de la salida del modelo
+# -----------------------------------------------------------------------------
+# Sólo se examinan estos caracteres de la salida (num_predict ya la acota; esto cubre el caso sin perfiles)
+MODEL_JSON_MAX_CHARS = int(os.getenv("MODEL_JSON_MAX_CHARS", "20000"))
+
+# Claves de la respuesta del modelo (ver system_prompt.txt); todas se devuelven como string
+MODEL_RESPONSE_SCHEMA: Dict[str, Dict[str, Any]] = {
+    "Clasificacion": {"required": True},
+    "Urgencia": {"required": False},
+    "descripcion_corta": {"required": False},
+    "respuesta_extendida": {"required": False},
+}
+
+_JSON_CLOSERS = {"{": "}", "[": "]"}
+_JSON_ESCAPES = set('"\\/bfnrtu')
+_PY_LITERALS = {"True": "true", "False": "false", "None": "null"}
+_CONTROL_ESCAPES = {"\n": "\\n", "\r": "\\r", "\t": "\\t"}
+_PARTIAL_UNICODE_ESCAPE = re.compile(r"\\u[0-9a-fA-F]{0,3}$")
+
+
+def _scan_json_object(text: str, start: int, repairs: List[str]) -> Tuple[List[str], int]:
+    """Recorre text desde el '{' en start hasta que se cierra el objeto, en una sola pasada.
+
+    Devuelve los textos candidatos (ya reparados) y la posición siguiente al objeto.
+    Reparaciones: comas finales, comillas simples, caracteres de control y escapes inválidos
+    dentro de strings, True/False/None, corchetes cruzados y, si la salida se corta, cierre
+    del string y de los corchetes pendientes (con un segundo candidato que descarta el último
+    miembro incompleto).
+    """
+    out: List[str] = []
+    stack: List[str] = []
+    expect_key = False
+    in_string = False
+    quote = '"'
+    escape = False
+    string_is_key = False
+    token_start = -1
+    # Punto hasta donde todo lo emitido es válido: (largo de out, profundidad de stack)
+    safe = (0, 0)
+    end = min(len(text), start + MODEL_JSON_MAX_CHARS)
+    i = start
+    while i < end:
+        ch = text[i]
+        i += 1
+        if in_string:
+            if escape:
+                escape = False
+                if ch == "'":
+                    # \' no existe en JSON
+                    out[-1] = "'"
+                elif ch in _JSON_ESCAPES:
+                    out.append(ch)
+                else:
+                    out[-1] = "\\\\"
+                    out.append(ch)
+                    repairs.append("invalid_escape")
+            elif ch == "\\":
+                out.append(ch)
+                escape = True
+            elif ch == quote:
+                out.append('"')
+                in_string = False
+                if not string_is_key:
+                    safe = (len(out), len(stack))
+            elif ch == '"':
+                out.append('\\"')
+            elif ch < " ":
+                out.append(_CONTROL_ESCAPES.get(ch) or "\\u%04x" % ord(ch))
+                repairs.append("control_chars")
+            else:
+                out.append(ch)
+            continue
+
+        if token_start >= 0 and not (ch.isalnum() or ch in "+-."):
+            token = "".join(out[token_start:])
+            if token in _PY_LITERALS:
+                out[token_start:] = [_PY_LITERALS[token]]
+                repairs.append("python_literals")
+            token_start = -1
+            safe = (len(out), len(stack))
+
+        if ch == '"' or ch == "'":
+            if ch == "'":
+                repairs.append("single_quotes")
+            in_string = True
+            quote = ch
+            string_is_key = expect_key and stack[-1] == "{"
+            out.append('"')
+        elif ch == "{" or ch == "[":
+            stack.append(ch)
+            out.append(ch)
+            expect_key = ch == "{"
+            safe = (len(out), len(stack))
+        elif ch == "}" or ch == "]":
+            if out[-1] == ",":
+                out.pop()
+                repairs.append("trailing_comma")
+            opener = stack.pop()
+            if _JSON_CLOSERS[opener] != ch:
+                repairs.append("mismatched_brackets")
+            out.append(_JSON_CLOSERS[opener])
+            if not stack:
+                return ["".join(out)], i
+            expect_key = False
+            safe = (len(out), len(stack))
+        elif ch == ":":
+            out.append(ch)
+            expect_key = False
+        elif ch == ",":
+            out.append(ch)
+            expect_key = stack[-1] == "{"
+        elif not ch.isspace():
+            if token_start < 0:
+                token_start = len(out)
+            out.append(ch)
+
+    # Salida cortada (num_predict, plazo o MODEL_JSON_MAX_CHARS) antes de cerrar el objeto
+    repairs.append("truncated")
+    cut = "".join(out[:safe[0]]) + "".join(_JSON_CLOSERS[b] for b in reversed(stack[:safe[1]]))
+    if in_string and string_is_key:
+        return [cut], end
+    if in_string:
+        if escape:
+            out.pop()
+        tail = _PARTIAL_UNICODE_ESCAPE.search("".join(out[-6:]))
+        if tail:
+            del out[len(out) - len(tail.group(0)):]
+        out.append('"')
+    elif token_start >= 0:
+        token = "".join(out[token_start:])
+        out[token_start:] = [_PY_LITERALS.get(token, token)]
+    if out[-1] == ",":
+        out.pop()
+    elif out[-1] == ":":
+        return [cut], end
+    full = "".join(out) + "".join(_JSON_CLOSERS[b] for b in reversed(stack))
+    return [full, cut], end
+
+
+def iter_json_objects(text: str) -> Iterator[Tuple[Any, List[str]]]:
+    """Objetos JSON de nivel superior que aparecen en text, en orden, con las reparaciones aplicadas.
+
+    Cada carácter se examina una sola vez: tras un objeto (válido o no) se sigue desde donde terminó.
+    """
+    pos = 0
+    limit = min(len(text), MODEL_JSON_MAX_CHARS)
+    while pos < limit:
+        start = text.find("{", pos, limit)
+        if start < 0:
+            return
+        repairs: List[str] = []
+        if text[pos:start].strip():
+            repairs.append("surrounding_text")
+        candidates, pos = _scan_json_object(text, start, repairs)
+        for candidate in candidates:
+            try:
+                obj = json.loads(candidate)
+            except ValueError:
+                continue
+            yield obj, list(dict.fromkeys(repairs))
+            break
+
+
+def validate_model_response(obj: Any) -> Optional[Dict[str, Any]]:
+    """Aplica MODEL_RESPONSE_SCHEMA; None si falta una clave requerida o está vacía.
+
+    Los números (p. ej. "Urgencia": 3) se pasan a string, como los devuelve el resto del sistema.
+    """
+    if not isinstance(obj, dict):
+        return None
+    result = dict(obj)
+    for key, spec in MODEL_RESPONSE_SCHEMA.items():
+        value = result.get(key)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            value = str(int(value)) if float(value).is_integer() else str(value)
+            result[key] = value
+        if spec["required"] and not (isinstance(value, str) and value.strip()):
+            return None
+    return result
+
+
+class ModelParseStats:
+    """Resultado y tiempo del parseo de las salidas del modelo (tasa de error_fallback incluida)."""
+
+    def __init__(self, window: int = 1000):
+        self._lock = threading.Lock()
+        self._parse_us: "deque[float]" = deque(maxlen=window)
+        self.outputs = 0
+        self.direct = 0
+        self.repaired = 0
+        self.failed = 0
+        self.by_repair: Dict[str, int] = {}
+
+    def record(self, ok: bool, repairs: Optional[List[str]], elapsed_s: float):
+        with self._lock:
+            self.outputs += 1
+            self._parse_us.append(elapsed_s * 1e6)
+            if not ok:
+                self.failed += 1
+            elif repairs is None:
+                self.direct += 1
+            else:
+                self.repaired += 1
+                for repair in set(repairs):
+                    self.by_repair[repair] = self.by_repair.get(repair, 0) + 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            parse_us = sorted(self._parse_us)
+            return {
+                "outputs": self.outputs,
+                "direct": self.direct,
+                "repaired": self.repaired,
+                "failed": self.failed,
+                "error_fallback_rate": (self.failed / self.outputs) if self.outputs else 0.0,
+                "by_repair": dict(self.by_repair),
+                "parse_us": {"p50": _percentile(parse_us, 0.50), "p99": _percentile(parse_us, 0.99)},
+            }
+
+
+model_parse_stats = ModelParseStats()
+
+
+# -----------------------------------------------------------------------------
+# Micro-batching de clasificaciones hacia Ollama
+# -----------------------------------------------------------------------------
+OLLAMA_BATCH_ENABLED = os.getenv("OLLAMA_BATCH_ENABLED", "false").lower() in ("1", "true", "yes")
+# Espera máxima del primer trabajo de un lote a que lleguen otros
+OLLAMA_BATCH_WINDOW_MS = float(os.getenv("OLLAMA_BATCH_WINDOW_MS", "20"))
+OLLAMA_BATCH_MAX = int(os.getenv("OLLAMA_BATCH_MAX", "8"))
+# Peticiones que cada servidor Ollama procesa a la vez (su OLLAMA_NUM_PARALLEL)
+OLLAMA_NUM_PARALLEL = int(os.getenv("OLLAMA_NUM_PARALLEL", "4"))
+
+
+class BatchJob:
+    """Clasificación pendiente: mensajes, deadline y el Future donde queda la salida cruda."""
+
+    def __init__(self, messages: List[Dict[str, str]], model: str, timeout: float,
+                 meta: Optional[Dict[str, Any]] = None, options: Optional[Dict[str, Any]] = None):
+        self.messages = messages
+        self.model = model
+        self.meta = meta
+        self.options = options
+        self.timeout = timeout
+        self.enqueued = time.monotonic()
+        self.deadline = self.enqueued + timeout
+        self.lease: Optional[str] = None
+        self.future: Future = Future()
+
+
+class OllamaBatchDispatcher:
+    """Junta las clasificaciones pendientes durante una ventana corta y las envía juntas a Ollama.
+
+    Ollama no tiene un endpoint de lotes: agrupa en cada paso las secuencias de sus slots
+    paralelos, así que un lote es una ráfaga de peticiones simultáneas. El despachador llena
+    los slots libres (num_parallel por endpoint, nunca más) y corta
+    cada lote al llenarlo, al vencer la ventana o cuando a un trabajo no le alcanza el deadline
+    para seguir esperando.
+
+    Con admission, el despachador reemplaza a la espera por GPU de /generate: los trabajos
+    esperan acá (hasta max_depth, no más de max_wait) y cada uno se envía con un slot de
+    admission, tomado sólo si no hay consultas en su cola, así el límite sigue siendo global.
+    Sólo lo usa el /generate de Flask (run.py, serve.py); asgi.py va directo a la cola de GPU.
+    """
+
+    def __init__(self, window_s: float, max_batch: int, parallel: int, endpoints: int,
+                 admission: Optional[AdmissionQueue] = None):
+        self.window = window_s
+        self.max_batch = max(1, max_batch)
+        self.capacity = max(1, parallel) * max(1, endpoints)
+        self.admission = admission
+        self._cond = threading.Condition()
+        self._pending: "deque[BatchJob]" = deque()
+        self._inflight = 0
+        self._pid: Optional[int] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self.batches = 0
+        self.jobs = 0
+        self.expired = 0
+        self.rejected = 0
+        self.flushes = {"full": 0, "window": 0, "deadline": 0}
+        self._batch_sizes: "deque[int]" = deque(maxlen=1000)
+        self._queue_ms: "deque[float]" = deque(maxlen=1000)
+
+    def _ensure_started(self):
+        # Con serve.py el módulo se importa antes del fork: cada worker arranca su propio hilo y pool
+        if self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._pending.clear()
+            self._inflight = 0
+            self._executor = ThreadPoolExecutor(max_workers=self.capacity, thread_name_prefix="ollama-batch")
+            threading.Thread(target=self._run, name="ollama-batch-dispatcher", daemon=True).start()
+            self._pid = os.getpid()
+
+    def submit(self, messages: List[Dict[str, str]], model: str, timeout: float,
+               meta: Optional[Dict[str, Any]] = None, options: Optional[Dict[str, Any]] = None) -> Future:
+        self._ensure_started()
+        job = BatchJob(messages, model, timeout, meta, options)
+        with self._cond:
+            if self.admission is not None and len(self._pending) >= self.admission.max_depth:
+                self.rejected += 1
+                raise AdmissionRejected("gpu_queue_full", self._retry_after_locked())
+            self._pending.append(job)
+            self._cond.notify_all()
+        return job.future
+
+    def call(self, messages: List[Dict[str, str]], model: str, timeout: float,
+             meta: Optional[Dict[str, Any]] = None, options: Optional[Dict[str, Any]] = None) -> str:
+        """Equivalente bloqueante de call_ollama: devuelve la salida cruda o el texto de error.
+
+        Lanza AdmissionRejected si no hay lugar en la cola o no consiguió slot a tiempo.
+        """
+        try:
+            return self.submit(messages, model, timeout, meta, options).result()
+        except AdmissionRejected:
+            raise
+        except TimeoutError as e:
+            if meta is not None:
+                meta["deadline_exceeded"] = True
+            return f"No se pudo obtener respuesta de Ollama. Último error: {e}"
+        except Exception as e:
+            return f"No se pudo obtener respuesta de Ollama. Último error: {e}"
+
+    def _retry_after_locked(self) -> int:
+        return self.admission.stats()["retry_after_s"] if self.admission is not None else 1
+
+    def _reject_stale_locked(self, now: float):
+        """Saca de la cola los trabajos que esperaron slot más de admission.max_wait."""
+        if self.admission is None:
+            return
+        while self._pending and now - self._pending[0].enqueued >= self.admission.max_wait:
+            job = self._pending.popleft()
+            self.rejected += 1
+            job.future.set_exception(AdmissionRejected("gpu_queue_timeout", self._retry_after_locked()))
+
+    def _take_leases(self, n: int) -> List[str]:
+        leases: List[str] = []
+        while len(leases) < n:
+            lease = self.admission.try_admit_now()
+            if lease is None:
+                break
+            leases.append(lease)
+        return leases
+
+    def _next_batch(self) -> List[BatchJob]:
+        with self._cond:
+            while True:
+                while not self._pending or self._inflight >= self.capacity:
+                    self._cond.wait()
+                now = time.monotonic()
+                self._reject_stale_locked(now)
+                if not self._pending:
+                    continue
+                room = min(self.max_batch, self.capacity - self._inflight)
+                flush_at = self._pending[0].enqueued + self.window
+                urgent_at = min(job.deadline for job in self._pending) - self.window
+                if len(self._pending) >= room:
+                    reason = "full"
+                elif now >= urgent_at:
+                    reason = "deadline"
+                elif now >= flush_at:
+                    reason = "window"
+                else:
+                    self._cond.wait(min(flush_at, urgent_at) - now)
+                    continue
+                size = min(room, len(self._pending))
+                leases: List[Optional[str]] = [None] * size
+                if self.admission is not None:
+                    leases = self._take_leases(size)
+                    if not leases:
+                        # Slots ocupados (por este u otro worker): se reintenta como la cola de admisión
+                        self._cond.wait(self.admission.poll)
+                        continue
+                batch = [self._pending.popleft() for _ in range(len(leases))]
+                for job, lease in zip(batch, leases):
+                    job.lease = lease
+                    if lease is not None:
+                        # Como en /generate, la espera por el slot no descuenta del plazo de generación
+                        job.deadline = now + job.timeout
+                self._inflight += len(batch)
+                self.flushes[reason] += 1
+                return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            now = time.monotonic()
+            self.batches += 1
+            self.jobs += len(batch)
+            self._batch_sizes.append(len(batch))
+            for job in batch:
+                self._queue_ms.append((now - job.enqueued) * 1000)
+                if job.deadline <= now:
+                    self.expired += 1
+                    job.future.set_exception(TimeoutError("deadline vencido en la cola de lotes"))
+                    self._job_done(job)
+                    continue
+                self._executor.submit(self._execute, job)
+
+    def _execute(self, job: BatchJob):
+        try:
+            timeout = max(0.1, job.deadline - time.monotonic())
+            job.future.set_result(_call_ollama_direct(job.messages, job.model, timeout, job.meta, job.options))
+        except Exception as e:
+            job.future.set_exception(e)
+        finally:
+            self._job_done(job)
+
+    def _job_done(self, job: BatchJob):
+        if job.lease is not None:
+            try:
+                self.admission.release(job.lease)
+            except Exception:
+                app.logger.exception("No se pudo liberar el slot de GPU %s", job.lease)
+            job.lease = None
+        with self._cond:
+            self._inflight -= 1
+            self._cond.notify_all()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            pending = len(self._pending)
+            in_flight = self._inflight
+            sizes = list(self._batch_sizes)
+            queue_ms = sorted(self._queue_ms)
+        return {
+            "enabled": True,
+            "window_ms": self.window * 1000,
+            "max_batch": self.max_batch,
+            "capacity": self.capacity,
+            "pending": pending,
+            "in_flight": in_flight,
+            "batches": self.batches,
+            "jobs": self.jobs,
+            "expired": self.expired,
+            "rejected": self.rejected,
+            "flushes": dict(self.flushes),
+            "avg_batch_size": (sum(sizes) / len(sizes)) if sizes else 0.0,
+            "queue_ms": {"p50": _percentile(queue_ms, 0.50), "p99": _percentile(queue_ms, 0.99)},
+        }
+
+
+ollama_dispatcher: Optional[OllamaBatchDispatcher] = None
+if OLLAMA_BATCH_ENABLED:
+    ollama_dispatcher = OllamaBatchDispatcher(
+        OLLAMA_BATCH_WINDOW_MS / 1000.0, OLLAMA_BATCH_MAX, OLLAMA_NUM_PARALLEL, len(OLLAMA_ENDPOINTS), gpu_admission
+    )
+
+
+# -----------------------------------------------------------------------------
+# Prompt / sistema
+# -----------------------------------------------------------------------------
+def load_system_prompt() -> str:
+    try:
+        with open("system_prompt.txt", "r", encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        return "ERROR: system_prompt.txt no encontrado. No se puede clasificar."
+
+
+# Se cargan en el primer uso (o en warm_start) y se recargan al guardar el prompt
+SYSTEM_PROMPT: Optional[str] = None
+PROMPT_PREFIX: Optional[Dict[str, Any]] = None
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimación barata (~4 caracteres por token) para comparar prefijo y sufijo sin el tokenizador del modelo."""
+    return math.ceil(len(text) / 4) if text else 0
+
+
+def build_prompt_prefix(system_prompt: str) -> Dict[str, Any]:
+    """Prefijo común a todas las consultas: va primero y es idéntico byte a byte entre peticiones.
+
+    Ollama conserva en cada slot el KV cache del último prompt y sólo evalúa lo que cambia
+    desde el primer token distinto; todo lo variable (contexto municipal, texto del usuario)
+    tiene que ir después de este prefijo.
+    """
+    content = system_prompt.replace("\r\n", "\n").strip()
+    return {
+        "messages": ({"role": "system", "content": content},),
+        "tokens": estimate_tokens(content),
+        "sha256": hashlib.sha256(content.encode("utf-8")).hexdigest(),
+    }
+
+
+def reload_system_prompt():
+    """Lee system_prompt.txt y publica el prompt y su prefijo juntos."""
+    global SYSTEM_PROMPT, PROMPT_PREFIX
+    system_prompt = load_system_prompt()
+    PROMPT_PREFIX = build_prompt_prefix(system_prompt)
+    SYSTEM_PROMPT = system_prompt
+
+
+def get_system_prompt() -> str:
+    if SYSTEM_PROMPT is None:
+        reload_system_prompt()
+    return SYSTEM_PROMPT
+
+
+def get_prompt_prefix() -> Dict[str, Any]:
+    if PROMPT_PREFIX is None:
+        reload_system_prompt()
+    return PROMPT_PREFIX
+
+
+# -----------------------------------------------------------------------------
+# Respuestas por reglas (sin LLM)
+# -----------------------------------------------------------------------------
+RULES_ENABLED = os.getenv("RULES_ENABLED", "true").lower() in ("1", "true", "yes")
+# Consultas más largas suelen tener matices que conviene dejar al modelo
+RULES_MAX_WORDS = int(os.getenv("RULES_MAX_WORDS", "15"))
+
+# "escriturar" aparece en casi toda consulta; no alcanza para decidir que se piden requisitos
+_REQUISITOS_ESTRICTOS = [kw for kw in KEYWORDS_REQUISITOS if kw != "escriturar"]
+
+
+def _rule_requisitos(text: str, municipio: Optional[Dict[str, str]]) -> Optional[Dict[str, str]]:
+    if not contains_any_keyword(text, _REQUISITOS_ESTRICTOS):
+        return None
+    if contains_any_keyword(text, KEYWORDS_BENEFICIOS) or contains_any_keyword(text, KEYWORDS_DIRECCIONES):
+        return None
+    return {
+        "Urgencia": "2",
+        "Clasificacion": "ESCRITURACIÓN",
+        "descripcion_corta": "Requisitos para escriturar la vivienda.",
+        "respuesta_extendida": REQUISITES_STRING,
+    }
+
+
+def _rule_beneficios(text: str, municipio: Optional[Dict[str, str]]) -> Optional[Dict[str, str]]:
+    if not contains_any_keyword(text, KEYWORDS_BENEFICIOS):
+        return None
+    if contains_any_keyword(text, _REQUISITOS_ESTRICTOS) or contains_any_keyword(text, KEYWORDS_DIRECCIONES):
+        return None
+    return {
+        "Urgencia": "1",
+        "Clasificacion": "BENEFICIOS",
+        "descripcion_corta": "Beneficios de escriturar la vivienda.",
+        "respuesta_extendida": BENEFITS_STRING,
+    }
+
+
+def _rule_direcciones(text: str, municipio: Optional[Dict[str, str]]) -> Optional[Dict[str, str]]:
+    if not municipio or not contains_any_keyword(text, KEYWORDS_DIRECCIONES):
+        return None
+    if contains_any_keyword(text, KEYWORDS_BENEFICIOS) or contains_any_keyword(text, _REQUISITOS_ESTRICTOS):
+        return None
+    return {
+        "Urgencia": "2",
+        "Clasificacion": "CONTACTO",
+        "descripcion_corta": f"Datos de la oficina de {MunicipioNameFromDict(municipio)}.",
+        "respuesta_extendida": format_municipio_data(municipio),
+    }
+
+
+# Se evalúan en orden; la primera que responde gana
+FAST_PATH_RULES = [
+    ("requisitos", _rule_requisitos),
+    ("beneficios", _rule_beneficios),
+    ("direcciones", _rule_direcciones),
+]
+
+_rules_lock = threading.Lock()
+_rules_stats: Dict[str, Any] = {"checked": 0, "hits": 0, "by_rule": {name: 0 for name, _ in FAST_PATH_RULES}}
+
+
+def apply_fast_path_rules(user_prompt: str, municipio: Optional[Dict[str, str]]) -> Optional[Dict[str, str]]:
+    """Clasificación determinística para consultas que se responden con los textos predefinidos."""
+    if not RULES_ENABLED:
+        return None
+    content = None
+    rule_name = None
+    if len(user_prompt.split()) <= RULES_MAX_WORDS:
+        for rule_name, rule in FAST_PATH_RULES:
+            content = rule(user_prompt, municipio)
+            if content is not None:
+                break
+    with _rules_lock:
+        _rules_stats["checked"] += 1
+        if content is not None:
+            _rules_stats["hits"] += 1
+            _rules_stats["by_rule"][rule_name] += 1
+    if content is None:
+        return None
+    content["respuesta_extendida"] = sanitize_html(content["respuesta_extendida"])
+    return content
+
+
+def rules_stats() -> Dict[str, Any]:
+    with _rules_lock:
+        checked = _rules_stats["checked"]
+        return {
+            "enabled": RULES_ENABLED,
+            "checked": checked,
+            "hits": _rules_stats["hits"],
+            "hit_rate": (_rules_stats["hits"] / checked) if checked else 0.0,
+            "by_rule": dict(_rules_stats["by_rule"]),
+        }
+
+
+# -----------------------------------------------------------------------------
+# Caché de respuestas
+# -----------------------------------------------------------------------------
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1024"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+
+
+class ResponseCache:
+    """Caché LRU con expiración (TTL) de clasificaciones ya parseadas, segura entre hilos."""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        if self.max_size <= 0:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at <= now:
+                del self._data[key]
+                self.evictions += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: str, value: Any):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+
+
+def response_cache_key(
+    user_prompt: str, municipio: Optional[Dict[str, str]], system_prompt: str, history: str = ""
+) -> str:
+    """Hash del prompt normalizado, la fila de municipio detectada, el prompt de sistema y el historial enviado."""
+    parts: List[Any] = [normalize_text(user_prompt), municipio or {}, system_prompt]
+    if history:
+        parts.append(history)
+    material = json.dumps(parts, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+# -----------------------------------------------------------------------------
+# Caché semántica (paráfrasis de consultas ya respondidas)
+# -----------------------------------------------------------------------------
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+SEMANTIC_CACHE_MAX = int(os.getenv("SEMANTIC_CACHE_MAX", "5000"))
+SEMANTIC_CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH", "semantic_cache.npz")
+SEMANTIC_CACHE_SAVE_EVERY = int(os.getenv("SEMANTIC_CACHE_SAVE_EVERY", "20"))
+# "hashing" (determinístico, sin dependencias) u "ollama" (modelo de embeddings local)
+SEMANTIC_CACHE_EMBEDDER = os.getenv("SEMANTIC_CACHE_EMBEDDER", "hashing")
+OLLAMA_EMBED_MODEL = os.getenv("OLLAMA_EMBED_MODEL", "nomic-embed-text")
+
+
+class HashingEmbedder:
+    """Vectorizador por hashing de palabras y trigramas de caracteres (determinístico entre reinicios)."""
+
+    name = "hashing"
+
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+
+    def _features(self, text: str) -> List[Tuple[str, float]]:
+        feats: List[Tuple[str, float]] = []
+        for word in normalize_text(text).split():
+            feats.append(("w:" + word, 1.0))
+            padded = f" {word} "
+            for i in range(len(padded) - 2):
+                feats.append(("c:" + padded[i:i + 3], 0.5))
+        return feats
+
+    def embed(self, text: str) -> "np.ndarray":
+        import numpy as np
+        vec = np.zeros(self.dim, dtype=np.float32)
+        for feat, weight in self._features(text):
+            h = zlib.crc32(feat.encode("utf-8"))
+            sign = 1.0 if h & 0x80000000 else -1.0
+            vec[h % self.dim] += sign * weight
+        norm = float(np.linalg.norm(vec))
+        return vec / norm if norm else vec
+
+
+class OllamaEmbedder:
+    """Embeddings con un modelo local servido por Ollama (/api/embed)."""
+
+    name = "ollama"
+
+    def __init__(self, model: str, timeout: int = 10):
+        self.model = model
+        self.timeout = timeout
+
+    def embed(self, text: str) -> "np.ndarray":
+        """Embedding del texto por el primer endpoint sano, con el mismo circuit breaker que /api/chat.
+
+        A diferencia del chat, no se prueba un endpoint expulsado: sin embedding la consulta
+        sólo pierde la caché semántica.
+        """
+        import numpy as np
+        last_error: Optional[BaseException] = None
+        for backend in ollama_router.candidates():
+            if backend.state == "open":
+                continue
+            started = ollama_router.begin(backend)
+            try:
+                resp = backend.session.post(
+                    f"{backend.url}/api/embed",
+                    json={"model": self.model, "input": text},
+                    timeout=self.timeout,
+                )
+                resp.raise_for_status()
+                vec = np.asarray(resp.json()["embeddings"][0], dtype=np.float32)
+            except Exception as e:
+                ollama_router.end(backend, started, e)
+                last_error = e
+                continue
+            ollama_router.end(backend, started)
+            norm = float(np.linalg.norm(vec))
+            return vec / norm if norm else vec
+        raise RuntimeError(f"No hay endpoint de Ollama disponible para embeddings. Último error: {last_error}")
+
+
+def make_embedder(kind: str):
+    if kind == "ollama":
+        return OllamaEmbedder(OLLAMA_EMBED_MODEL)
+    return HashingEmbedder()
+
+
+class SemanticCache:
+    """Índice vectorial de respuestas previas: una matriz contigua float32 y un producto punto por consulta.
+
+    Al llenarse reemplaza la entrada más antigua. El municipio de cada fila está además como
+    entero en un arreglo paralelo, así el filtro por municipio también es una sola comparación
+    vectorizada. Se persiste en disco (.npz) cada SEMANTIC_CACHE_SAVE_EVERY altas y se recarga
+    al iniciar.
+    """
+
+    def __init__(self, embedder, threshold: float, max_entries: int, path: Optional[str] = None,
+                 save_every: int = 20, fingerprint: str = ""):
+        self.embedder = embedder
+        # Huella del prompt de sistema con el que se generaron las respuestas guardadas
+        self.fingerprint = fingerprint
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.path = path
+        self.save_every = save_every
+        self._lock = threading.Lock()
+        self._matrix: Optional["np.ndarray"] = None
+        self._municipios: List[str] = []
+        # Id de municipio por fila de _matrix y el id asignado a cada clave de municipio
+        self._municipio_ids: Optional["np.ndarray"] = None
+        self._municipio_id: Dict[str, int] = {}
+        self._values: List[Any] = []
+        self._next = 0
+        self._unsaved = 0
+        self.hits = 0
+        self.misses = 0
+        if path:
+            self.load()
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def embed(self, text: str) -> "np.ndarray":
+        return self.embedder.embed(text)
+
+    def lookup(self, vec: "np.ndarray", municipio_key: str) -> Optional[Any]:
+        """Respuesta guardada más similar con el mismo municipio, si supera el umbral."""
+        import numpy as np
+        with self._lock:
+            n = len(self._values)
+            if self._matrix is None or n == 0 or vec.shape[0] != self._matrix.shape[1]:
+                self.misses += 1
+                return None
+            municipio_id = self._municipio_id.get(municipio_key)
+            if municipio_id is None:
+                self.misses += 1
+                return None
+            sims = self._matrix[:n] @ vec
+            sims = np.where(self._municipio_ids[:n] == municipio_id, sims, -1.0)
+            best = int(np.argmax(sims))
+            if sims[best] >= self.threshold:
+                self.hits += 1
+                return self._values[best]
+            self.misses += 1
+            return None
+
+    def add(self, vec: "np.ndarray", municipio_key: str, value: Any):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            if self._matrix is None or vec.shape[0] != self._matrix.shape[1]:
+                self._reset(vec.shape[0])
+            if len(self._values) < self.max_entries:
+                slot = len(self._values)
+                self._municipios.append(municipio_key)
+                self._values.append(value)
+            else:
+                slot = self._next
+                self._municipios[slot] = municipio_key
+                self._values[slot] = value
+            self._matrix[slot] = vec
+            self._municipio_ids[slot] = self._municipio_id.setdefault(municipio_key, len(self._municipio_id))
+            self._next = (slot + 1) % self.max_entries
+            self._unsaved += 1
+            should_save = self.path and self._unsaved >= self.save_every
+        if should_save:
+            self.save()
+
+    def _reset(self, dim: int):
+        import numpy as np
+        self._matrix = np.zeros((self.max_entries, dim), dtype=np.float32)
+        self._municipio_ids = np.full(self.max_entries, -1, dtype=np.int32)
+        self._municipio_id = {}
+        self._municipios = []
+        self._values = []
+        self._next = 0
+
+    def clear(self):
+        with self._lock:
+            self._matrix = None
+            self._municipio_ids = None
+            self._municipio_id = {}
+            self._municipios = []
+            self._values = []
+            self._next = 0
+            self._unsaved = 0
+        if self.path and os.path.exists(self.path):
+            try:
+                os.remove(self.path)
+            except OSError as e:
+                app.logger.warning("No se pudo borrar la caché semántica %s: %s", self.path, e)
+
+    def save(self):
+        with self._lock:
+            if self._matrix is None or not self.path:
+                return
+            n = len(self._values)
+            matrix = self._matrix[:n].copy()
+            meta = json.dumps({
+                "embedder": self.embedder.name,
+                "fingerprint": self.fingerprint,
+                "municipios": self._municipios,
+                "values": self._values,
+                "next": self._next,
+            }, ensure_ascii=False)
+            self._unsaved = 0
+        tmp_path = self.path + ".tmp.npz"
+        import numpy as np
+        try:
+            np.savez(tmp_path, embeddings=matrix, meta=np.array(meta))
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            app.logger.warning("No se pudo guardar la caché semántica en %s: %s", self.path, e)
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        import numpy as np
+        try:
+            with np.load(self.path, allow_pickle=False) as data:
+                matrix = data["embeddings"]
+                meta = json.loads(str(data["meta"]))
+        except Exception as e:
+            app.logger.warning("Caché semántica ilegible en %s, se ignora: %s", self.path, e)
+            return
+        if meta.get("embedder") != self.embedder.name or meta.get("fingerprint") != self.fingerprint:
+            app.logger.info("Caché semántica generada con otro embedder o prompt de sistema; se descarta.")
+            return
+        n = min(len(meta["values"]), self.max_entries)
+        if n == 0:
+            return
+        with self._lock:
+            self._reset(matrix.shape[1])
+            self._matrix[:n] = matrix[:n]
+            self._municipios = meta["municipios"][:n]
+            for slot, municipio_key in enumerate(self._municipios):
+                self._municipio_ids[slot] = self._municipio_id.setdefault(municipio_key, len(self._municipio_id))
+            self._values = meta["values"][:n]
+            self._next = meta.get("next", n) % self.max_entries
+        app.logger.info("Caché semántica cargada: %d entradas.", n)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": True,
+                "embedder": self.embedder.name,
+                "size": len(self._values),
+                "max_size": self.max_entries,
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+semantic_cache: Optional[SemanticCache] = None
+if SEMANTIC_CACHE_ENABLED:
+    semantic_cache = SemanticCache(
+        make_embedder(SEMANTIC_CACHE_EMBEDDER),
+        SEMANTIC_CACHE_THRESHOLD,
+        SEMANTIC_CACHE_MAX,
+        path=SEMANTIC_CACHE_PATH,
+        save_every=SEMANTIC_CACHE_SAVE_EVERY,
+        fingerprint=hashlib.sha256(get_system_prompt().encode("utf-8")).hexdigest(),
+    )
+    atexit.register(semantic_cache.save)
+
+
+# -----------------------------------------------------------------------------
+# Coalescencia de consultas idénticas en vuelo (single-flight)
+# -----------------------------------------------------------------------------
+COALESCE_ENABLED = os.getenv("COALESCE_ENABLED", "true").lower() in ("1", "true", "yes")
+# Espera máxima de un seguidor; pasado ese tiempo genera por su cuenta (líder colgada)
+COALESCE_MAX_WAIT = float(os.getenv("COALESCE_MAX_WAIT", "180"))
+
+
+class InFlightCall:
+    """Generación en curso; las consultas idénticas que llegan mientras tanto esperan su resultado.
+
+    Al terminar queda la salida cruda del modelo (result), la excepción de la líder (error),
+    o ninguna de las dos si la líder abandonó (cliente desconectado): en ese caso los
+    seguidores vuelven a competir por generar. deadline_exceeded indica que la salida quedó
+    cortada por el plazo del perfil, para que los seguidores respondan igual que la líder.
+    """
+
+    def __init__(self, key: Optional[str]):
+        self.key = key
+        self.result: Optional[str] = None
+        self.error: Optional[BaseException] = None
+        self.deadline_exceeded = False
+        self.followers = 0
+        self._done = threading.Event()
+        self._callbacks: List[Any] = []
+        self._lock = threading.Lock()
+
+    def _set(self, result: Optional[str], error: Optional[BaseException], deadline_exceeded: bool = False):
+        with self._lock:
+            if self._done.is_set():
+                return
+            self.result = result
+            self.error = error
+            self.deadline_exceeded = deadline_exceeded
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn()
+
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def add_done_callback(self, fn):
+        """fn() se llama (desde el hilo de la líder) al terminar; en el acto si ya terminó."""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        fn()
+
+    def outcome(self) -> Optional[str]:
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self._done.wait(timeout)
+
+
+class SingleFlight:
+    """Registro de generaciones en vuelo por clave de caché (prompt normalizado, RAG y SYSTEM_PROMPT)."""
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self._calls: Dict[str, InFlightCall] = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+        self.abandoned = 0
+
+    def join(self, key: Optional[str]) -> Tuple[InFlightCall, bool]:
+        """Devuelve (call, True) si esta consulta debe generar, o (call, False) para esperar a otra."""
+        if not self.enabled or key is None:
+            return InFlightCall(None), True
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.followers += 1
+                self.coalesced += 1
+                return call, False
+            call = InFlightCall(key)
+            self._calls[key] = call
+            self.leaders += 1
+            return call, True
+
+    def _finish(self, call: InFlightCall, result: Optional[str], error: Optional[BaseException],
+                deadline_exceeded: bool = False):
+        with self._lock:
+            if call.key is not None and self._calls.get(call.key) is call:
+                del self._calls[call.key]
+        call._set(result, error, deadline_exceeded)
+
+    def complete(self, call: InFlightCall, result: str, deadline_exceeded: bool = False):
+        self._finish(call, result, None, deadline_exceeded)
+
+    def fail(self, call: InFlightCall, error: BaseException):
+        self._finish(call, None, error)
+
+    def abandon(self, call: InFlightCall):
+        """Cierra sin resultado; no hace nada si call ya terminó."""
+        if call.done():
+            return
+        if call.followers:
+            self.abandoned += 1
+        self._finish(call, None, None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            in_flight = len(self._calls)
+            waiting = sum(call.followers for call in self._calls.values())
+        total = self.leaders + self.coalesced
+        return {
+            "enabled": self.enabled,
+            "in_flight": in_flight,
+            "waiting": waiting,
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "abandoned": self.abandoned,
+            "coalesce_rate": (self.coalesced / total) if total else 0.0,
+        }
+
+
+inflight_generations = SingleFlight(COALESCE_ENABLED)
+
+
+def lead_or_follow(query: Dict[str, Any]) -> Tuple[Optional[InFlightCall], Optional[InFlightCall]]:
+    """(call, None) si esta consulta genera y debe cerrar call; (None, call terminada) si otra ya lo hizo.
+
+    Si la líder falló, su excepción (p. ej. AdmissionRejected) se propaga también acá.
+    """
+    while True:
+        call, leader = inflight_generations.join(query["cache_key"])
+        if leader:
+            return call, None
+        if not call.wait(COALESCE_MAX_WAIT):
+            inflight_generations.abandon(call)
+            continue
+        if call.outcome() is not None:
+            return None, call
+
+
+def abort_flight(flight: InFlightCall, rejected: AdmissionRejected):
+    """La líder no obtuvo GPU: si se desconectó, un seguidor toma su lugar; si no, todos reciben el rechazo."""
+    if rejected.reason == "client_disconnected":
+        inflight_generations.abandon(flight)
+    else:
+        inflight_generations.fail(flight, rejected)
+
+
+# -----------------------------------------------------------------------------
+# Memoria de conversación por sesión
+# -----------------------------------------------------------------------------
+SESSION_MEMORY_ENABLED = os.getenv("SESSION_MEMORY_ENABLED", "true").lower() in ("1", "true", "yes")
+# Inactividad tras la que se olvida una sesión
+SESSION_TTL = float(os.getenv("SESSION_TTL", "1800"))
+# Tope de sesiones y de bytes en memoria por proceso; al superarlo se descartan las menos recientes
+SESSION_MAX = int(os.getenv("SESSION_MAX", "50000"))
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", str(32 * 1024 * 1024)))
+# Tokens estimados de historial que se guardan; los turnos más viejos pasan al resumen
+SESSION_HISTORY_TOKENS = int(os.getenv("SESSION_HISTORY_TOKENS", "300"))
+SESSION_SUMMARY_CHARS = int(os.getenv("SESSION_SUMMARY_CHARS", "300"))
+SESSION_TURN_CHARS = 300
+# Consultas de hasta estas palabras se tratan como repreguntas ("¿y el horario?")
+SESSION_FOLLOWUP_WORDS = int(os.getenv("SESSION_FOLLOWUP_WORDS", "8"))
+# Base SQLite donde van a parar las sesiones desalojadas de memoria (vacío = se descartan);
+# con STATE_BACKEND=sqlite las sesiones se guardan directamente en el estado compartido
+SESSION_SPILL_PATH = os.getenv("SESSION_SPILL_PATH", "")
+# Bytes que se suman por sesión a su JSON (clave, tupla y nodo del OrderedDict)
+SESSION_ENTRY_OVERHEAD = 200
+SESSION_ID_RE = re.compile(r"^[A-Za-z0-9_-]{4,64}$")
+
+
+def new_session_entry() -> Dict[str, Any]:
+    # m: último municipio detectado, s: resumen de turnos viejos, h: [[consulta, respuesta], ...]
+    return {"m": "", "s": "", "h": []}
+
+
+class SessionMemory:
+    """Sesiones en un LRU acotado por cantidad y bytes, con vencimiento por inactividad.
+
+    Cada sesión se guarda como JSON compacto. Con spill, las sesiones desalojadas pasan a
+    SQLite y vuelven a memoria al reaparecer. Con shared=True (varios workers) el spill es el
+    estado compartido y no se guarda nada en el proceso.
+    """
+
+    def __init__(self, max_sessions: int, max_bytes: int, ttl: float,
+                 spill: Optional[StateStore] = None, shared: bool = False):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.spill = spill
+        self.shared = shared and spill is not None
+        self._entries: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.spill_hits = 0
+        self.expired = 0
+        self.evicted = 0
+
+    @staticmethod
+    def _spill_key(session_id: str) -> str:
+        return "session:" + session_id
+
+    def _drop(self, session_id: str):
+        _, data = self._entries.pop(session_id)
+        self._bytes -= len(data) + SESSION_ENTRY_OVERHEAD
+
+    def get(self, session_id: str) -> Dict[str, Any]:
+        if self.shared:
+            entry = self.spill.get_json(self._spill_key(session_id))
+            with self._lock:
+                if entry is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+            return entry or new_session_entry()
+
+        now = time.monotonic()
+        data = None
+        with self._lock:
+            item = self._entries.get(session_id)
+            if item is not None:
+                if item[0] > now:
+                    data = item[1]
+                    # Vencimiento deslizante: el orden LRU coincide con el de vencimiento
+                    self._entries[session_id] = (now + self.ttl, data)
+                    self._entries.move_to_end(session_id)
+                    self.hits += 1
+                else:
+                    self._drop(session_id)
+                    self.expired += 1
+        if data is not None:
+            return json.loads(data)
+
+        entry = self.spill.get_json(self._spill_key(session_id)) if self.spill is not None else None
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.spill_hits += 1
+        if entry is None:
+            return new_session_entry()
+        self.put(session_id, entry)
+        return entry
+
+    def put(self, session_id: str, entry: Dict[str, Any]):
+        if self.shared:
+            self.spill.set_json(self._spill_key(session_id), entry, ttl=self.ttl)
+            return
+
+        data = json.dumps(entry, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        now = time.monotonic()
+        evicted: List[Tuple[str, float, bytes]] = []
+        with self._lock:
+            if session_id in self._entries:
+                self._drop(session_id)
+            self._entries[session_id] = (now + self.ttl, data)
+            self._bytes += len(data) + SESSION_ENTRY_OVERHEAD
+            while self._entries:
+                oldest_id, (expires_at, oldest) = next(iter(self._entries.items()))
+                if expires_at <= now:
+                    self._drop(oldest_id)
+                    self.expired += 1
+                elif len(self._entries) > self.max_sessions or self._bytes > self.max_bytes:
+                    self._drop(oldest_id)
+                    self.evicted += 1
+                    evicted.append((oldest_id, expires_at, oldest))
+                else:
+                    break
+        if self.spill is not None:
+            for evicted_id, expires_at, evicted_data in evicted:
+                self.spill.set_json(self._spill_key(evicted_id), json.loads(evicted_data), ttl=expires_at - now)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": True,
+                "shared": self.shared,
+                "spill": self.spill is not None,
+                "sessions": len(self._entries),
+                "bytes": self._bytes,
+                "max_sessions": self.max_sessions,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "spill_hits": self.spill_hits,
+                "expired": self.expired,
+                "evicted": self.evicted,
+            }
+
+
+def make_session_memory() -> Optional[SessionMemory]:
+    if not SESSION_MEMORY_ENABLED:
         return None
+    if STATE_BACKEND == "sqlite":
+        return SessionMemory(SESSION_MAX, SESSION_MAX_BYTES, SESSION_TTL, spill=state_store, shared=True)
+    spill = SQLiteStateStore(SESSION_SPILL_PATH) if SESSION_SPILL_PATH else None
+    return SessionMemory(SESSION_MAX, SESSION_MAX_BYTES, SESSION_TTL, spill=spill)
+
+
+session_memory = make_session_memory()
+
+
+def client_session_id(value: Any) -> Optional[str]:
+    """session_id que manda el cliente (chat.html), si tiene un formato aceptable."""
+    if isinstance(value, str) and SESSION_ID_RE.match(value):
+        return value
+    return None
+
+
+def session_history_text(entry: Dict[str, Any]) -> str:
+    """Historial de la sesión como contexto para el modelo (vacío si no hay turnos)."""
+    lines = []
+    if entry["s"]:
+        lines.append("Resumen: " + entry["s"])
+    for user_text, reply in entry["h"]:
+        lines.append("Usuario: " + user_text)
+        if reply:
+            lines.append("Asistente: " + reply)
+    return "\n".join(lines)
+
+
+def remember_turn(query: Dict[str, Any], content: Dict[str, Any]):
+    """Agrega el turno a la sesión de la consulta, dentro de SESSION_HISTORY_TOKENS."""
+    if session_memory is None or query.get("session_id") is None:
+        return
+    entry = query["session"]
+    if query["municipio_key"]:
+        entry["m"] = query["municipio_key"]
+    reply = ""
+    if content.get("Clasificacion") not in (None, "ERROR_MODELO"):
+        reply = f'{content["Clasificacion"]}: {content.get("descripcion_corta", "")}'.strip(": ")
+    entry["h"].append([query["prompt"][:SESSION_TURN_CHARS], reply[:SESSION_TURN_CHARS]])
+
+    # Los turnos que no entran en el presupuesto quedan sólo como consulta en el resumen
+    tokens = sum(estimate_tokens(u) + estimate_tokens(r) for u, r in entry["h"])
+    while len(entry["h"]) > 1 and tokens > SESSION_HISTORY_TOKENS:
+        user_text, old_reply = entry["h"].pop(0)
+        tokens -= estimate_tokens(user_text) + estimate_tokens(old_reply)
+        summary = (entry["s"] + " | " + user_text) if entry["s"] else user_text
+        entry["s"] = summary[-SESSION_SUMMARY_CHARS:]
+    try:
+        session_memory.put(query["session_id"], entry)
+    except Exception as e:
+        app.logger.warning("No se pudo guardar la sesión %s: %s", query["session_id"], e)
 
 
 # -----------------------------------------------------------------------------
-# Ollama Call
+# Perfiles de generación (tokens y plazo por tipo de consulta)
 # -----------------------------------------------------------------------------
-def call_ollama(
-    messages: List[Dict[str, str]], model: str = "gemma2:2b", timeout: int = 120
-) -> str:
-    """Llama al endpoint de Ollama y devuelve la respuesta CRUDA de la IA."""
-    global current_endpoint_index
-    last_error = None
-    n = len(OLLAMA_ENDPOINTS)
-    if n == 0:
-        return "No hay endpoints de Ollama configurados."
-        
-    model_to_use = os.getenv("OLLAMA_MODEL", model) 
-
-    for i in range(n):
-        idx = (current_endpoint_index + i) % n
-        endpoint = OLLAMA_ENDPOINTS[idx].rstrip("/")
-        url = f"{endpoint}/api/chat"
-        # Solicitud estricta de FORMATO JSON para la clasificación
-        payload = {"model": model_to_use, "messages": messages, "stream": False, "format": "json"} 
-        headers = {"Content-Type": "application/json"}
-        try:
-            current_endpoint_index = (idx + 1) % n
-            resp = requests.post(url, json=payload, headers=headers, timeout=timeout)
-            resp.raise_for_status()
-            data = resp.json()
-            
-            # --- Lógica de Extracción de Contenido de Ollama ---
-            if "message" in data and isinstance(data["message"], dict):
-                content = data["message"].get("content", "")
-                if content:
-                    return content.strip()
-            
-            if "response" in data and isinstance(data["response"], str):
-                return data["response"].strip()
-                
-            if ("choices" in data and isinstance(data["choices"], list) and len(data["choices"]) > 0):
-                first = data["choices"][0]
-                if (isinstance(first, dict) and "message" in first and isinstance(first["message"], dict)):
-                    return first["message"].get("content", "").strip()
+GENERATION_PROFILES_ENABLED = os.getenv("GENERATION_PROFILES_ENABLED", "true").lower() in ("1", "true", "yes")
+# Contexto de Ollama: igual en todos los perfiles, cambiarlo entre peticiones obliga a recargar el modelo
+OLLAMA_NUM_CTX = int(os.getenv("OLLAMA_NUM_CTX", "2048"))
+# Límites de palabras del prompt para elegir perfil cuando no hay palabras clave
+GENERATION_SHORT_WORDS = int(os.getenv("GENERATION_SHORT_WORDS", "12"))
+GENERATION_LONG_WORDS = int(os.getenv("GENERATION_LONG_WORDS", "60"))
+
+# num_predict alcanza holgado para el JSON con una respuesta_extendida de 100 palabras;
+# deadline_s es el plazo de la generación (sin contar la espera en la cola de GPU)
+GENERATION_PROFILES: Dict[str, Dict[str, Any]] = {
+    "breve": {"num_predict": 256, "temperature": 0.2, "deadline_s": 30},
+    "estandar": {"num_predict": 384, "temperature": 0.2, "deadline_s": 45},
+    "detallada": {"num_predict": 512, "temperature": 0.3, "deadline_s": 60},
+}
+# Ajustes por entorno, p. ej. GENERATION_PROFILES='{"breve": {"deadline_s": 20}}'
+for _name, _overrides in json.loads(os.getenv("GENERATION_PROFILES") or "{}").items():
+    GENERATION_PROFILES.setdefault(_name, dict(GENERATION_PROFILES["estandar"])).update(_overrides)
+# Con format json el modelo a veces sigue emitiendo saltos de línea tras cerrar el objeto
+GENERATION_STOP = ["\n\n\n"]
+
+# Palabras clave (normalizadas) que fijan el perfil antes de mirar la longitud
+GENERATION_PROFILE_KEYWORDS: List[Tuple[str, Tuple[str, ...]]] = [
+    ("detallada", ("requisitos", "pasos", "documentacion", "tramite", "sucesion", "herencia")),
+    ("breve", ("direccion", "donde queda", "telefono", "horario", "mail", "correo")),
+]
+
+
+def select_generation_profile(user_prompt: str) -> str:
+    """Perfil de generación según palabras clave y, si no hay, la longitud del prompt."""
+    text_norm = normalize_text(user_prompt)
+    for profile, keywords in GENERATION_PROFILE_KEYWORDS:
+        if any(keyword in text_norm for keyword in keywords):
+            return profile
+    n_words = len(text_norm.split())
+    if n_words <= GENERATION_SHORT_WORDS:
+        return "breve"
+    if n_words >= GENERATION_LONG_WORDS:
+        return "detallada"
+    return "estandar"
+
+
+def generation_options(profile: str) -> Dict[str, Any]:
+    """Opciones de Ollama (/api/chat "options") de un perfil."""
+    config = GENERATION_PROFILES[profile]
+    return {
+        "num_predict": int(config["num_predict"]),
+        "num_ctx": OLLAMA_NUM_CTX,
+        "temperature": float(config["temperature"]),
+        "stop": list(config.get("stop", GENERATION_STOP)),
+    }
+
+
+def generation_deadline(query: Dict[str, Any]) -> float:
+    """Segundos que tiene la generación de la consulta antes de cortarse."""
+    if query.get("profile") is None:
+        return 120.0
+    return float(GENERATION_PROFILES[query["profile"]]["deadline_s"])
+
+
+# -----------------------------------------------------------------------------
+# Pipeline de /generate
+# -----------------------------------------------------------------------------
+def detect_municipio(user_prompt: str) -> Optional[Dict[str, str]]:
+    """Detección de municipio (RAG): mención literal, luego búsqueda difusa del texto y de sus sufijos."""
+    return (
+        find_municipio_in_text(user_prompt)
+        or search_municipio(user_prompt)
+        or extract_and_search_municipio(user_prompt)
+    )
+
+
+def is_followup(user_prompt: str) -> bool:
+    return len(user_prompt.split()) <= SESSION_FOLLOWUP_WORDS
+
+
+def needs_history(
+    user_prompt: str, session: Optional[Dict[str, Any]], literal: Optional[Dict[str, str]]
+) -> bool:
+    """Una repregunta lleva el historial solo si no se sostiene sola.
+
+    Si nombra su propio municipio (literal, la mención que ya buscó prepare_query) o pregunta
+    por un dato puntual (requisitos, beneficios, dirección), el municipio detectado alcanza y
+    la consulta no depende de la conversación.
+    """
+    if not session or not session["h"] or not is_followup(user_prompt):
+        return False
+    if literal is not None:
+        return False
+    return not contains_any_keyword(user_prompt, KEYWORDS_REQUISITOS + KEYWORDS_BENEFICIOS + KEYWORDS_DIRECCIONES)
+
+
+def detect_session_municipio(
+    user_prompt: str, session: Optional[Dict[str, Any]], literal: Optional[Dict[str, str]]
+) -> Optional[Dict[str, str]]:
+    """detect_municipio teniendo en cuenta el último municipio de la sesión.
+
+    literal es la mención literal del texto (find_municipio_in_text), que cambia de municipio;
+    si no la hay, una repregunta sigue con el de la sesión sin pasar por la búsqueda difusa.
+    """
+    found = literal
+    if found is None and (not session or not session["m"] or not is_followup(user_prompt)):
+        found = search_municipio(user_prompt) or extract_and_search_municipio(user_prompt)
+    if found is None and session and session["m"]:
+        found = get_gazetteer().row_by_name(session["m"])
+    return found
+
+
+def build_ollama_messages(
+    user_prompt: str, municipio: Optional[Dict[str, str]], history: str = ""
+) -> List[Dict[str, str]]:
+    """PROMPT_PREFIX y a continuación las partes variables: contexto municipal, historial y consulta."""
+    municipio_context = ""
+    if municipio:
+        municipio_context = format_municipio_data(municipio)
+        municipio_context = "\n\n📍 *Información del municipio detectado:*\n" + municipio_context + "\n\n"
+
+    messages_for_ollama = list(get_prompt_prefix()["messages"])
 
-            return json.dumps(data) 
+    if municipio_context:
+        messages_for_ollama.append({"role": "system", "content": "Contexto municipal:\n" + municipio_context})
 
+    if history:
+        messages_for_ollama.append({"role": "system", "content": "Conversación previa:\n" + history})
+
+    messages_for_ollama.append({"role": "user", "content": user_prompt})
+    return messages_for_ollama
+
+
+def prompt_token_split(messages: List[Dict[str, str]]) -> Dict[str, int]:
+    """Tokens estimados del prefijo reutilizable y del sufijo que cambia en cada consulta."""
+    prefix = get_prompt_prefix()
+    n_prefix = len(prefix["messages"])
+    return {
+        "prefix": prefix["tokens"],
+        "suffix": sum(estimate_tokens(m["content"]) for m in messages[n_prefix:]),
+    }
+
+
+def prepare_query(user_prompt: str, session_id: Optional[str] = None) -> Dict[str, Any]:
+    """Etapas previas al LLM: sesión, RAG, reglas y cachés.
+
+    Si alguna etapa ya tiene la respuesta, queda en "content" (con su "source");
+    si no, "messages" trae lo que hay que enviar a Ollama.
+    """
+    session = None
+    with timed("session"):
+        if session_memory is not None and session_id is not None:
+            try:
+                session = session_memory.get(session_id)
+            except Exception as e:
+                app.logger.warning("Memoria de sesión no disponible: %s", e)
+
+    with timed("rag"):
+        # La mención literal se busca una sola vez: decide el municipio y si hace falta el historial
+        literal = find_municipio_in_text(user_prompt)
+        municipio_found = detect_session_municipio(user_prompt, session, literal)
+    history = session_history_text(session) if needs_history(user_prompt, session, literal) else ""
+    if METRICS_ENABLED:
+        metrics.inc("asistente_rag_lookups_total", result="hit" if municipio_found else "miss")
+    query: Dict[str, Any] = {
+        "prompt": user_prompt,
+        "session_id": session_id if session is not None else None,
+        "session": session,
+        "history": history,
+        "municipio": municipio_found,
+        "municipio_key": (municipio_found or {}).get("MUNICIPIO", ""),
+        "content": None,
+        "source": None,
+        "cache_key": None,
+        "vector": None,
+        "messages": None,
+        "prompt_tokens": None,
+        "profile": None,
+        "options": None,
+    }
+
+    with timed("rules"):
+        rule_content = apply_fast_path_rules(user_prompt, municipio_found)
+    if rule_content is not None:
+        query.update(content=rule_content, source="rules")
+        return query
+
+    # Las cachés se consultan sin el historial: una respuesta ya dada para la misma consulta y
+    # municipio sirve también a la repregunta. Solo si hay que generar, la clave (y con ella el
+    # single-flight) incluye el historial.
+    with timed("cache"):
+        query["cache_key"] = response_cache_key(user_prompt, municipio_found, get_system_prompt())
+        cached = response_cache.get(query["cache_key"])
+    if cached is not None:
+        query.update(content=cached, source="cache")
+        return query
+
+    # Caché semántica: paráfrasis de una consulta ya respondida para el mismo municipio
+    if semantic_cache is not None:
+        try:
+            with timed("semantic_cache"):
+                vector = semantic_cache.embed(user_prompt)
+                similar = semantic_cache.lookup(vector, query["municipio_key"])
         except Exception as e:
-            last_error = e
-            app.logger.warning("Error contactando a Ollama en %s: %s", endpoint, e)
-            continue
-    return f"No se pudo obtener respuesta de Ollama. Último error: {last_error}"
+            app.logger.warning("Caché semántica no disponible: %s", e)
+            vector = similar = None
+        if similar is not None:
+            response_cache.put(query["cache_key"], similar)
+            query.update(content=similar, source="semantic_cache")
+            return query
+        # Lo generado con historial depende de la conversación: no se agrega a la caché semántica
+        if not history:
+            query["vector"] = vector
+
+    if history:
+        with timed("cache"):
+            query["cache_key"] = response_cache_key(user_prompt, municipio_found, get_system_prompt(), history)
+            cached = response_cache.get(query["cache_key"])
+        if cached is not None:
+            query.update(content=cached, source="cache")
+            return query
+
+    query["messages"] = build_ollama_messages(user_prompt, municipio_found, history)
+    query["prompt_tokens"] = prompt_token_split(query["messages"])
+    if GENERATION_PROFILES_ENABLED:
+        query["profile"] = select_generation_profile(user_prompt)
+        query["options"] = generation_options(query["profile"])
+    return query
+
+
+class GenerationStats:
+    """Ventana de las últimas generaciones: lo que informó Ollama y el reparto estimado prefijo/sufijo."""
+
+    def __init__(self, window: int = 1000):
+        self._samples: "deque[Dict[str, Any]]" = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.deadline_exceeded = 0
+        self.by_profile: Dict[str, Dict[str, int]] = {}
+
+    def record(self, prompt_tokens: Dict[str, int], meta: Dict[str, Any], profile: Optional[str] = None):
+        sample = {**meta, "prefix_tokens": prompt_tokens["prefix"], "suffix_tokens": prompt_tokens["suffix"]}
+        timed_out = bool(meta.get("deadline_exceeded"))
+        with self._lock:
+            self._samples.append(sample)
+            self.count += 1
+            self.deadline_exceeded += timed_out
+            counts = self.by_profile.setdefault(profile or "sin_perfil", {"generations": 0, "deadline_exceeded": 0})
+            counts["generations"] += 1
+            counts["deadline_exceeded"] += timed_out
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            samples = list(self._samples)
+
+        def avg(values: List[float]) -> float:
+            return (sum(values) / len(values)) if values else 0.0
+
+        def ms(field: str) -> Dict[str, float]:
+            values = sorted(s[field] / 1e6 for s in samples if field in s)
+            return {"avg": avg(values), "p50": _percentile(values, 0.50), "p95": _percentile(values, 0.95)}
+
+        with_eval = [s for s in samples if "prompt_eval_count" in s]
+        evaluated = sum(s["prompt_eval_count"] for s in with_eval)
+        estimated = sum(s["prefix_tokens"] + s["suffix_tokens"] for s in with_eval)
+        eval_tokens = sum(s.get("eval_count", 0) for s in samples if "eval_duration" in s)
+        eval_seconds = sum(s["eval_duration"] for s in samples if "eval_duration" in s) / 1e9
+        with self._lock:
+            by_profile = {name: dict(counts) for name, counts in self.by_profile.items()}
+        return {
+            "generations": self.count,
+            "deadline_exceeded": self.deadline_exceeded,
+            "by_profile": by_profile,
+            "window": len(samples),
+            "prefix_tokens_est": avg([s["prefix_tokens"] for s in samples]),
+            "suffix_tokens_est": avg([s["suffix_tokens"] for s in samples]),
+            "prompt_eval_count_avg": avg([s["prompt_eval_count"] for s in with_eval]),
+            # Parte del prompt que Ollama no tuvo que evaluar (prefijo ya en su KV cache), estimada
+            "prompt_cached_ratio_est": max(0.0, 1 - evaluated / estimated) if estimated else 0.0,
+            "prompt_eval_ms": ms("prompt_eval_duration"),
+            "eval_ms": ms("eval_duration"),
+            "load_ms": ms("load_duration"),
+            "eval_tokens_per_s": (eval_tokens / eval_seconds) if eval_seconds else 0.0,
+        }
+
+
+generation_stats = GenerationStats()
+
+
+def record_generation(query: Dict[str, Any], meta: Dict[str, Any]):
+    """Registra la generación de una consulta (tokens de prefijo/sufijo y tiempos de Ollama)."""
+    if query.get("prompt_tokens") is None:
+        return
+    generation_stats.record(query["prompt_tokens"], meta, query.get("profile"))
+    if meta.get("deadline_exceeded"):
+        app.logger.warning(
+            "Generación cortada: se agotó el plazo de %.1f s (perfil %s)", generation_deadline(query), query.get("profile")
+        )
+    app.logger.info(
+        "Generación: perfil %s, prefijo ~%d tokens, sufijo ~%d, evaluados %s, prompt_eval %.0f ms, eval %.0f ms (%s tokens)",
+        query.get("profile"), query["prompt_tokens"]["prefix"], query["prompt_tokens"]["suffix"],
+        meta.get("prompt_eval_count", "?"), meta.get("prompt_eval_duration", 0) / 1e6,
+        meta.get("eval_duration", 0) / 1e6, meta.get("eval_count", "?"),
+    )
+
+
+def extract_model_response(raw_response: str) -> Tuple[Optional[Dict[str, Any]], Optional[List[str]]]:
+    """Objeto de la salida del modelo que cumple MODEL_RESPONSE_SCHEMA y las reparaciones que necesitó.
+
+    La salida suele ser JSON válido (format json): se prueba json.loads y sólo si falla se recorre
+    el texto con iter_json_objects. Las reparaciones son None si no hizo falta ninguna.
+    """
+    started = time.perf_counter()
+    parsed: Optional[Dict[str, Any]] = None
+    repairs: Optional[List[str]] = None
+    try:
+        obj = json.loads(raw_response)
+    except ValueError:
+        obj = None
+    if isinstance(obj, dict):
+        parsed = validate_model_response(obj)
+    else:
+        for obj, obj_repairs in iter_json_objects(raw_response):
+            parsed = validate_model_response(obj)
+            if parsed is not None:
+                repairs = obj_repairs
+                break
+    model_parse_stats.record(parsed is not None, repairs, time.perf_counter() - started)
+    if parsed is not None and repairs:
+        app.logger.info("JSON del modelo reparado: %s", ", ".join(sorted(set(repairs))))
+    return parsed, repairs
+
+
+def parse_model_response(raw_response: str) -> Optional[Dict[str, Any]]:
+    """Extrae el objeto JSON de la salida del modelo; None si no hay uno con 'Clasificacion'."""
+    return extract_model_response(raw_response)[0]
+
+
+def error_fallback_content(raw_response: str) -> Dict[str, str]:
+    # *** Fallback Estructurado: Devuelve ERROR_MODELO para el Frontend ***
+    return {
+        "Urgencia": "5",
+        "Clasificacion": "ERROR_MODELO",
+        "respuesta_extendida":
+            "**Error de Clasificación (Modelo Fallido):** La IA no pudo generar el formato de datos necesario. " +
+            "Esto ocurre si la pregunta es muy corta o el modelo falló. " +
+            "**Output crudo:** " + raw_response[:200] + "..."
+    }
+
+
+def deadline_fallback_content() -> Dict[str, str]:
+    # Mismo formato ERROR_MODELO, para generaciones cortadas por el plazo del perfil
+    return {
+        "Urgencia": "5",
+        "Clasificacion": "ERROR_MODELO",
+        "respuesta_extendida":
+            "**Error de Clasificación (Tiempo Agotado):** La IA no terminó de responder dentro del tiempo " +
+            "previsto. Por favor, intentá nuevamente en unos minutos.",
+    }
+
+
+def assistant_payload(content: Dict[str, Any], session_id: str, source: Optional[str]) -> Dict[str, Any]:
+    payload = {
+        "role": "assistant",
+        "content": content,
+        "session_id": session_id,
+        "type": "structured_data",
+    }
+    if source:
+        payload["source"] = source
+    return payload
+
+
+def finish_generation(
+    query: Dict[str, Any], raw_response: str, session_id: str, coalesced: bool = False, timed_out: bool = False
+) -> Tuple[Dict[str, Any], int]:
+    """Parsea la salida del modelo, guarda en caché si es válida y arma el cuerpo de respuesta.
+
+    Con coalesced=True la salida es de otra consulta idéntica, que ya la guardó en las cachés.
+    Con timed_out=True la generación se cortó por el plazo y se responde ERROR_MODELO directamente.
+    El turno queda en la memoria de la sesión.
+    """
+    payload, status = _generation_payload(query, raw_response, session_id, coalesced, timed_out)
+    count_response(payload)
+    remember_turn(query, payload["content"])
+    return payload, status
+
+
+def _generation_payload(
+    query: Dict[str, Any], raw_response: str, session_id: str, coalesced: bool, timed_out: bool
+) -> Tuple[Dict[str, Any], int]:
+    if timed_out:
+        return {
+            "role": "assistant",
+            "content": deadline_fallback_content(),
+            "session_id": session_id,
+            "type": "error_fallback"
+        }, 500
+
+    with timed("parse"):
+        parsed_json, repairs = extract_model_response(raw_response)
+    if parsed_json is not None:
+        # Éxito: El LLM devolvió un JSON válido con el campo requerido.
+        if coalesced:
+            return assistant_payload(parsed_json, session_id, "coalesced"), 200
+        if repairs and "truncated" in repairs:
+            # Respuesta cortada: se entrega, pero no se guarda para las próximas consultas
+            return assistant_payload(parsed_json, session_id, "llm"), 200
+        response_cache.put(query["cache_key"], parsed_json)
+        if semantic_cache is not None and query["vector"] is not None:
+            semantic_cache.add(query["vector"], query["municipio_key"], parsed_json)
+        return assistant_payload(parsed_json, session_id, "llm"), 200
+
+    # Fallo del Modelo: El JSON no se pudo extraer o no contenía la clave 'Clasificacion'.
+    app.logger.error("JSONDecodeError: Fallo en la extracción de JSON o campo 'Clasificacion' faltante.")
+    return {
+        "role": "assistant",
+        "content": error_fallback_content(raw_response),
+        "session_id": session_id,
+        "type": "error_fallback"
+    }, 500
+
+
+def _encode_stream_event(event: Dict[str, Any], sse: bool) -> str:
+    data = json.dumps(event, ensure_ascii=False)
+    if sse:
+        return f"event: {event['event']}\ndata: {data}\n\n"
+    return data + "\n"
+
+
+def _stream_generation(
+    query: Dict[str, Any], session_id: str, sse: bool, gpu_lease: str, flight: InFlightCall
+) -> Iterator[str]:
+    """Reenvía los tokens de Ollama como eventos y cierra con la respuesta parseada.
+
+    El slot de GPU ya fue tomado por la vista; se libera al terminar o si el cliente se desconecta.
+    Las consultas idénticas que esperan en flight reciben la salida completa al final.
+    """
+    raw_response = None
+    try:
+        yield _encode_stream_event({"event": "meta", "session_id": session_id}, sse)
+        fields = StreamingJSONFields()
+        chunks: List[str] = []
+        meta: Dict[str, Any] = {}
+        started = time.perf_counter()
+        stream = call_ollama_stream(
+            query["messages"], timeout=generation_deadline(query), meta=meta, options=query["options"]
+        )
+        for piece in stream:
+            chunks.append(piece)
+            for event in fields.feed(piece):
+                yield _encode_stream_event(event, sse)
+        record_stage("ollama", time.perf_counter() - started)
+        raw_response = "".join(chunks).strip()
+        record_generation(query, meta)
+        _release_gpu(gpu_lease)
+        gpu_lease = None
+        inflight_generations.complete(flight, raw_response, bool(meta.get("deadline_exceeded")))
+        payload, status = finish_generation(
+            query, raw_response, session_id, timed_out=bool(meta.get("deadline_exceeded"))
+        )
+        yield _encode_stream_event({"event": "done", "status": status, **payload}, sse)
+    finally:
+        _release_gpu(gpu_lease)
+        if raw_response is None:
+            inflight_generations.abandon(flight)
+
+
+def _stream_static(payload: Dict[str, Any], sse: bool, status: int = 200) -> Iterator[str]:
+    """Respuestas ya completas (reglas, cachés, coalescencia): campos completos y cierre."""
+    yield _encode_stream_event({"event": "meta", "session_id": payload["session_id"]}, sse)
+    for key, value in payload["content"].items():
+        yield _encode_stream_event({"event": "field", "key": key, "value": value}, sse)
+    yield _encode_stream_event({"event": "done", "status": status, **payload}, sse)
+
+
+def _stream_response(events: Iterator[str], sse: bool) -> Response:
+    mimetype = "text/event-stream" if sse else "application/x-ndjson"
+    resp = Response(events, mimetype=mimetype)
+    resp.headers["Cache-Control"] = "no-cache"
+    # Evita que nginx acumule la respuesta antes de enviarla
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
 
 
 # -----------------------------------------------------------------------------
-# Prompt / sistema
+# Clasificación por lotes (/generate_batch y batch_classify.py)
 # -----------------------------------------------------------------------------
-def load_system_prompt() -> str:
+# Clasificaciones en curso a la vez de los lotes de /generate_batch en este proceso (entre todos)
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", str(max(1, MAX_CONCURRENT_GPU // 2))))
+# Tickets por subida a /generate_batch y tamaño máximo de la subida (los backlogs grandes, con el CLI)
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "10000"))
+BATCH_MAX_UPLOAD_BYTES = int(os.getenv("BATCH_MAX_UPLOAD_BYTES", str(32 * 1024 * 1024)))
+# Campos (JSONL) o columnas (CSV) de donde se toman el identificador y el texto del ticket
+BATCH_ID_FIELDS = ("id", "ticket_id", "nro")
+BATCH_TEXT_FIELDS = ("prompt", "text", "texto", "mensaje", "body", "asunto")
+
+# Tope por proceso de /generate_batch; batch_classify.py usa sólo el de su --workers
+_batch_slots = threading.BoundedSemaphore(max(1, BATCH_WORKERS))
+
+
+class BatchInputError(ValueError):
+    pass
+
+
+def _batch_field(record: Dict[str, Any], names: Tuple[str, ...]) -> Any:
+    lowered = {str(k).strip().lower(): v for k, v in record.items()}
+    for name in names:
+        value = lowered.get(name)
+        if value not in (None, ""):
+            return value
+    return None
+
+
+def iter_batch_items(lines: Iterator[str], fmt: str = "jsonl") -> Iterator[Tuple[str, str]]:
+    """(id, texto) de cada ticket de un archivo JSONL o CSV.
+
+    Sin campo de id se usa el número de línea/fila, estable mientras no cambie el archivo
+    (así el CLI puede retomar un lote). Las líneas sin texto se saltean.
+    """
+    if fmt == "csv":
+        records = enumerate(csv.DictReader(lines), start=1)
+    else:
+        records = ((n, line) for n, line in enumerate(lines, start=1) if line.strip())
+    for n, record in records:
+        if fmt != "csv":
+            try:
+                record = json.loads(record)
+            except ValueError as e:
+                raise BatchInputError(f"línea {n}: JSON inválido ({e})")
+            if isinstance(record, str):
+                record = {"prompt": record}
+            if not isinstance(record, dict):
+                raise BatchInputError(f"línea {n}: se esperaba un objeto JSON")
+        text = _batch_field(record, BATCH_TEXT_FIELDS)
+        if not isinstance(text, str) or not text.strip():
+            continue
+        item_id = _batch_field(record, BATCH_ID_FIELDS)
+        yield (str(item_id) if item_id is not None else str(n)), text
+
+
+def batch_format(filename: str, content_type: str) -> str:
+    if filename.lower().endswith(".csv") or "csv" in content_type:
+        return "csv"
+    return "jsonl"
+
+
+def _acquire_batch_gpu(stop: threading.Event) -> Optional[str]:
+    """Slot de GPU para un ticket del lote, sólo cuando no hay consultas interactivas esperando.
+
+    try_admit_now nunca se adelanta a la cola de admisión de este proceso: mientras haya vecinos
+    esperando el lote no toma slots, y cuando los hay libres los ocupa. None si se canceló el lote.
+    La cola es local: batch_classify.py corre en otro proceso y no ve las consultas que esperan
+    en el servidor. Con STATE_BACKEND=sqlite y la misma base comparte el tope de slots
+    (MAX_CONCURRENT_GPU), pero no cede su turno al chat.
+    """
+    while not stop.is_set():
+        lease = gpu_admission.try_admit_now()
+        if lease is not None:
+            return lease
+        stop.wait(gpu_admission.poll)
+    return None
+
+
+def _batch_call_ollama(query: Dict[str, Any], meta: Dict[str, Any], stop: threading.Event) -> Optional[str]:
+    """call_ollama para un ticket del lote; None si el lote se canceló antes de conseguir GPU.
+
+    Sin micro-lotes el slot se toma con _acquire_batch_gpu. Con ellos lo toma el despachador
+    (también con try_admit_now); si su cola está llena, el ticket espera Retry-After y reintenta
+    en lugar de fallar: el lote no compite con el chat por la cola.
+    """
+    while not stop.is_set():
+        lease = None
+        if ollama_dispatcher is None:
+            lease = _acquire_batch_gpu(stop)
+            if lease is None:
+                return None
+        try:
+            return call_ollama(
+                query["messages"], timeout=generation_deadline(query), meta=meta, options=query["options"]
+            )
+        except AdmissionRejected as rejected:
+            stop.wait(rejected.retry_after)
+        finally:
+            _release_gpu(lease)
+    return None
+
+
+def classify_batch_item(item_id: str, text: str, stop: threading.Event) -> Dict[str, Any]:
+    """Un ticket por el mismo camino que /generate: RAG, reglas, cachés, Ollama y parseo del JSON."""
+    started = time.perf_counter()
+    record: Dict[str, Any] = {"id": item_id}
     try:
-        with open("system_prompt.txt", "r", encoding="utf-8") as f:
-            return f.read()
-    except FileNotFoundError:
-        return "ERROR: system_prompt.txt no encontrado. No se puede clasificar."
+        query = prepare_query(text)
+        if query["content"] is not None:
+            payload, status = assistant_payload(query["content"], item_id, query["source"]), 200
+            count_response(payload)
+        else:
+            meta: Dict[str, Any] = {}
+            raw_response = _batch_call_ollama(query, meta, stop)
+            if raw_response is None:
+                record.update(status="cancelled")
+                return record
+            record_generation(query, meta)
+            payload, status = finish_generation(
+                query, raw_response, item_id, timed_out=bool(meta.get("deadline_exceeded"))
+            )
+        record.update(
+            status="ok" if status == 200 else payload["type"],
+            source=payload.get("source"),
+            municipio=query["municipio_key"] or None,
+            content=payload["content"],
+        )
+    except Exception as e:
+        app.logger.exception("Error clasificando el ticket %s del lote: %s", item_id, e)
+        record.update(status="error", error=str(e))
+    record["ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return record
+
+
+def run_batch(
+    items: Iterator[Tuple[str, str]], workers: int = BATCH_WORKERS, stop: Optional[threading.Event] = None,
+    slots: Optional[threading.BoundedSemaphore] = None,
+) -> Iterator[Dict[str, Any]]:
+    """Clasifica los tickets con un pool acotado y devuelve los resultados a medida que terminan.
+
+    Se leen de items sólo los que caben en el pool (el archivo no se carga entero) y hay a lo
+    sumo workers tickets en curso. slots, si se pasa, es un tope compartido con otros lotes del
+    proceso (/generate_batch usa _batch_slots). Los resultados salen en el orden de entrada;
+    cada uno lleva su id.
+    """
+    stop = stop or threading.Event()
+    workers = max(1, workers)
+
+    def classify(item_id: str, text: str) -> Dict[str, Any]:
+        if stop.is_set():
+            return {"id": item_id, "status": "cancelled"}
+        return classify_batch_item(item_id, text, stop)
+
+    def work(item_id: str, text: str) -> Dict[str, Any]:
+        if slots is None:
+            return classify(item_id, text)
+        with slots:
+            return classify(item_id, text)
+
+    pending: "deque[Future]" = deque()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch") as pool:
+        try:
+            for item_id, text in items:
+                if stop.is_set():
+                    break
+                pending.append(pool.submit(work, item_id, text))
+                while len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            stop.set()
+
+
+# -----------------------------------------------------------------------------
+# Compresión HTTP y páginas estáticas
+# -----------------------------------------------------------------------------
+COMPRESSION_ENABLED = os.getenv("COMPRESSION_ENABLED", "true").lower() in ("1", "true", "yes")
+# Por debajo de este tamaño comprimir no compensa (cabeceras, CPU)
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", "1024"))
+# Niveles para respuestas dinámicas; las páginas estáticas se comprimen una vez con el máximo
+COMPRESSION_BR_QUALITY = int(os.getenv("COMPRESSION_BR_QUALITY", "4"))
+COMPRESSION_GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", "6"))
+COMPRESSIBLE_MIMETYPES = {
+    "application/json", "text/html", "text/plain", "text/css", "application/javascript", "image/svg+xml",
+}
+
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    """"br" o "gzip" según Accept-Encoding (con sus q=), o None si el cliente no acepta ninguna."""
+    accepted: Dict[str, float] = {}
+    for part in (accept_encoding or "").split(","):
+        coding, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        if coding:
+            accepted[coding.strip().lower()] = q
+    for coding in ("br", "gzip"):
+        if coding == "br" and brotli is None:
+            continue
+        if accepted.get(coding, accepted.get("*", 0.0)) > 0:
+            return coding
+    return None
+
+
+def compress_body(body: bytes, encoding: str, best: bool = False) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=11 if best else COMPRESSION_BR_QUALITY)
+    # mtime=0: la misma entrada da los mismos bytes (y la misma ETag) en todos los workers
+    return gzip.compress(body, compresslevel=9 if best else COMPRESSION_GZIP_LEVEL, mtime=0)
+
+
+def _add_vary(resp: Response):
+    vary = resp.headers.get("Vary", "")
+    if "accept-encoding" not in vary.lower():
+        resp.headers["Vary"] = f"{vary}, Accept-Encoding" if vary else "Accept-Encoding"
+
+
+@app.after_request
+def compress_response(resp):
+    """Comprime las respuestas de texto/JSON que superan COMPRESSION_MIN_BYTES.
+
+    Las respuestas en streaming (NDJSON, SSE, lotes) se dejan como están: comprimirlas
+    retendría los fragmentos en el compresor y el cliente dejaría de verlos llegar.
+    """
+    if (
+        not COMPRESSION_ENABLED
+        or resp.direct_passthrough
+        or resp.is_streamed
+        or resp.status_code < 200
+        or resp.status_code in (204, 304)
+        or "Content-Encoding" in resp.headers
+        or resp.mimetype not in COMPRESSIBLE_MIMETYPES
+    ):
+        return resp
+    _add_vary(resp)
+    body = resp.get_data()
+    if len(body) < COMPRESSION_MIN_BYTES:
+        return resp
+    encoding = choose_encoding(request.headers.get("Accept-Encoding", ""))
+    if encoding is None:
+        return resp
+    with timed("compress"):
+        compressed = compress_body(body, encoding)
+    if len(compressed) >= len(body):
+        return resp
+    resp.set_data(compressed)
+    resp.headers["Content-Encoding"] = encoding
+    return resp
+
 
-SYSTEM_PROMPT = load_system_prompt()
+class StaticPage:
+    """Página HTML servida desde memoria, con sus versiones br y gzip calculadas una sola vez.
+
+    Se vuelve a leer (y a comprimir) sólo si el archivo cambia. La ETag es fuerte: sale del
+    hash del contenido y lleva la codificación, porque cada versión es una representación distinta.
+    """
+
+    def __init__(self, path: str, mimetype: str = "text/html"):
+        self.path = path
+        self.mimetype = mimetype
+        self._lock = threading.Lock()
+        self._signature: Optional[tuple] = None
+        self._variants: Dict[Optional[str], bytes] = {}
+        self._etags: Dict[Optional[str], str] = {}
+
+    def load(self):
+        signature = _file_signature(self.path)
+        if signature is not None and signature == self._signature:
+            return
+        with self._lock:
+            if signature is not None and signature == self._signature:
+                return
+            with open(self.path, "rb") as f:
+                body = f.read()
+            digest = hashlib.sha256(body).hexdigest()[:32]
+            variants: Dict[Optional[str], bytes] = {None: body}
+            for encoding in ("br", "gzip"):
+                if encoding == "br" and brotli is None:
+                    continue
+                compressed = compress_body(body, encoding, best=True)
+                if len(compressed) < len(body):
+                    variants[encoding] = compressed
+            self._etags = {encoding: digest + (f"-{encoding}" if encoding else "") for encoding in variants}
+            self._variants = variants
+            self._signature = signature
+
+    def response(self) -> Response:
+        try:
+            self.load()
+        except OSError as e:
+            app.logger.error("No se pudo leer %s: %s", self.path, e)
+            return Response("Not Found", status=404, mimetype="text/plain")
+        encoding = choose_encoding(request.headers.get("Accept-Encoding", "")) if COMPRESSION_ENABLED else None
+        if encoding not in self._variants:
+            encoding = None
+        etag = self._etags[encoding]
+        # El navegador revalida en cada visita (no-cache) y recibe 304 si la página no cambió
+        if request.if_none_match.contains_weak(etag):
+            resp = Response(status=304)
+        else:
+            resp = Response(self._variants[encoding], mimetype=self.mimetype)
+            if encoding:
+                resp.headers["Content-Encoding"] = encoding
+        resp.set_etag(etag)
+        resp.headers["Cache-Control"] = "no-cache"
+        _add_vary(resp)
+        return resp
+
+    def stats(self) -> Dict[str, Any]:
+        return {encoding or "identity": len(body) for encoding, body in self._variants.items()}
+
+
+static_pages = {name: StaticPage(os.path.join(os.getcwd(), name)) for name in ("chat.html", "config.html")}
+
+
+def load_static_pages():
+    """Lee y precomprime las páginas (warm_start); una que falte se informa en su primer pedido."""
+    for page in static_pages.values():
+        try:
+            page.load()
+        except OSError as e:
+            app.logger.warning("No se pudo cargar %s: %s", page.path, e)
 
 
 # -----------------------------------------------------------------------------
@@ -548,7 +4518,12 @@ SYSTEM_PROMPT = load_system_prompt()
 # -----------------------------------------------------------------------------
 @app.route("/")
 def serve_html():
-    return send_from_directory(os.getcwd(), "chat.html")
+    return static_pages["chat.html"].response()
+
+
+@app.route("/config.html")
+def serve_config_html():
+    return static_pages["config.html"].response()
 
 
 @app.route("/generate", methods=["POST"])
@@ -556,7 +4531,10 @@ def generate():
     try:
         # --- Rate limiting y concurrencia ---
         client_ip = _get_client_ip()
-        if not _ip_allow(client_ip):
+        with timed("rate_limit"):
+            allowed = _ip_allow(client_ip)
+        if not allowed:
+            count_rejection("rate_limit")
             return (jsonify({"error": "Rate limit exceeded"}), 429)
         
         data = request.get_json(silent=True) or {}
@@ -565,103 +4543,195 @@ def generate():
         if not isinstance(user_prompt, str) or not user_prompt.strip():
             return jsonify({"error": "Entrada inválida: 'prompt' es requerido"}), 400
 
-        session_id = str(uuid.uuid4()) # Usado para logs/trazabilidad
+        # El session_id de chat.html identifica la conversación; sin él se genera uno para logs/trazabilidad
+        client_session = client_session_id(data.get("session_id"))
+        session_id = client_session or str(uuid.uuid4())
 
-        # --- Detección y Contexto (RAG Component) ---
-        municipio_found = (
-            find_municipio_in_text(user_prompt)
-            or search_municipio(user_prompt)
-            or extract_and_search_municipio(user_prompt)
-        )
+        # Streaming opcional: NDJSON, o SSE si el cliente lo pide por Accept
+        stream = bool(data.get("stream"))
+        sse = "text/event-stream" in request.headers.get("Accept", "")
 
-        municipio_context = ""
-        if municipio_found:
-            municipio_context = format_municipio_data(municipio_found)
-            municipio_context = "\n\n📍 *Información del municipio detectado:*\n" + municipio_context + "\n\n"
-        
-        # --- Preparación de mensajes para Ollama ---
-        messages_for_ollama = [{"role": "system", "content": SYSTEM_PROMPT}]
-        
-        if municipio_context:
-             messages_for_ollama.append({"role": "system", "content": "Contexto municipal:\n" + municipio_context})
-        
-        messages_for_ollama.append({"role": "user", "content": user_prompt})
+        # --- Detección, reglas y cachés (RAG Component) ---
+        query = prepare_query(user_prompt, client_session)
+        if query["content"] is not None:
+            remember_turn(query, query["content"])
+            payload = assistant_payload(query["content"], session_id, query["source"])
+            count_response(payload)
+            if stream:
+                return _stream_response(_stream_static(payload, sse), sse)
+            return jsonify(payload)
 
-        # --- Llamada a Ollama con Semaphore de GPU ---
-        if not _try_acquire_gpu():
-            return (jsonify({"error": "System busy", "reason": "gpu_queue_full"}), 429)
+        # --- Coalescencia: si una consulta idéntica ya está generando, se espera su salida ---
         try:
-            response_text = call_ollama(messages_for_ollama) 
-        finally:
-            _release_gpu()
+            with timed("coalesce"):
+                flight, shared = lead_or_follow(query)
+        except AdmissionRejected as rejected:
+            return _busy_response(rejected)
+        if shared is not None:
+            payload, status = finish_generation(
+                query, shared.result, session_id, coalesced=True, timed_out=shared.deadline_exceeded
+            )
+            if stream:
+                return _stream_response(_stream_static(payload, sse, status), sse)
+            return jsonify(payload), status
 
-        # ---------------------------------------------------------------------
-        # LÓGICA DE ROBUSTEZ: PARSEO Y FALLBACK DE JSON
-        # ---------------------------------------------------------------------
-        parsed_json = None
-        raw_response = response_text
-        
-        # 1. Intento simple de carga JSON
+        # --- Llamada a Ollama con un slot de GPU (espera en cola si están todos ocupados) ---
+        # Con micro-lotes, la espera por el slot es la cola del despachador, que junta los pedidos
+        gpu_lease = None
+        if stream or ollama_dispatcher is None:
+            environ = request.environ
+            try:
+                with timed("gpu_queue"):
+                    gpu_lease = _try_acquire_gpu(client_ip, lambda: _client_disconnected(environ))
+            except AdmissionRejected as rejected:
+                abort_flight(flight, rejected)
+                return _busy_response(rejected)
+        if stream:
+            return _stream_response(_stream_generation(query, session_id, sse, gpu_lease, flight), sse)
+        meta: Dict[str, Any] = {}
         try:
-            parsed_json = json.loads(raw_response)
-        except json.JSONDecodeError:
-            # 2. Fallback Regex: Extrae JSON envuelto en Markdown (```json {...} ```) o texto
-            
-            match = re.search(r"```json\s*(\{.*\})\s*```", raw_response, re.DOTALL)
-            
-            if not match:
-                # Intento de extracción buscando el primer '{' hasta el último '}'
-                start = raw_response.find('{')
-                end = raw_response.rfind('}')
-                
-                if start != -1 and end != -1 and end > start:
-                    json_string = raw_response[start:end+1]
-                    try:
-                        parsed_json = json.loads(json_string)
-                    except json.JSONDecodeError:
-                        pass
-            else:
-                # Usa el JSON capturado por el patrón Markdown
-                json_string = match.group(1)
-                try:
-                    parsed_json = json.loads(json_string)
-                except json.JSONDecodeError:
-                    pass
+            with timed("ollama"):
+                response_text = call_ollama(
+                    query["messages"], timeout=generation_deadline(query), meta=meta, options=query["options"]
+                )
+        except AdmissionRejected as rejected:
+            abort_flight(flight, rejected)
+            return _busy_response(rejected)
+        except Exception as e:
+            inflight_generations.fail(flight, e)
+            raise
+        finally:
+            _release_gpu(gpu_lease)
+        inflight_generations.complete(flight, response_text, bool(meta.get("deadline_exceeded")))
+        record_generation(query, meta)
 
-        
-        # --- Verificación de Clasificación y Manejo de Fallo ---
-        # *** Verificación Crítica: Buscamos el campo 'Clasificacion' para éxito ***
-        if parsed_json and isinstance(parsed_json, dict) and "Clasificacion" in parsed_json:
-            # Éxito: El LLM devolvió un JSON válido con el campo requerido.
-            return jsonify({
-                "role": "assistant",
-                "content": parsed_json,
-                "session_id": session_id,
-                "type": "structured_data"
-            })
-        else:
-            # Fallo del Modelo: El JSON no se pudo extraer o no contenía la clave 'Clasificacion'.
-            app.logger.error("JSONDecodeError: Fallo en la extracción de JSON o campo 'Clasificacion' faltante.")
-            
-            # *** Fallback Estructurado: Devuelve ERROR_MODELO para el Frontend ***
-            return jsonify({
-                "role": "assistant",
-                "content": {
-                    "Urgencia": "5",
-                    "Clasificacion": "ERROR_MODELO", 
-                    "respuesta_extendida": 
-                        "**Error de Clasificación (Modelo Fallido):** La IA no pudo generar el formato de datos necesario. " +
-                        "Esto ocurre si la pregunta es muy corta o el modelo falló. " +
-                        "**Output crudo:** " + raw_response[:200] + "..." 
-                },
-                "session_id": session_id,
-                "type": "error_fallback"
-            }), 500
+        # --- Parseo y fallback de JSON (ERROR_MODELO también si se agotó el plazo) ---
+        payload, status = finish_generation(
+            query, response_text, session_id, timed_out=bool(meta.get("deadline_exceeded"))
+        )
+        return jsonify(payload), status
 
     except Exception as e:
         app.logger.exception("Error general en /generate: %s", e)
         return jsonify({"error": str(e)}), 500
 
+@app.route("/generate_batch", methods=["POST"])
+def generate_batch():
+    """Clasifica un archivo de tickets (JSONL o CSV) y devuelve un resultado JSONL por ticket.
+
+    El archivo va como campo "file" de un formulario multipart o como cuerpo del POST
+    (text/csv o JSONL); la última línea trae el resumen. Un lote son hasta BATCH_MAX_ITEMS
+    llamadas al modelo por un solo pedido, así que sólo lo aceptan las IPs de WHITELIST_IPS.
+    """
+    client_ip = _get_client_ip()
+    if not _ip_whitelisted(client_ip):
+        count_rejection("batch_forbidden")
+        return jsonify({"error": "Clasificación por lotes no habilitada para esta IP (WHITELIST_IPS)"}), 403
+
+    request.max_content_length = BATCH_MAX_UPLOAD_BYTES
+    upload = request.files.get("file")
+    if upload is not None:
+        fmt = batch_format(upload.filename or "", upload.mimetype or "")
+        lines = io.TextIOWrapper(upload.stream, encoding="utf-8-sig", newline="")
+    else:
+        fmt = batch_format("", request.mimetype or "")
+        lines = io.StringIO(request.get_data(as_text=True), newline="")
+    try:
+        items = []
+        for item in iter_batch_items(lines, fmt):
+            if len(items) >= BATCH_MAX_ITEMS:
+                return jsonify({"error": f"El lote supera BATCH_MAX_ITEMS ({BATCH_MAX_ITEMS}); usá batch_classify.py"}), 413
+            items.append(item)
+    except (BatchInputError, UnicodeDecodeError, csv.Error) as e:
+        return jsonify({"error": f"Archivo inválido: {e}"}), 400
+    if not items:
+        return jsonify({"error": "Entrada inválida: el archivo no tiene tickets"}), 400
+
+    def results() -> Iterator[str]:
+        counts: Dict[str, int] = {}
+        for record in run_batch(iter(items), slots=_batch_slots):
+            counts[record["status"]] = counts.get(record["status"], 0) + 1
+            yield json.dumps(record, ensure_ascii=False) + "\n"
+        yield json.dumps({"summary": {"items": len(items), **counts}}, ensure_ascii=False) + "\n"
+
+    resp = Response(results(), mimetype="application/x-ndjson")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
+
+
+@app.route("/ready", methods=["GET"])
+def ready():
+    """Readiness para el healthcheck: 200 recién cuando el modelo está cargado en memoria."""
+    ollama_router.start()
+    readiness = ollama_router.readiness()
+    return jsonify({**readiness, "endpoints": ollama_router.stats()}), (200 if readiness["ready"] else 503)
+
+
+@app.route("/stats", methods=["GET"])
+def stats():
+    return jsonify({
+        "state": state_store.stats(),
+        "gpu_slots_in_use": state_store.slots_in_use("gpu"),
+        "gpu_queue": gpu_admission.stats(),
+        "coalescing": inflight_generations.stats(),
+        "generation": generation_stats.stats(),
+        "rag": rag_stats(),
+        "sessions": session_memory.stats() if session_memory is not None else {"enabled": False},
+        "json_parsing": model_parse_stats.stats(),
+        "ollama_readiness": ollama_router.readiness(),
+        "ollama_backends": ollama_router.stats(),
+        "ollama_batching": ollama_dispatcher.stats() if ollama_dispatcher is not None else {"enabled": False},
+        "rules": rules_stats(),
+        "response_cache": response_cache.stats(),
+        "semantic_cache": semantic_cache.stats() if semantic_cache is not None else {"enabled": False},
+        "startup": startup_report(),
+    })
+
+
+@metrics.collector
+def runtime_gauges() -> List[Tuple[str, str, str, Dict[str, str], float]]:
+    """Valores que ya llevan los componentes, leídos al momento del scrape."""
+    parsing = model_parse_stats.stats()
+    queue = gpu_admission.stats()
+    state = state_store.stats()
+    samples = [
+        ("asistente_gpu_slots_in_use", "gauge", "Slots de GPU ocupados (todos los workers).", {},
+         state_store.slots_in_use("gpu")),
+        ("asistente_gpu_slots_limit", "gauge", "Slots de GPU configurados (MAX_CONCURRENT_GPU).", {},
+         MAX_CONCURRENT_GPU),
+        ("asistente_gpu_queue_depth", "gauge", "Consultas esperando un slot de GPU.", {}, queue["depth"]),
+        ("asistente_rate_limit_keys", "gauge", "IPs con bucket de rate limit en memoria.", {},
+         state["rate_limit_keys"]),
+        ("asistente_response_cache_entries", "gauge", "Entradas en la caché de respuestas.", {},
+         response_cache.stats()["size"]),
+        ("asistente_model_outputs_total", "counter", "Salidas del modelo parseadas.", {}, parsing["outputs"]),
+        ("asistente_model_outputs_failed_total", "counter", "Salidas del modelo que terminaron en error_fallback.",
+         {}, parsing["failed"]),
+        ("asistente_error_fallback_ratio", "gauge", "Fracción de salidas del modelo sin JSON utilizable.", {},
+         parsing["error_fallback_rate"]),
+    ]
+    if session_memory is not None:
+        samples.append(("asistente_sessions", "gauge", "Sesiones de conversación en memoria.", {},
+                        session_memory.stats()["sessions"]))
+    for backend in ollama_router.stats():
+        labels = {"endpoint": backend["url"]}
+        samples.append(("asistente_ollama_requests_total", "counter", "Peticiones a cada endpoint de Ollama.",
+                        labels, backend["requests"]))
+        samples.append(("asistente_ollama_failures_total", "counter", "Errores de cada endpoint de Ollama.",
+                        labels, backend["failures"]))
+        samples.append(("asistente_ollama_endpoint_up", "gauge", "1 si el circuito del endpoint no está abierto.",
+                        labels, 0 if backend["state"] == "open" else 1))
+    return samples
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    """Métricas en formato de texto de Prometheus (de este worker)."""
+    if not METRICS_ENABLED:
+        return "Métricas deshabilitadas (METRICS_ENABLED=false).\n", 404, {"Content-Type": "text/plain"}
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
 # -----------------------------------------------------------------------------
 # Rutas de Configuración del Prompt
 # -----------------------------------------------------------------------------
@@ -685,8 +4755,12 @@ def save_prompt():
             f.write(new_content)
         
         # Recarga global del prompt para aplicar cambios inmediatamente
-        global SYSTEM_PROMPT
-        SYSTEM_PROMPT = load_system_prompt()
+        reload_system_prompt()
+        # Las respuestas cacheadas se generaron con el prompt anterior
+        response_cache.clear()
+        if semantic_cache is not None:
+            semantic_cache.clear()
+            semantic_cache.fingerprint = hashlib.sha256(get_system_prompt().encode("utf-8")).hexdigest()
         
         return jsonify({"success": True}), 200
     except Exception as e:
@@ -694,9 +4768,80 @@ def save_prompt():
         return jsonify({"success": False, "error": str(e)}), 500
 
 
+# -----------------------------------------------------------------------------
+# Arranque: carga diferida e informe de tiempos
+# -----------------------------------------------------------------------------
+_startup: Dict[str, Any] = {
+    "imports_ms": (_IMPORTS_DONE - _MODULE_STARTED) * 1000,
+    "module_ms": None,
+    "warm_start_ms": None,
+    "warm_start": None,
+    "first_request": None,
+}
+_startup_lock = threading.Lock()
+
+
+def warm_start() -> Dict[str, Any]:
+    """Carga lo que necesita la primera consulta: prompt de sistema, índice RAG (del snapshot si
+    está al día), bleach y las páginas precomprimidas.
+
+    serve.py lo llama antes del fork, así los workers lo heredan ya cargado; sin warm_start
+    cada parte se carga en su primer uso.
+    """
+    started = time.perf_counter()
+    reload_system_prompt()
+    prompt_done = time.perf_counter()
+    refresh_rag_data()
+    rag_done = time.perf_counter()
+    # sanitize_html importa bleach en su primer uso; toda respuesta pasa por ahí
+    import bleach  # noqa: F401
+    sanitizer_done = time.perf_counter()
+    load_static_pages()
+    done = time.perf_counter()
+    _startup["warm_start"] = {
+        "system_prompt_ms": (prompt_done - started) * 1000,
+        "rag_ms": (rag_done - prompt_done) * 1000,
+        "rag_source": _rag_state["last_source"],
+        "sanitizer_ms": (sanitizer_done - rag_done) * 1000,
+        "static_pages_ms": (done - sanitizer_done) * 1000,
+    }
+    _startup["warm_start_ms"] = (done - started) * 1000
+    app.logger.info(
+        "Arranque: imports %.0f ms, módulo %.0f ms, warm_start %.0f ms (índice RAG desde %s).",
+        _startup["imports_ms"], _startup["module_ms"] or 0.0, _startup["warm_start_ms"], _rag_state["last_source"],
+    )
+    return startup_report()
+
+
+def record_first_request(path: str, duration_s: float, timings: Optional[Dict[str, float]] = None):
+    """Registra la primera consulta atendida: cuándo llegó respecto de la importación y cuánto tardó."""
+    with _startup_lock:
+        if _startup["first_request"] is not None:
+            return
+        _startup["first_request"] = {
+            "path": path,
+            "since_import_ms": (time.perf_counter() - _MODULE_STARTED) * 1000,
+            "duration_ms": duration_s * 1000,
+            "stages_ms": {stage: seconds * 1000 for stage, seconds in (timings or {}).items()},
+        }
+    app.logger.info(
+        "Primera consulta (%s): %.1f ms, a los %.0f ms de empezar a importar run.py.",
+        path, duration_s * 1000, _startup["first_request"]["since_import_ms"],
+    )
+
+
+def startup_report() -> Dict[str, Any]:
+    return {**_startup, "pid": os.getpid()}
+
+
+_startup["module_ms"] = (time.perf_counter() - _IMPORTS_DONE) * 1000
+
+
 # -----------------------------------------------------------------------------
 # Run
 # -----------------------------------------------------------------------------
 if __name__ == "__main__":
     # Escucha en 0.0.0.0 y usa el puerto 8001 (configuración de Docker)
+    warm_start()
+    ollama_router.start()
     app.run(host='0.0.0.0', port=os.getenv("FLASK_PORT", 8001))
\ No newline at end of file
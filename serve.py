@@ -0,0 +1,112 @@
+"""Lanzador de producción: varios procesos worker (gevent) sobre un mismo socket.
+
+El proceso principal carga la app una sola vez y luego hace fork de WORKERS hijos que
+comparten el socket de escucha; si un worker muere, se reemplaza. Con más de un worker
+el estado compartido (rate limiting, slots de GPU, rotación de endpoints) pasa a SQLite
+para que los límites sigan siendo globales.
+
+    WORKERS=4 python serve.py
+"""
+from gevent import monkey
+
+monkey.patch_all()
+
+import os
+import signal
+import socket
+import sys
+
+import gevent
+from gevent.pywsgi import WSGIHandler, WSGIServer
+
+# Pocos workers alcanzan: el cuello es la GPU (MAX_CONCURRENT_GPU slots) y cada worker suma su
+# propio sondeo de salud y precarga contra Ollama
+WORKERS = int(os.getenv("WORKERS", "2"))
+HOST = os.getenv("FLASK_HOST", "0.0.0.0")
+PORT = int(os.getenv("FLASK_PORT", "8001"))
+
+if WORKERS > 1:
+    # Varios procesos: los diccionarios en memoria dejarían de ser límites globales
+    os.environ.setdefault("STATE_BACKEND", "sqlite")
+
+import run  # noqa: E402  (después del monkey patching y de fijar STATE_BACKEND)
+
+
+def make_listener() -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((HOST, PORT))
+    sock.listen(2048)
+    return sock
+
+
+class Handler(WSGIHandler):
+    def get_environ(self):
+        env = super().get_environ()
+        # Permite a la cola de GPU detectar clientes que se desconectaron mientras esperaban
+        env["gevent.socket"] = self.socket
+        return env
+
+
+def serve_worker(listener):
+    # Precarga del modelo y sondeo de Ollama propios de este worker (los hilos no sobreviven al fork)
+    run.ollama_router.start()
+    server = WSGIServer(listener, run.app, handler_class=Handler)
+    gevent.signal_handler(signal.SIGTERM, server.stop)
+    gevent.signal_handler(signal.SIGINT, server.stop)
+    server.serve_forever()
+
+
+def main():
+    listener = make_listener()
+    # Prompt e índice RAG cargados una vez en el proceso principal: los workers los heredan
+    run.warm_start()
+    run.app.logger.warning(
+        "Sirviendo en %s:%d con %d worker(s), estado '%s'", HOST, PORT, WORKERS, run.STATE_BACKEND
+    )
+    if WORKERS <= 1:
+        serve_worker(listener)
+        return
+
+    children = set()
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            try:
+                serve_worker(listener)
+            finally:
+                os._exit(0)
+        children.add(pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for _ in range(WORKERS):
+        spawn()
+
+    while children:
+        try:
+            pid, status = os.waitpid(-1, 0)
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        children.discard(pid)
+        if not stopping:
+            run.app.logger.warning("Worker %d terminó (estado %d); se reemplaza.", pid, status)
+            spawn()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,185 @@
+"""Servidor Ollama de prueba para benchmarks: responde /api/chat con una clasificación fija.
+
+    STUB_LATENCY_MS=200 STUB_TOKEN_MS=25 STUB_MALFORMED_RATE=0.1 STUB_PARALLEL=4 python stub_ollama.py
+"""
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# -----------------------------------------------------------------------------
+# CONFIGURACIÓN DEL STUB
+# -----------------------------------------------------------------------------
+STUB_PORT = int(os.getenv("STUB_PORT", "11435"))
+# Latencia fija antes de empezar a responder (simula la evaluación del prompt)
+STUB_LATENCY_MS = float(os.getenv("STUB_LATENCY_MS", "50"))
+# Variación aleatoria de la latencia, +/- en ms
+STUB_JITTER_MS = float(os.getenv("STUB_JITTER_MS", "0"))
+# Tiempo por token generado (0 = respuesta instantánea tras la latencia); 25 ms ~ 40 tokens/s
+STUB_TOKEN_MS = float(os.getenv("STUB_TOKEN_MS", "0"))
+# Fracción de respuestas con los defectos típicos de gemma2 (bloque ```json, comas finales, cortes...)
+STUB_MALFORMED_RATE = float(os.getenv("STUB_MALFORMED_RATE", "0"))
+STUB_SEED = int(os.getenv("STUB_SEED", "42"))
+# Peticiones atendidas a la vez, como OLLAMA_NUM_PARALLEL (0 = sin límite); el resto espera
+STUB_PARALLEL = int(os.getenv("STUB_PARALLEL", "0"))
+# Caracteres por token simulado (los fragmentos del stream tienen un token cada uno)
+STUB_CHARS_PER_TOKEN = 8
+
+STUB_RESPONSE = {
+    "Clasificacion": "ESCRITURACIÓN",
+    "Urgencia": "2",
+    "descripcion_corta": "Consulta sobre escrituración.",
+    "respuesta_extendida": "Para escriturar tu vivienda necesitás el boleto de compra-venta y los DNI de todos los intervinientes.",
+}
+
+# Defectos que se aplican a la salida cuando toca una respuesta malformada
+MALFORMACIONES = [
+    lambda c: "Claro, aquí tenés la clasificación:\n```json\n" + c + "\n```",
+    lambda c: c[:-1] + ",}",
+    lambda c: c.replace('"', "'"),
+    lambda c: c[:len(c) * 2 // 3],
+    lambda c: c.replace(". ", ".\n", 1),
+    lambda c: "No puedo clasificar esta consulta sin más información.",
+]
+
+# -----------------------------------------------------------------------------
+
+_rng = random.Random(STUB_SEED)
+_rng_lock = threading.Lock()
+
+
+def response_content(malformed_rate: float) -> str:
+    """Salida del modelo: la clasificación fija o, con probabilidad malformed_rate, una variante defectuosa."""
+    content = json.dumps(STUB_RESPONSE, ensure_ascii=False)
+    if malformed_rate <= 0:
+        return content
+    with _rng_lock:
+        if _rng.random() >= malformed_rate:
+            return content
+        return _rng.choice(MALFORMACIONES)(content)
+
+
+def response_latency_ms(latency_ms: float, jitter_ms: float) -> float:
+    if jitter_ms <= 0:
+        return latency_ms
+    with _rng_lock:
+        return max(0.0, latency_ms + _rng.uniform(-jitter_ms, jitter_ms))
+
+
+def response_tokens() -> int:
+    """Tokens que el stub "genera" por respuesta (eval_count)."""
+    content = json.dumps(STUB_RESPONSE, ensure_ascii=False)
+    return -(-len(content) // STUB_CHARS_PER_TOKEN)
+
+
+class StubOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Como el servidor de Ollama (Go): sin Nagle, si no las conexiones persistentes suman ~40 ms por respuesta
+    disable_nagle_algorithm = True
+    latency_ms = STUB_LATENCY_MS
+    jitter_ms = STUB_JITTER_MS
+    token_ms = STUB_TOKEN_MS
+    malformed_rate = STUB_MALFORMED_RATE
+    slots = threading.BoundedSemaphore(STUB_PARALLEL) if STUB_PARALLEL > 0 else None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/api/tags":
+            self._send_json(200, {"models": []})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", "0"))
+        try:
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            request = {}
+        if self.path != "/api/chat":
+            self._send_json(404, {"error": "not found"})
+            return
+
+        if self.slots is not None:
+            with self.slots:
+                self._chat(request)
+        else:
+            self._chat(request)
+
+    def _chat(self, request):
+        if not request.get("messages"):
+            # Como Ollama: un chat sin mensajes sólo carga el modelo
+            self._send_json(200, {"model": request.get("model", "stub"), "done": True, "done_reason": "load"})
+            return
+        time.sleep(response_latency_ms(self.latency_ms, self.jitter_ms) / 1000.0)
+        content = response_content(self.malformed_rate)
+        model = request.get("model", "stub")
+        pieces = [content[i:i + STUB_CHARS_PER_TOKEN] for i in range(0, len(content), STUB_CHARS_PER_TOKEN)]
+        prompt_chars = sum(len(str(m.get("content", ""))) for m in request.get("messages", []))
+        done = {
+            "model": model,
+            "done": True,
+            "prompt_eval_count": -(-prompt_chars // 4),
+            "prompt_eval_duration": int(self.latency_ms * 1e6),
+            "eval_count": len(pieces),
+            "eval_duration": int(len(pieces) * self.token_ms * 1e6),
+        }
+
+        if not request.get("stream"):
+            time.sleep(len(pieces) * self.token_ms / 1000.0)
+            self._send_json(200, {**done, "message": {"role": "assistant", "content": content}})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for piece in pieces:
+            if self.token_ms:
+                time.sleep(self.token_ms / 1000.0)
+            self._write_chunk({"model": model, "message": {"role": "assistant", "content": piece}, "done": False})
+        self._write_chunk({**done, "message": {"role": "assistant", "content": ""}})
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_chunk(self, payload):
+        data = (json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8")
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+
+def start_stub(port=0, latency_ms=None, token_ms=None, malformed_rate=None):
+    """Levanta el stub en un hilo y devuelve el servidor (server.server_port tiene el puerto)."""
+    overrides = {
+        name: value
+        for name, value in (("latency_ms", latency_ms), ("token_ms", token_ms), ("malformed_rate", malformed_rate))
+        if value is not None
+    }
+    handler = StubOllamaHandler
+    if overrides:
+        handler = type("StubOllamaHandler", (StubOllamaHandler,), overrides)
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    server = ThreadingHTTPServer(("0.0.0.0", STUB_PORT), StubOllamaHandler)
+    server.daemon_threads = True
+    print(
+        f"Stub de Ollama escuchando en http://0.0.0.0:{STUB_PORT} (latencia {STUB_LATENCY_MS} ms "
+        f"+/- {STUB_JITTER_MS}, {STUB_TOKEN_MS} ms/token, {STUB_MALFORMED_RATE:.0%} malformadas, "
+        f"{STUB_PARALLEL or 'sin límite de'} slots)"
+    )
+    server.serve_forever()
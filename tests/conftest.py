@@ -0,0 +1,37 @@
+"""Entorno de las pruebas: run.py contra stub_ollama.py y una copia de las bases en un directorio temporal.
+
+La configuración de run.py se lee al importarlo, así que el entorno se arma acá, antes de
+que los módulos de prueba lo importen. El índice de municipios sincroniza el CSV con
+municipios.db en su primer uso: se trabaja sobre copias para no modificar el repositorio.
+"""
+import os
+import shutil
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import stub_ollama  # noqa: E402
+
+WORKDIR = tempfile.mkdtemp(prefix="asistente-ia-tests-")
+stub = stub_ollama.start_stub(0, latency_ms=20, token_ms=0, malformed_rate=0)
+os.environ.update({
+    "OLLAMA_ENDPOINT": f"http://127.0.0.1:{stub.server_port}",
+    "OLLAMA_WARMUP_ENABLED": "false",
+    "STATE_BACKEND": "memory",
+    "GAZETTEER_SNAPSHOT_PATH": os.path.join(WORKDIR, "municipios.snapshot.pkl"),
+    "SEMANTIC_CACHE_ENABLED": "false",
+    "OLLAMA_BATCH_ENABLED": "false",
+    "WHITELIST_IPS": "10.9.0.0/16",
+})
+
+import run  # noqa: E402
+
+run.DB_NAME = shutil.copy(os.path.join(ROOT, run.DB_NAME), os.path.join(WORKDIR, "municipios.db"))
+run.CSV_PATH = shutil.copy(os.path.join(ROOT, run.CSV_PATH), os.path.join(WORKDIR, "datos_tierras.csv"))
+
+
+def pytest_sessionfinish(session, exitstatus):
+    stub.shutdown()
+    shutil.rmtree(WORKDIR, ignore_errors=True)
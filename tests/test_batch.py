@@ -0,0 +1,107 @@
+"""Clasificación por lotes: resultados en orden, cancelación, retomar el CLI y acceso a /generate_batch."""
+import json
+import threading
+import time
+
+import batch_classify
+import run
+
+
+def tickets(n, start=0):
+    return [(str(i), f"reclamo {i}: el municipio no me contesta por el expediente de mi casa") for i in range(start, start + n)]
+
+
+def test_run_batch_keeps_input_order():
+    records = list(run.run_batch(iter(tickets(12)), workers=3))
+    assert [r["id"] for r in records] == [str(i) for i in range(12)]
+    assert {r["status"] for r in records} == {"ok"}
+
+
+def test_run_batch_cancel_while_waiting_for_gpu():
+    # Con todos los slots ocupados, los tickets esperan GPU hasta que se cancela el lote
+    leases = [run.gpu_admission.try_admit_now() for _ in range(run.MAX_CONCURRENT_GPU)]
+    assert all(leases)
+    stop = threading.Event()
+    records = []
+    worker = threading.Thread(target=lambda: records.extend(run.run_batch(iter(tickets(10, 100)), 2, stop)))
+    try:
+        worker.start()
+        time.sleep(0.3)
+        stop.set()
+        worker.join(5)
+    finally:
+        for lease in leases:
+            run._release_gpu(lease)
+    assert not worker.is_alive()
+    assert records and len(records) < 10
+    assert {r["status"] for r in records} == {"cancelled"}
+
+
+def test_run_batch_stops_reading_items_after_cancel():
+    stop = threading.Event()
+    read = []
+
+    def items():
+        for item in tickets(50, 200):
+            read.append(item[0])
+            yield item
+
+    for _ in run.run_batch(items(), workers=2, stop=stop):
+        stop.set()
+    assert len(read) < 50
+
+
+def test_run_batch_shared_slots_bound_concurrency():
+    slots = threading.BoundedSemaphore(1)
+    running, peak = [0], [0]
+    lock = threading.Lock()
+    classify = run.classify_batch_item
+
+    def tracked(item_id, text, stop):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        try:
+            return classify(item_id, text, stop)
+        finally:
+            with lock:
+                running[0] -= 1
+
+    run.classify_batch_item = tracked
+    try:
+        records = list(run.run_batch(iter(tickets(6, 300)), workers=4, slots=slots))
+    finally:
+        run.classify_batch_item = classify
+    assert len(records) == 6
+    assert peak[0] == 1
+
+
+def test_classify_resumes_from_checkpoint(tmp_path):
+    source = tmp_path / "tickets.jsonl"
+    output = tmp_path / "salida.jsonl"
+    source.write_text("".join(json.dumps({"id": i, "prompt": text}) + "\n" for i, text in tickets(4, 400)))
+    output.write_text(
+        json.dumps({"id": "400", "status": "ok", "previo": True}) + "\n"
+        + json.dumps({"id": "401", "status": "error", "error": "timeout"}) + "\n"
+        + '{"id": "402", "stat'
+    )
+    counts = batch_classify.classify(str(source), str(output), "jsonl", 2)
+    records = [json.loads(line) for line in output.read_text().splitlines()]
+    assert sorted(r["id"] for r in records) == ["400", "401", "402", "403"]
+    assert next(r for r in records if r["id"] == "400")["previo"] is True
+    assert all(r["status"] == "ok" for r in records)
+    assert counts == {"ok": 3}
+
+
+def test_generate_batch_only_for_whitelisted_ips():
+    client = run.app.test_client()
+    body = "".join(json.dumps({"id": i, "prompt": text}) + "\n" for i, text in tickets(3, 500))
+    denied = client.post("/generate_batch", data=body, content_type="application/x-ndjson",
+                         environ_base={"REMOTE_ADDR": "192.0.2.7"})
+    assert denied.status_code == 403
+    allowed = client.post("/generate_batch", data=body, content_type="application/x-ndjson",
+                          environ_base={"REMOTE_ADDR": "10.9.1.2"})
+    lines = [json.loads(line) for line in allowed.get_data(as_text=True).splitlines()]
+    assert allowed.status_code == 200
+    assert [r["id"] for r in lines[:-1]] == ["500", "501", "502"]
+    assert lines[-1] == {"summary": {"items": 3, "ok": 3}}
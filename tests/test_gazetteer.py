@@ -0,0 +1,70 @@
+"""Búsqueda de municipios: menciones literales (NameMatcher) y búsqueda difusa (FuzzyIndex)."""
+import difflib
+
+import run
+
+
+def matcher(*names):
+    m = run.NameMatcher()
+    for name in names:
+        m.add(name)
+    m.build()
+    return m
+
+
+def found(m, text):
+    return sorted((text[start:end], m.names[name_id]) for start, end, name_id in m.find_all(text))
+
+
+def test_name_matcher_finds_overlapping_names():
+    m = matcher("general san martin", "san martin", "martin", "la plata")
+    text = "vivo en general san martin cerca de la plata"
+    assert found(m, text) == [
+        ("general san martin", "general san martin"),
+        ("la plata", "la plata"),
+        ("martin", "martin"),
+        ("san martin", "san martin"),
+    ]
+
+
+def test_name_matcher_matches_whole_words_only():
+    m = matcher("tandil", "la plata")
+    assert found(m, "tandilense de la platanera") == []
+
+
+def test_name_matcher_recovers_after_partial_match():
+    m = matcher("san isidro", "san pedro")
+    assert found(m, "san san pedro") == [("san pedro", "san pedro")]
+
+
+def test_name_matcher_add_returns_existing_id():
+    m = run.NameMatcher()
+    assert m.add("quilmes") == m.add("quilmes")
+
+
+VALUES = [
+    "quilmes", "tandil", "la plata", "lomas de zamora", "general san martin", "san isidro",
+    "san pedro", "san fernando", "tres de febrero", "bahia blanca", "mar del plata", "olavarria",
+]
+
+
+def brute_force(q, threshold):
+    best_id, best_sim = None, 0.0
+    for value_id, value in enumerate(VALUES):
+        sim = difflib.SequenceMatcher(None, q, value).ratio()
+        if sim >= threshold and sim > best_sim:
+            best_id, best_sim = value_id, sim
+    return best_id
+
+
+def test_fuzzy_index_matches_brute_force():
+    index = run.FuzzyIndex(VALUES, 0.8)
+    queries = ["quilmez", "tandill", "la palta", "lomas de zamora", "gral san martin",
+               "san isidor", "san pedor", "bahia blanka", "mardel plata", "olavaria", "cordoba", ""]
+    for q in queries:
+        assert index.best_match(q)[0] == brute_force(q, 0.8), q
+
+
+def test_fuzzy_index_below_threshold():
+    index = run.FuzzyIndex(VALUES, 0.85)
+    assert index.best_match("rosario") == (None, 0.0)
@@ -0,0 +1,82 @@
+"""Extracción del JSON del modelo: reparaciones de _scan_json_object y lectura incremental del stream."""
+import json
+
+import run
+
+
+def scan(text):
+    repairs = []
+    candidates, end = run._scan_json_object(text, text.index("{"), repairs)
+    return candidates, end, repairs
+
+
+def test_scan_valid_object_stops_at_its_end():
+    text = '{"a": "x}y", "b": [1, {"c": 2}]} resto'
+    candidates, end, repairs = scan(text)
+    assert json.loads(candidates[0]) == {"a": "x}y", "b": [1, {"c": 2}]}
+    assert text[end:] == " resto"
+    assert repairs == []
+
+
+def test_scan_repairs_trailing_comma():
+    candidates, _, repairs = scan('{"a": 1,}')
+    assert json.loads(candidates[0]) == {"a": 1}
+    assert "trailing_comma" in repairs
+
+
+def test_scan_repairs_single_quotes_and_python_literals():
+    candidates, _, repairs = scan("{'a': True, 'b': None}")
+    assert json.loads(candidates[0]) == {"a": True, "b": None}
+    assert {"single_quotes", "python_literals"} <= set(repairs)
+
+
+def test_scan_closes_truncated_output():
+    candidates, _, repairs = scan('{"a": "completo", "b": [1, 2')
+    assert "truncated" in repairs
+    parsed = [json.loads(c) for c in candidates]
+    assert parsed[0] == {"a": "completo", "b": [1, 2]}
+    assert parsed[-1]["a"] == "completo"
+
+
+def test_scan_escapes_control_characters_in_strings():
+    candidates, _, _ = scan('{"a": "linea uno\nlinea dos"}')
+    assert json.loads(candidates[0]) == {"a": "linea uno\nlinea dos"}
+
+
+def test_iter_json_objects_in_order_with_surrounding_text():
+    found = list(run.iter_json_objects('Claro: {"a": 1} y además {"b": 2}'))
+    assert [obj for obj, _ in found] == [{"a": 1}, {"b": 2}]
+    assert all("surrounding_text" in repairs for _, repairs in found)
+
+
+def test_iter_json_objects_skips_unparseable_objects():
+    found = list(run.iter_json_objects('{sin comillas} {"ok": true}'))
+    assert found[-1][0] == {"ok": True}
+
+
+def test_iter_json_objects_without_json():
+    assert list(run.iter_json_objects("No puedo clasificar esta consulta.")) == []
+
+
+def feed_all(chunks):
+    parser = run.StreamingJSONFields()
+    events = []
+    for chunk in chunks:
+        events.extend(parser.feed(chunk))
+    return events
+
+
+def test_streaming_fields_emit_deltas_then_complete_values():
+    events = feed_all(['{"Clasif', 'icacion": "ESCRI', 'TURA", "Urg', 'encia": 3, "x": {"y": [1]}}'])
+    deltas = [e["text"] for e in events if e["event"] == "delta" and e["key"] == "Clasificacion"]
+    assert "".join(deltas) == "ESCRITURA"
+    fields = {e["key"]: e["value"] for e in events if e["event"] == "field"}
+    assert fields == {"Clasificacion": "ESCRITURA", "Urgencia": 3, "x": {"y": [1]}}
+
+
+def test_streaming_fields_same_result_for_any_split():
+    text = json.dumps({"a": "tilde á \"citada\" ñ", "b": None, "c": [1, "]"]}, ensure_ascii=True)
+    whole = [e for e in feed_all([text]) if e["event"] == "field"]
+    by_char = [e for e in feed_all(list(text)) if e["event"] == "field"]
+    assert whole == by_char
+    assert {e["key"]: e["value"] for e in whole} == json.loads(text)
@@ -0,0 +1,54 @@
+"""Caché de respuestas (TTL y LRU) y token buckets del estado en memoria."""
+import time
+
+import run
+
+
+def test_response_cache_expires_after_ttl():
+    cache = run.ResponseCache(max_size=4, ttl=0.05)
+    cache.put("k", {"v": 1})
+    assert cache.get("k") == {"v": 1}
+    time.sleep(0.06)
+    assert cache.get("k") is None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_response_cache_evicts_least_recently_used():
+    cache = run.ResponseCache(max_size=2, ttl=60)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1  # "b" queda como el menos reciente
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+
+
+def test_response_cache_disabled_with_size_zero():
+    cache = run.ResponseCache(max_size=0, ttl=60)
+    cache.put("a", 1)
+    assert cache.get("a") is None
+
+
+def test_take_token_allows_burst_then_rejects():
+    store = run.InProcessStateStore()
+    assert [store.take_token("ip:1", 0.0, 3.0) for _ in range(4)] == [True, True, True, False]
+    # Cada clave tiene su propio bucket
+    assert store.take_token("ip:2", 0.0, 3.0)
+
+
+def test_take_token_refills_over_time():
+    store = run.InProcessStateStore()
+    assert store.take_token("ip:1", 100.0, 1.0)
+    assert not store.take_token("ip:1", 100.0, 1.0)
+    time.sleep(0.02)
+    assert store.take_token("ip:1", 100.0, 1.0)
+
+
+def test_take_token_forgets_oldest_keys_beyond_max_keys():
+    store = run.InProcessStateStore(shards=1, max_keys=2)
+    assert store.take_token("a", 0.0, 1.0)
+    assert not store.take_token("a", 0.0, 1.0)
+    store.take_token("b", 0.0, 1.0)
+    store.take_token("c", 0.0, 1.0)
+    # "a" se descartó por el tope: vuelve con el bucket lleno
+    assert store.take_token("a", 0.0, 1.0)